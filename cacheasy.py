@@ -1,15 +1,46 @@
-from enum import Enum
+from enum import Enum, IntEnum
 import numpy as np
 import math
+import sys
+import os
+import io
+import csv
+import glob
+import json
+import time
+import signal
+import contextlib
+import builtins
+import hashlib
+import tempfile
+import asyncio
+import threading
+import colorama
+import cmd2
+from collections import OrderedDict, deque
+from itertools import islice, repeat
+from concurrent.futures import ProcessPoolExecutor
+from queue import Queue
 
 rng = np.random.default_rng()
 
 ReplacementPolicy = Enum('ReplacementPolicy', ['FIFO', 'LRU', 'MRU', 'RANDOM'])
+#how the lines of a level relate to those of the levels above it: they may or may not be there
+#(NINE), they always are (INCLUSIVE) or they never are (EXCLUSIVE)
+InclusionPolicy = Enum('InclusionPolicy', ['NINE', 'INCLUSIVE', 'EXCLUSIVE'])
+
+#stands in for colorama's Fore/Back/Style when colours are disabled, so no escape codes are ever built
+class NoColour:
+    def __getattr__(self, name):
+        return ""
+
+colour_enabled = True
 
-from colorama import Fore, Back, Style
-def prettydir(addr, totalbits, setbits, bytebits, brackets=True, tagcol = Fore.RED, virtualbits = 0):
+def prettydir(addr, totalbits, setbits, bytebits, brackets=True, tagcol = None, virtualbits = 0):
     if totalbits == 0:
         return ""
+    if tagcol is None:
+        tagcol = Fore.RED
     #calculate the toal amount of bits
     blockbits = totalbits - setbits - bytebits
     #convert addr to binary string of (totalbits)
@@ -26,16 +57,56 @@ def prettydir(addr, totalbits, setbits, bytebits, brackets=True, tagcol = Fore.R
     else:
         return f"{app_str}{tagcol}{blockstr}{Fore.GREEN}{setstr}{Fore.BLUE}{bytebits}{Style.RESET_ALL}"
     
-prettytick = f"{Fore.GREEN}✔{Style.RESET_ALL}"
-prettyfail = f"{Fore.RED}✘{Style.RESET_ALL}"
-prettyright = f"{Fore.YELLOW}→{Style.RESET_ALL}"
-prettyleft = f"{Fore.YELLOW}←{Style.RESET_ALL}"
-prettyup = f"{Fore.BLUE}↑{Style.RESET_ALL}"
-prettyupyellow = f"{Fore.YELLOW}↑{Style.RESET_ALL}"
-prettydown = f"{Fore.BLUE}↓{Style.RESET_ALL}"
-prettydowndown = f"{Fore.BLUE}⯯{Style.RESET_ALL}"
-prettyswap = f"{Fore.YELLOW}⇆{Style.RESET_ALL}"
-prettytrash = f"{Fore.MAGENTA}🗑{Style.RESET_ALL}"
+def set_colour(enabled):
+    global Fore, Back, Style, colour_enabled
+    global prettytick, prettyfail, prettyright, prettyleft, prettyup, prettyupyellow, prettydown, prettydowndown, prettyswap, prettytrash
+    colour_enabled = enabled
+    if enabled:
+        Fore, Back, Style = colorama.Fore, colorama.Back, colorama.Style
+    else:
+        Fore = Back = Style = NoColour()
+    prettytick = f"{Fore.GREEN}✔{Style.RESET_ALL}"
+    prettyfail = f"{Fore.RED}✘{Style.RESET_ALL}"
+    prettyright = f"{Fore.YELLOW}→{Style.RESET_ALL}"
+    prettyleft = f"{Fore.YELLOW}←{Style.RESET_ALL}"
+    prettyup = f"{Fore.BLUE}↑{Style.RESET_ALL}"
+    prettyupyellow = f"{Fore.YELLOW}↑{Style.RESET_ALL}"
+    prettydown = f"{Fore.BLUE}↓{Style.RESET_ALL}"
+    prettydowndown = f"{Fore.BLUE}⯯{Style.RESET_ALL}"
+    prettyswap = f"{Fore.YELLOW}⇆{Style.RESET_ALL}"
+    prettytrash = f"{Fore.MAGENTA}🗑{Style.RESET_ALL}"
+
+#colours only make sense on a terminal
+set_colour(sys.stdout.isatty())
+
+
+#all the simulator output goes through a single buffered writer. It is flushed
+#when the prompt returns, every flush_lines lines, or explicitly. Background threads
+#(live ingestion) write through it too, so lines are buffered and written under a lock
+class OutputWriter:
+
+    def __init__(self, flush_lines = 4096):
+        self.lines = []
+        self.flush_lines = flush_lines
+        self.lock = threading.RLock()
+
+    def write(self, text):
+        with self.lock:
+            self.lines.append(text)
+            if len(self.lines) >= self.flush_lines:
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.lines:
+                #resolved on every flush so stdout redirections are honored
+                stream = sys.stdout
+                stream.write("\n".join(self.lines))
+                stream.write("\n")
+                stream.flush()
+                self.lines.clear()
+
+output = OutputWriter()
 
 
 def bits_to_power(bits, unit):
@@ -54,15 +125,456 @@ def bits_to_power(bits, unit):
     return f"{2**(bits-60)}E{unit}"
 
 
-from collections import OrderedDict
+#every narrated event of the hierarchy. Stored as one byte in the event log
+EventKind = IntEnum('EventKind', ['READ_REQUEST', 'WRITE_REQUEST', 'VIRTUAL_READ_REQUEST', 'VIRTUAL_WRITE_REQUEST',
+                                  'HIT', 'MISS', 'FILL', 'EVICT',
+                                  'VICTIM_HIT', 'VICTIM_MISS', 'SWAP_OUT', 'SWAP_IN', 'VICTIM_PUSH', 'VICTIM_EVICT',
+                                  'CLEAR_PUSH', 'CLEAR',
+                                  'MEMORY_READ', 'MEMORY_WRITE',
+                                  'PAGE_HIT', 'PAGE_FAULT', 'PAGE_LOAD', 'PAGE_EVICT', 'PAGE_SWAP',
+                                  'PREFETCH_FILL', 'PREFETCH_BUFFER', 'PREFETCH_SUPPLY',
+                                  'PAGE_WALK', 'BUFFER_DRAIN',
+                                  'UPGRADE', 'INVALIDATE', 'DOWNGRADE', 'BACK_INVALIDATE'])
+
+#groups of event kinds that can be used as filters. Prefetch is a flag, not a kind
+EVENT_CATEGORIES = {
+    'request': (EventKind.READ_REQUEST, EventKind.WRITE_REQUEST, EventKind.VIRTUAL_READ_REQUEST, EventKind.VIRTUAL_WRITE_REQUEST),
+    'hit': (EventKind.HIT, EventKind.VICTIM_HIT, EventKind.PAGE_HIT),
+    'miss': (EventKind.MISS, EventKind.VICTIM_MISS, EventKind.PAGE_FAULT),
+    'pull': (EventKind.FILL, EventKind.MEMORY_READ, EventKind.PAGE_LOAD, EventKind.PREFETCH_FILL, EventKind.PREFETCH_BUFFER, EventKind.PREFETCH_SUPPLY, EventKind.PAGE_WALK),
+    'evict': (EventKind.EVICT, EventKind.VICTIM_PUSH, EventKind.VICTIM_EVICT, EventKind.CLEAR_PUSH, EventKind.CLEAR, EventKind.MEMORY_WRITE, EventKind.PAGE_EVICT, EventKind.BUFFER_DRAIN, EventKind.BACK_INVALIDATE),
+    'swap': (EventKind.SWAP_OUT, EventKind.SWAP_IN, EventKind.PAGE_SWAP),
+    'coherence': (EventKind.UPGRADE, EventKind.INVALIDATE, EventKind.DOWNGRADE),
+}
+
+REQUEST_KINDS = frozenset(EVENT_CATEGORIES['request'])
+
+
+class EventLog:
+    #one fixed size record per event. For virtual memory events the set is the physical page
+    #and aux the other virtual page involved
+    DTYPE = np.dtype([('access', '<i8'), ('level', '<u2'), ('kind', 'u1'), ('flags', 'u1'),
+                      ('set', '<u4'), ('addr', '<u8'), ('aux', '<u8')])
+    PREFETCH = 1
+
+    def __init__(self, capacity = 4096):
+        self.events = np.zeros(capacity, dtype=EventLog.DTYPE)
+        self.size = 0
+        #index of the current request, incremented by every request event
+        self.access = -1
+        #flags applied to every event recorded (e.g: while prefetching)
+        self.flags = 0
+        #objects able to render their events, indexed by the level field
+        self.levels = []
+        self.level_names = []
+
+    def register(self, level):
+        if getattr(level, 'event_log', None) is self:
+            return level.event_id
+        self.levels.append(level)
+        self.level_names.append(level.name)
+        return len(self.levels) - 1
+
+    def record(self, level_id, kind, addr, set_idx = 0, aux = 0):
+        if kind in REQUEST_KINDS:
+            self.access += 1
+        if self.size == len(self.events):
+            grown = np.zeros(2 * len(self.events), dtype=EventLog.DTYPE)
+            grown[:self.size] = self.events
+            self.events = grown
+        self.events[self.size] = (self.access, level_id, kind, self.flags, set_idx, addr, aux)
+        self.size += 1
+
+    def clear(self):
+        self.size = 0
+        self.access = -1
+
+    def get_events(self):
+        return self.events[:self.size]
+
+    def save(self, filename):
+        np.savez_compressed(filename, events=self.get_events(), levels=np.array(self.level_names))
+
+    #binds a saved log to the levels of a memory system with the same structure
+    @staticmethod
+    def load(filename, sources):
+        data = np.load(filename)
+        names = [str(name) for name in data['levels']]
+        if names != [source.name for source in sources[:len(names)]]:
+            raise Exception(f"Log levels {names} do not match the current memory system")
+        log = EventLog(max(len(data['events']), 1))
+        log.levels = list(sources[:len(names)])
+        log.level_names = names
+        log.size = len(data['events'])
+        log.events[:log.size] = data['events']
+        log.access = int(log.events[log.size-1]['access']) if log.size > 0 else -1
+        return log
+
+    def select(self, levels = None, sets = None, addr_range = None, kinds = None, prefetch = False, access_range = None):
+        events = self.get_events()
+        mask = np.ones(len(events), dtype=bool)
+        if levels is not None:
+            mask &= np.isin(events['level'], levels)
+        if sets is not None:
+            mask &= np.isin(events['set'], sets)
+        if addr_range is not None:
+            mask &= (events['addr'] >= addr_range[0]) & (events['addr'] <= addr_range[1])
+        if kinds is not None or prefetch:
+            kind_mask = np.isin(events['kind'], kinds) if kinds is not None else np.zeros(len(events), dtype=bool)
+            if prefetch:
+                kind_mask |= (events['flags'] & EventLog.PREFETCH) != 0
+            mask &= kind_mask
+        if access_range is not None:
+            mask &= (events['access'] >= access_range[0]) & (events['access'] <= access_range[1])
+        return events[mask]
+
+    def render(self, events, numbered = False):
+        for event in events:
+            line = self.levels[event['level']].render_event(EventKind(event['kind']), int(event['addr']), int(event['set']), int(event['aux']))
+            if numbered:
+                line = f"{event['access']:>6} {line}"
+            output.write(line)
+
+
+#events that analysis code can subscribe to on every level
+HookEvent = IntEnum('HookEvent', ['HIT', 'MISS', 'FILL', 'EVICT', 'WRITEBACK', 'VICTIM_SWAP', 'PREFETCH', 'PAGE_FAULT'])
+
+
+class Hook:
+    #subscribers of one event type of one level
+    PREFETCH = 1
+    DIRTY = 2
+
+    def __init__(self, level, event):
+        self.level = level
+        self.event = event
+        self.callbacks = []
+        self.batches = []
+
+    def notify(self, addr, flags = 0):
+        for callback in self.callbacks:
+            callback(self.event, self.level, addr, flags)
+        for batch in self.batches:
+            batch.add(self.event, addr, flags)
+
+
+class HookBatch:
+    #accumulates events and delivers them as a NumPy structured array of `size` events
+    DTYPE = np.dtype([('event', 'u1'), ('addr', '<u8'), ('set', '<u4'), ('flags', 'u1')])
+
+    def __init__(self, level, callback, size):
+        self.level = level
+        self.callback = callback
+        self.size = size
+        self.events = []
+        self.addrs = []
+        self.flags = []
+
+    def add(self, event, addr, flags):
+        self.events.append(event)
+        self.addrs.append(addr)
+        self.flags.append(flags)
+        if len(self.events) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if not self.events:
+            return
+        chunk = np.empty(len(self.events), dtype=HookBatch.DTYPE)
+        chunk['event'] = self.events
+        chunk['addr'] = self.addrs
+        chunk['flags'] = self.flags
+        if hasattr(self.level, 'set_width'):
+            chunk['set'] = (chunk['addr'] >> self.level.line_size_width) & (2**self.level.set_width - 1)
+        else:
+            chunk['set'] = 0
+        self.events, self.addrs, self.flags = [], [], []
+        self.callback(self.level, chunk)
+
+
+class Observable:
+    #hooks[event] stays None while nobody listens, so idle events cost a single check
+
+    def init_hooks(self):
+        self.hooks = [None] * (len(HookEvent) + 1)
+
+    #callback(event, level, addr, flags) per event, or callback(level, chunk) with batch=<events per chunk>
+    def subscribe(self, events, callback, batch = None):
+        if isinstance(events, (str, HookEvent)):
+            events = [events]
+        events = [HookEvent[event.upper()] if isinstance(event, str) else event for event in events]
+        subscriber = HookBatch(self, callback, batch) if batch else callback
+        for event in events:
+            if self.hooks[event] is None:
+                self.hooks[event] = Hook(self, event)
+            if batch:
+                self.hooks[event].batches.append(subscriber)
+            else:
+                self.hooks[event].callbacks.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        if isinstance(subscriber, HookBatch):
+            subscriber.flush()
+        for (event, hook) in enumerate(self.hooks):
+            if hook is None:
+                continue
+            if subscriber in hook.callbacks:
+                hook.callbacks.remove(subscriber)
+            if subscriber in hook.batches:
+                hook.batches.remove(subscriber)
+            if not hook.callbacks and not hook.batches:
+                self.hooks[event] = None
+
+    #delivers the events still waiting in batch subscribers
+    def flush_hooks(self):
+        flushed = set()
+        for hook in self.hooks:
+            if hook is None:
+                continue
+            for batch in hook.batches:
+                if id(batch) not in flushed:
+                    flushed.add(id(batch))
+                    batch.flush()
+
+
+PagePolicy = Enum('PagePolicy', ['FIFO', 'LRU', 'CLOCK', 'SECOND_CHANCE', 'NRU', 'AGING'])
+
+#one entry per physical page (frame). virtual_page is -1 while the frame is free
+FRAME_DTYPE = np.dtype([('virtual_page', '<i8'), ('referenced', 'u1'), ('dirty', 'u1'), ('age', 'u1')])
+
+#Page replacement policies choose the frame to evict. The referenced and dirty bits live in
+#the frame table, which the virtual memory updates on every access
+class PageReplacement:
+
+    def __init__(self, frames, interval = 64):
+        self.frames = frames
+        #accesses between periodic updates of the referenced bits (NRU and aging)
+        self.interval = interval
+
+    def loaded(self, frame):
+        pass
+
+    def accessed(self, frame):
+        pass
+
+    def evicted(self, frame):
+        pass
+
+    def victim(self):
+        raise Exception("Page policy without a victim")
+
+    #frames in the order of the policy, for printing
+    def resident(self):
+        return [frame for frame in range(len(self.frames)) if self.frames['virtual_page'][frame] >= 0]
+
+
+class FifoPages(PageReplacement):
+    def __init__(self, frames, interval = 64):
+        super().__init__(frames, interval)
+        #frames in load order, oldest first
+        self.order = OrderedDict()
+
+    def loaded(self, frame):
+        self.order[frame] = None
+
+    def evicted(self, frame):
+        del self.order[frame]
+
+    def victim(self):
+        return next(iter(self.order))
+
+    def resident(self):
+        return list(self.order)
+
+
+class LruPages(FifoPages):
+    def accessed(self, frame):
+        self.order.move_to_end(frame)
+
 
+class ClockPages(PageReplacement):
+    def __init__(self, frames, interval = 64):
+        super().__init__(frames, interval)
+        self.hand = 0
 
-class VirtualMemory:
+    #the hand clears referenced bits until it finds a frame without it
+    def victim(self):
+        referenced = self.frames['referenced']
+        while referenced[self.hand]:
+            referenced[self.hand] = 0
+            self.hand = (self.hand + 1) % len(self.frames)
+        frame = self.hand
+        self.hand = (self.hand + 1) % len(self.frames)
+        return frame
+
+    def resident(self):
+        frames = super().resident()
+        return frames[self.hand:] + frames[:self.hand] if len(frames) == len(self.frames) else frames
+
+
+class SecondChancePages(FifoPages):
+    #FIFO, but referenced pages are sent to the back of the queue once
+    def victim(self):
+        referenced = self.frames['referenced']
+        while True:
+            frame = next(iter(self.order))
+            if not referenced[frame]:
+                return frame
+            referenced[frame] = 0
+            self.order.move_to_end(frame)
+
+
+class NruPages(PageReplacement):
+    def __init__(self, frames, interval = 64):
+        super().__init__(frames, interval)
+        self.ticks = 0
+
+    def accessed(self, frame):
+        self.ticks += 1
+        if self.ticks >= self.interval:
+            self.ticks = 0
+            self.tick()
+
+    def loaded(self, frame):
+        self.accessed(frame)
+
+    def tick(self):
+        self.frames['referenced'] = 0
+
+    #lowest class first: not referenced and clean, not referenced and dirty, referenced and clean...
+    def victim(self):
+        classes = self.frames['referenced'] * 2 + self.frames['dirty']
+        return int(np.argmin(classes))
+
+
+class AgingPages(NruPages):
+    #every interval the referenced bits are shifted into an 8 bit age, and cleared
+    def tick(self):
+        self.frames['age'] = (self.frames['age'] >> 1) | (self.frames['referenced'] << 7)
+        self.frames['referenced'] = 0
+
+    def loaded(self, frame):
+        self.frames['age'][frame] = 0
+        super().loaded(frame)
+
+    def victim(self):
+        return int(np.argmin(self.frames['age']))
+
+
+PAGE_POLICIES = {PagePolicy.FIFO: FifoPages, PagePolicy.LRU: LruPages, PagePolicy.CLOCK: ClockPages,
+                 PagePolicy.SECOND_CHANCE: SecondChancePages, PagePolicy.NRU: NruPages, PagePolicy.AGING: AgingPages}
+
+
+#Radix page table stored in physical frames reserved for it. A walk reads one entry per level
+#through the memory system. The TLB keeps whole translations and the page-walk cache keeps
+#pointers to lower level tables, so walks can skip the upper levels
+class PageWalker:
+    PTE_SIZE = 8
+
+    def __init__(self, level_bits, page_width, first_frame, reserved_frames, tlb_entries = 64, walk_cache_entries = 0):
+        self.level_bits = level_bits
+        self.page_width = page_width
+        self.first_frame = first_frame
+        self.reserved_frames = reserved_frames
+        #tables are allocated on first use, one after another
+        self.next_free = first_frame << page_width
+        self.limit = (first_frame + reserved_frames) << page_width
+        self.tables = {}
+        self.tlb = OrderedDict()
+        self.tlb_entries = tlb_entries
+        self.walk_cache = OrderedDict()
+        self.walk_cache_entries = walk_cache_entries
+        self.table_address(0, 0)
+        self.reset()
+
+    def reset(self):
+        self.walks = 0
+        self.entries_read = 0
+        self.entries_written = 0
+        self.walk_cache_hits = 0
+        self.tlb_hits = 0
+        #cost of the hierarchy spent on page table entries
+        self.cost = 0
+
+    #physical address of the table of a level, for a prefix of the virtual page number
+    def table_address(self, level, prefix):
+        key = (level, prefix)
+        if key not in self.tables:
+            size = 2**self.level_bits[level] * PageWalker.PTE_SIZE
+            if self.next_free + size > self.limit:
+                raise Exception(f"The page table does not fit in its {self.reserved_frames} reserved frames")
+            self.tables[key] = self.next_free
+            self.next_free += size
+        return self.tables[key]
+
+    #(level, prefix, entry address) of every entry translating a virtual page, top level first
+    def path(self, virtual_page):
+        shift = sum(self.level_bits)
+        prefix = 0
+        path = []
+        for (level, bits) in enumerate(self.level_bits):
+            shift -= bits
+            index = (virtual_page >> shift) & (2**bits - 1)
+            path.append((level, prefix, self.table_address(level, prefix) + index * PageWalker.PTE_SIZE))
+            prefix = (prefix << bits) | index
+        return path
+
+    def leaf(self, virtual_page):
+        return self.path(virtual_page)[-1][2]
+
+    def tlb_lookup(self, virtual_page, count = True):
+        if virtual_page in self.tlb:
+            self.tlb.move_to_end(virtual_page)
+            if count:
+                self.tlb_hits += 1
+            return True
+        return False
+
+    def tlb_insert(self, virtual_page):
+        if self.tlb_entries > 0:
+            self.tlb[virtual_page] = None
+            self.tlb.move_to_end(virtual_page)
+            if len(self.tlb) > self.tlb_entries:
+                self.tlb.popitem(last = False)
+
+    def invalidate(self, virtual_page):
+        self.tlb.pop(virtual_page, None)
+
+    #entries to read for a walk, starting at the deepest table found in the page-walk cache
+    def walk(self, virtual_page, count = True):
+        path = self.path(virtual_page)
+        start = 0
+        for depth in range(len(path) - 1, 0, -1):
+            key = path[depth][:2]
+            if key in self.walk_cache:
+                self.walk_cache.move_to_end(key)
+                start = depth
+                break
+        if self.walk_cache_entries > 0:
+            for (level, prefix, entry) in path[start + 1:]:
+                self.walk_cache[(level, prefix)] = None
+                if len(self.walk_cache) > self.walk_cache_entries:
+                    self.walk_cache.popitem(last = False)
+        if count:
+            self.walks += 1
+            self.entries_read += len(path) - start
+            if start > 0:
+                self.walk_cache_hits += 1
+        return [entry for (level, prefix, entry) in path[start:]]
+
+    def stats_dict(self):
+        return {"page_walks": self.walks, "walk_entries_read": self.entries_read, "walk_entries_written": self.entries_written,
+                "walk_cache_hits": self.walk_cache_hits, "tlb_hits": self.tlb_hits, "walk_cost": self.cost}
+
+
+class VirtualMemory(Observable):
     
     #page table
     #virtual page, physical page (marco), active, edad
     
-    def __init__(self, name, virtual_address_width, address_width, page_width):
+    def __init__(self, name, virtual_address_width, address_width, page_width, page_policy = PagePolicy.LRU, page_interval = 64,
+                 walk_levels = None, tlb_entries = 64, walk_cache_entries = 0, reserved_frames = None):
         #sanity checks
         if virtual_address_width < address_width or address_width < page_width:
             raise Exception("Wrong virtual memory parameters")
@@ -72,47 +584,205 @@ class VirtualMemory:
         self.address_width = address_width
         self.page_width = page_width
         self.number_of_pages = 2**(self.address_width-self.page_width)
+        #optional radix page table, in the last physical pages
+        self.walker = None
+        if walk_levels is not None:
+            if sum(walk_levels) < virtual_address_width - page_width:
+                raise Exception(f"The page table levels must cover the {virtual_address_width - page_width} bits of the virtual page number")
+            if reserved_frames is None:
+                reserved_frames = len(walk_levels)
+            if reserved_frames >= self.number_of_pages:
+                raise Exception("No physical pages left for data after reserving the page table")
+            self.number_of_pages -= reserved_frames
+            self.walker = PageWalker(walk_levels, page_width, self.number_of_pages, reserved_frames, tlb_entries, walk_cache_entries)
         self.statistics = CacheStatistics()
-        #Page table is an ordered dictionary of virtual_page, phys_page values
-        #being in the dictionary means the page is actively translated
-        #the position in the dictionary is the age of the page
-        #(older pages first due to OrderedDict implementation)
-        self.page_table = OrderedDict() 
+        #Page table is a dictionary of virtual_page, phys_page values
+        #being in the dictionary means the page is actively translated.
+        #The frame table holds the bits of every physical page for the replacement policy
+        self.page_table = {}
+        self.frames = np.zeros(self.number_of_pages, dtype=FRAME_DTYPE)
+        self.frames['virtual_page'] = -1
+        self.page_policy = page_policy
+        self.policy = PAGE_POLICIES[page_policy](self.frames, page_interval)
+        #evicted pages that had been written
+        self.dirty_writebacks = 0
+        #event log and inline narration, inherited from the memory system
+        self.event_log = None
+        self.event_id = 0
+        self.narrate = True
+        self.init_hooks()
+        #accesses left in fast forward mode (math.inf until it is disabled)
+        self.fast_forward = 0
         
     def add_memory_system(self, memory_system):
+        if memory_system.directory is not None:
+            raise Exception("Virtual memory is not supported on top of several cores")
         self.memory_system = memory_system
+        self.narrate = memory_system.narrate
+        #the latency of a request includes its translation
+        memory_system.record_requests = False
+        if self.walker is not None:
+            for frame in range(self.walker.first_frame, self.walker.first_frame + self.walker.reserved_frames):
+                memory_system.load(frame << self.page_width)
+        if memory_system.event_log is not None:
+            self.attach_event_log(memory_system.event_log)
+
+    def event_sources(self):
+        return [self] + self.memory_system.event_sources()
+
+    def attach_event_log(self, event_log):
+        if event_log is not None:
+            self.event_id = event_log.register(self)
+        self.event_log = event_log
+        self.memory_system.attach_event_log(event_log)
+
+    def set_narrate(self, narrate):
+        self.narrate = narrate
+        self.memory_system.set_narrate(narrate)
+
+    def _event(self, kind, addr, physical_page = 0, other_page = 0):
+        if self.event_log is not None:
+            self.event_log.record(self.event_id, kind, addr, physical_page, other_page)
+        if self.narrate:
+            output.write(self.render_event(kind, addr, physical_page, other_page))
+
+    def render_event(self, kind, addr, physical_page, other_page):
+        if kind == EventKind.VIRTUAL_READ_REQUEST:
+            return f"{prettydir(addr, self.virtual_address_width, 0, 0, tagcol = Fore.LIGHTCYAN_EX, virtualbits=self.virtual_address_width)}{Fore.YELLOW} R Virtual Read Request{Style.RESET_ALL}"
+        if kind == EventKind.VIRTUAL_WRITE_REQUEST:
+            return f"{prettydir(addr, self.virtual_address_width, 0, 0, tagcol = Fore.LIGHTCYAN_EX, virtualbits=self.virtual_address_width)}{Fore.YELLOW} W Virtual Write Request{Style.RESET_ALL}"
+        virtual_page = addr >> self.page_width
+        prefix = prettydir(addr, self.virtual_address_width, 0, self.page_width)
+        match kind:
+            case EventKind.PAGE_FAULT:
+                return f"{prefix} {prettyfail} Virtual page 0x{virtual_page:0x} not found"
+            case EventKind.PAGE_EVICT:
+                return f"{prefix} {prettyfail} Page table full. Invalidating virtual page 0x{other_page:0x} @ physical 0x{physical_page:0x}"
+            case EventKind.PAGE_SWAP:
+                return f"{prefix} {prettyswap} Virtual page 0x{virtual_page:0x} replaces 0x{other_page:0x} on physical page 0x{physical_page:0x}"
+            case EventKind.PAGE_LOAD:
+                return f"{prefix} {prettydown} Virtual page 0x{virtual_page:0x} loaded into 0x{physical_page:0x}"
+            case EventKind.PAGE_HIT:
+                return f"{prefix} {prettytick} Virtual page 0x{virtual_page:0x} found at physical 0x{physical_page:0x}"
+            case EventKind.PAGE_WALK:
+                return f"{prefix} {prettydown} Page walk for virtual page 0x{virtual_page:0x}: {physical_page} entries read, {other_page} levels from the page-walk cache"
+        raise Exception(f"Event {kind.name} not supported by virtual memory")
         
+    #frame for a new page: the next free one, or the one chosen by the policy (which is unmapped)
+    def _claim_frame(self):
+        if len(self.page_table) < self.number_of_pages:
+            return len(self.page_table), None, False
+        frame = self.policy.victim()
+        old_page = int(self.frames['virtual_page'][frame])
+        del self.page_table[old_page]
+        self.policy.evicted(frame)
+        return frame, old_page, bool(self.frames['dirty'][frame])
+
+    def _map(self, virtual_page, frame):
+        self.page_table[virtual_page] = frame
+        self.frames[frame] = (virtual_page, 1, 0, 0)
+        self.policy.loaded(frame)
+
+    #TLB lookup, and page table walk if it misses
+    def _walk(self, virtual_page):
+        if self.walker.tlb_lookup(virtual_page):
+            return
+        cost = self.memory_system.total_cost()
+        entries = self.walker.walk(virtual_page)
+        self._event(EventKind.PAGE_WALK, virtual_page * 2**self.page_width, len(entries), len(self.walker.level_bits) - len(entries))
+        for entry in entries:
+            self.memory_system.read(entry)
+        self.walker.cost += self.memory_system.total_cost() - cost
+
+    #the leaf entries of the loaded and evicted pages are updated in memory
+    def _update_entries(self, virtual_page, old_page):
+        cost = self.memory_system.total_cost()
+        if old_page is not None:
+            self.walker.invalidate(old_page)
+            self.memory_system.write(self.walker.leaf(old_page))
+            self.walker.entries_written += 1
+        self.memory_system.write(self.walker.leaf(virtual_page))
+        self.walker.entries_written += 1
+        self.walker.cost += self.memory_system.total_cost() - cost
+
     def evict_load_page(self, virtual_page):
+        page_address = virtual_page * 2**self.page_width
+        if self.walker is not None:
+            self._walk(virtual_page)
         if virtual_page not in self.page_table:
             self.statistics.line_miss += 1
-            print(f"{prettydir(virtual_page * 2**self.page_width, self.virtual_address_width, 0, self.page_width)} {prettyfail} Virtual page 0x{virtual_page:0x} not found")
-            physical_page = None
-            if len(self.page_table) == self.number_of_pages:
+            self._event(EventKind.PAGE_FAULT, page_address)
+            if self.hooks[HookEvent.PAGE_FAULT] is not None:
+                self.hooks[HookEvent.PAGE_FAULT].notify(page_address)
+            physical_page, old_page, dirty = self._claim_frame()
+            if old_page is not None:
                 #evict
                 self.statistics.line_evict += 1
-                entry = self.page_table.popitem(last = False)
-                print(f"{prettydir(virtual_page * 2**self.page_width, self.virtual_address_width, 0, self.page_width)} {prettyfail} Page table full. Invalidating virtual page 0x{entry[0]:0x} @ physical 0x{entry[1]:0x}")
-                physical_page = entry[1] #this page will be the new physical one
+                self.statistics.bytes_fill += 2**self.page_width
+                if dirty:
+                    self.dirty_writebacks += 1
+                    self.statistics.bytes_writeback += 2**self.page_width
+                self._event(EventKind.PAGE_EVICT, page_address, physical_page, old_page)
+                if self.hooks[HookEvent.EVICT] is not None:
+                    self.hooks[HookEvent.EVICT].notify(old_page * 2**self.page_width, Hook.DIRTY if dirty else 0)
                 initial_address = physical_page * 2**self.page_width
                 final_address = physical_page * 2**self.page_width + 2**self.page_width - 1
                 self.memory_system.clear(initial_address, final_address)
                 self.memory_system.load(initial_address)
-                print(f"{prettydir(virtual_page * 2**self.page_width, self.virtual_address_width, 0, self.page_width)} {prettyswap} Virtual page 0x{virtual_page:0x} replaces 0x{entry[0]:0x} on physical page 0x{physical_page:0x}")
+                self._event(EventKind.PAGE_SWAP, page_address, physical_page, old_page)
+                if self.hooks[HookEvent.FILL] is not None:
+                    self.hooks[HookEvent.FILL].notify(page_address)
             else:
                 self.statistics.line_pull += 1
-                physical_page = len(self.page_table)
+                self.statistics.bytes_fill += 2**self.page_width
                 initial_address = physical_page * 2**self.page_width
                 self.memory_system.load(initial_address)
-                print(f"{prettydir(virtual_page * 2**self.page_width, self.virtual_address_width, 0, self.page_width)} {prettydown} Virtual page 0x{virtual_page:0x} loaded into 0x{physical_page:0x}")
-            self.page_table[virtual_page] = physical_page
+                self._event(EventKind.PAGE_LOAD, page_address, physical_page)
+                if self.hooks[HookEvent.FILL] is not None:
+                    self.hooks[HookEvent.FILL].notify(page_address)
+            self._map(virtual_page, physical_page)
+            if self.walker is not None:
+                self._update_entries(virtual_page, old_page)
         else:
             self.statistics.line_hit += 1
             physical_page = self.page_table[virtual_page]
-            self.page_table.move_to_end(virtual_page)
-            print(f"{prettydir(virtual_page * 2**self.page_width, self.virtual_address_width, 0, self.page_width)} {prettytick} Virtual page 0x{virtual_page:0x} found at physical 0x{physical_page:0x}")
+            self.frames['referenced'][physical_page] = 1
+            self.policy.accessed(physical_page)
+            self._event(EventKind.PAGE_HIT, page_address, physical_page)
+            if self.hooks[HookEvent.HIT] is not None:
+                self.hooks[HookEvent.HIT].notify(page_address)
+        if self.walker is not None:
+            self.walker.tlb_insert(virtual_page)
+        return physical_page
         
-                
-            
+    #fast forward translation: same page table and memory contents, no statistics or events
+    def warm_translate(self, virtual_address, write = False):
+        virtual_page = self.get_virtual_page_number(virtual_address)
+        if self.walker is not None and not self.walker.tlb_lookup(virtual_page, count = False):
+            for entry in self.walker.walk(virtual_page, count = False):
+                self.memory_system.last_level.warm_read(entry)
+        if virtual_page in self.page_table:
+            physical_page = self.page_table[virtual_page]
+            self.frames['referenced'][physical_page] = 1
+            self.policy.accessed(physical_page)
+        else:
+            physical_page, old_page, dirty = self._claim_frame()
+            initial_address = physical_page * 2**self.page_width
+            if old_page is not None:
+                self.memory_system.warm_clear(initial_address, initial_address + 2**self.page_width - 1)
+            self.memory_system.load(initial_address)
+            self._map(virtual_page, physical_page)
+            if self.walker is not None:
+                if old_page is not None:
+                    self.walker.invalidate(old_page)
+                    self.memory_system.last_level.warm_write(self.walker.leaf(old_page))
+                self.memory_system.last_level.warm_write(self.walker.leaf(virtual_page))
+        if self.walker is not None:
+            self.walker.tlb_insert(virtual_page)
+        if write:
+            self.frames['dirty'][physical_page] = 1
+        return self.get_physical_address(virtual_address)
+
     def get_physical_address(self, virtual_address):
         virtual_page = virtual_address >> self.page_width
         physical_page = self.page_table[virtual_page]
@@ -122,59 +792,440 @@ class VirtualMemory:
     def get_virtual_page_number(self, virtual_address):
         return virtual_address >> self.page_width
             
-    def _read_virtual(self, virtual_address):
+    def _read_virtual(self, virtual_address, size = None):
         virtual_page = self.get_virtual_page_number(virtual_address)
         self.evict_load_page(virtual_page)
-        self.memory_system.read(self.get_physical_address(virtual_address))
+        self.memory_system.read(self.get_physical_address(virtual_address), size = size)
         
-    def _write_virtual(self, virtual_address):
+    def _write_virtual(self, virtual_address, size = None):
         virtual_page = self.get_virtual_page_number(virtual_address)
-        self.evict_load_page(virtual_page)
-        self.memory_system.write(self.get_physical_address(virtual_address))
+        physical_page = self.evict_load_page(virtual_page)
+        self.frames['dirty'][physical_page] = 1
+        self.memory_system.write(self.get_physical_address(virtual_address), size = size)
+
+    #accesses of a given size may straddle pages, and are split in one access per page
+    def split(self, addr, size):
+        if size is None:
+            return ((addr, None),)
+        return split_access(addr, size, self.page_width)
         
-    def read(self, init, end = None, step = None):
+    def read(self, init, end = None, step = None, size = None):
         if end is None:
             end = init
         if step is None:
             step = 1
         for i in range(init, end + 1, step):
-            print(f"{prettydir(i, self.virtual_address_width, 0, 0, tagcol = Fore.LIGHTCYAN_EX, virtualbits=self.virtual_address_width)}{Fore.YELLOW} R Virtual Read Request{Style.RESET_ALL}")
-            self._read_virtual(i)
+            if self.fast_forward > 0:
+                self.fast_forward -= 1
+                for (addr, piece) in self.split(i, size):
+                    for (part, part_size) in self.memory_system.split(self.warm_translate(addr), piece):
+                        self.memory_system.last_level.warm_read(part)
+                continue
+            self._event(EventKind.VIRTUAL_READ_REQUEST, i)
+            start = self.memory_system.latency_total() if self.memory_system.latency is not None else None
+            for (addr, piece) in self.split(i, size):
+                self._read_virtual(addr, piece)
+            if start is not None:
+                self.memory_system.latency.add(self.memory_system.latency_total() - start)
+            if self.memory_system.traffic is not None:
+                self.memory_system.traffic.tick(self.memory_system)
 
-    def write(self, init, end = None, step = None):
+    def write(self, init, end = None, step = None, size = None):
         if end is None:
             end = init
         if step is None:
             step = 1
         for i in range(init, end + 1, step):
-            print(f"{prettydir(i, self.virtual_address_width, 0, 0, tagcol = Fore.LIGHTCYAN_EX, virtualbits=self.virtual_address_width)}{Fore.YELLOW} W Virtual Write Request{Style.RESET_ALL}")
-            self._write_virtual(i)
+            if self.fast_forward > 0:
+                self.fast_forward -= 1
+                for (addr, piece) in self.split(i, size):
+                    for (part, part_size) in self.memory_system.split(self.warm_translate(addr, write = True), piece):
+                        self.memory_system.last_level.warm_write(part, part_size)
+                continue
+            self._event(EventKind.VIRTUAL_WRITE_REQUEST, i)
+            start = self.memory_system.latency_total() if self.memory_system.latency is not None else None
+            for (addr, piece) in self.split(i, size):
+                self._write_virtual(addr, piece)
+            if start is not None:
+                self.memory_system.latency.add(self.memory_system.latency_total() - start)
+            if self.memory_system.traffic is not None:
+                self.memory_system.traffic.tick(self.memory_system)
             
+    def run_trace(self, trace, chunk_size = 2**20):
+        for start in range(0, len(trace), chunk_size):
+            records = trace[start:start + chunk_size]
+            for addr, write, size in zip(records['addr'].tolist(), records['write'].tolist(), trace_sizes(records)):
+                if write:
+                    self.write(addr, size = size)
+                else:
+                    self.read(addr, size = size)
+
+    def set_fast_forward(self, accesses = math.inf):
+        self.fast_forward = accesses
+
+    def enable_sampling(self, ratio, seed = 0):
+        raise Exception("Set sampling needs physical addresses, it can't be used with virtual memory")
+
+    def show_costs(self):
+        self.memory_system.show_costs(requests = self.statistics.line_hit + self.statistics.line_miss)
+
+    def disable_sampling(self):
+        pass
+
     def reset_statistics(self):
         self.statistics.reset()
+        self.dirty_writebacks = 0
+        if self.walker is not None:
+            self.walker.reset()
         self.memory_system.reset_statistics()
 
+    def stats_dict(self):
+        hits = self.statistics.line_hit
+        total = self.statistics.line_hit + self.statistics.line_miss
+        translation = {
+            "name": self.name, "kind": "virtual",
+            "translations": total, "translation_hits": hits,
+            "page_faults": self.statistics.line_miss,
+            "pages_loaded": self.statistics.line_pull,
+            "pages_evicted": self.statistics.line_evict,
+            "page_policy": self.page_policy.name,
+            "dirty_writebacks": self.dirty_writebacks,
+            "translation_hit_rate": hits / total if total > 0 else 0.0,
+            "bytes_loaded": self.statistics.bytes_fill,
+            "bytes_written_back": self.statistics.bytes_writeback,
+        }
+        if self.walker is not None:
+            translation.update(self.walker.stats_dict())
+        stats = {"translation": translation, **self.memory_system.stats_dict()}
+        stats["latency"] = self.memory_system.latency_report(requests = total)
+        stats["traffic"] = self.memory_system.traffic_report(requests = total)
+        return stats
+
     def show_state(self, only_stats = False):
         hits = self.statistics.line_hit
         total = self.statistics.line_hit + self.statistics.line_miss
         
         hitrate = (hits / total) * 100  if total > 0 else 0
         
-        print(f"{Fore.BLUE}{Back.GREEN}{self.name}{Style.RESET_ALL}")
+        output.write(f"{Fore.BLUE}{Back.GREEN}{self.name}{Style.RESET_ALL}")
         printstr = f"Translations: {Fore.GREEN}{hits}{Style.RESET_ALL} hits out of {Fore.YELLOW}{total}{Style.RESET_ALL} requests ({hitrate:.2f} hit rate). {prettydown}{self.statistics.line_pull} pages pulled and {prettyup}{self.statistics.line_evict} pages swapped"
+        if self.page_policy != PagePolicy.LRU:
+            printstr += f"\n{self.page_policy.name}: {Fore.RED}{self.statistics.line_miss}{Style.RESET_ALL} page faults, {prettyup}{self.dirty_writebacks} dirty pages written back"
+        printstr += f"\nPages: {prettydown}{self.statistics.bytes_fill} B loaded and {prettyup}{self.statistics.bytes_writeback} B written back"
+        if self.walker is not None:
+            walker = self.walker
+            printstr += f"\nPage walks: {Fore.YELLOW}{walker.walks}{Style.RESET_ALL} walks ({Fore.GREEN}{walker.tlb_hits}{Style.RESET_ALL} TLB hits), {prettydown}{walker.entries_read} entries read " + \
+                f"({Fore.GREEN}{walker.walk_cache_hits}{Style.RESET_ALL} walks helped by the page-walk cache), {prettyup}{walker.entries_written} entries written. Cost: [{Fore.YELLOW}{walker.cost}{Style.RESET_ALL}]"
         numzeros_virt = (self.virtual_address_width - self.page_width + 3) // 4
         numzeros_phys = (self.address_width - self.page_width + 3) // 4
         if not only_stats:
             printstr += f"\n{'-'*(numzeros_phys+numzeros_virt + 7)}\n"
             
             translations = []
-            for entry in self.page_table.items():
-                translations.append(f"{Fore.RED}0x{entry[0]:0{numzeros_virt}x} {prettyright} {Fore.GREEN}0x{entry[1]:0{numzeros_phys}x}{Style.RESET_ALL}")
+            for frame in self.policy.resident():
+                translations.append(f"{Fore.RED}0x{int(self.frames['virtual_page'][frame]):0{numzeros_virt}x} {prettyright} {Fore.GREEN}0x{frame:0{numzeros_phys}x}{Style.RESET_ALL}")
                 
             printstr += "\n".join(translations)
         
-        print(printstr)        
-        self.memory_system.show_state(only_stats)
+        output.write(printstr)        
+        self.memory_system.show_state(only_stats, requests = total)
+
+
+#latency of every request in power of two buckets: bucket 0 holds the zero latencies and
+#bucket b the range [2**(b-1), 2**b). Latencies are buffered and binned in chunks
+class LatencyHistogram:
+    BUCKETS = 64
+    CHUNK = 4096
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = np.zeros(LatencyHistogram.BUCKETS, dtype=np.int64)
+        self.pending = []
+        self.count = 0
+        self.total = 0
+        self.maximum = 0
+
+    def add(self, latency):
+        self.pending.append(latency)
+        if len(self.pending) >= LatencyHistogram.CHUNK:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        latencies = np.array(self.pending, dtype=np.int64)
+        self.pending = []
+        #the exponent of frexp is the bit length of the latency
+        buckets = np.frexp(latencies.astype(np.float64))[1]
+        self.counts += np.bincount(buckets, minlength=LatencyHistogram.BUCKETS)
+        self.count += len(latencies)
+        self.total += int(latencies.sum())
+        self.maximum = max(self.maximum, int(latencies.max()))
+
+    def buckets(self):
+        self.flush()
+        used = np.nonzero(self.counts)[0]
+        return [(0 if bucket == 0 else 2**(int(bucket)-1), 0 if bucket == 0 else 2**int(bucket)-1, int(self.counts[bucket])) for bucket in used]
+
+    def show(self, width = 40):
+        peak = max([count for (low, high, count) in self.buckets()], default=0)
+        for (low, high, count) in self.buckets():
+            bar = '█' * max(1, round(width * count / peak))
+            output.write(f"{low:>8}-{high:<8} {Fore.YELLOW}{count:>8}{Style.RESET_ALL} {bar}")
+
+
+#bytes moved across every level boundary in consecutive windows of requests
+class TrafficWindows:
+
+    def __init__(self, memory_system, size):
+        self.size = size
+        self.reset(memory_system)
+
+    def reset(self, memory_system):
+        self.requests = 0
+        self.start = memory_system.traffic_totals()
+        self.samples = []
+
+    def tick(self, memory_system):
+        self.requests += 1
+        if self.requests % self.size == 0:
+            totals = memory_system.traffic_totals()
+            self.samples.append(totals - self.start)
+            self.start = totals
+
+    #array of (window, level, down/up) bytes
+    def windows(self):
+        if len(self.samples) == 0:
+            return np.zeros((0, len(self.start), 2), dtype=np.int64)
+        return np.stack(self.samples)
+
+
+#time of the timed mode, shared by every level. Requests issue one cycle after the previous one
+#(or at the time of their trace records) without waiting for it, unless a level stalled.
+#Each level sets ready to the cycle its data is available, and misses go on from now
+class Clock:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.now = 0
+        self.ready = 0
+        self.issue = 0
+        self.done = 0
+        self.next = 0
+        self.blocked = 0
+        self.first = None
+        self.last = 0
+        self.requests = 0
+        self.latency = 0
+
+    def start(self, time = None):
+        self.now = max(self.next if time is None else time, self.blocked)
+        self.issue = self.now
+        self.ready = self.now
+        self.done = self.now
+        self.next = self.now + 1
+        if self.first is None:
+            self.first = self.issue
+
+    #every line of a request is looked up at its issue time, and the request ends with the last one
+    def complete(self):
+        self.done = max(self.done, self.ready)
+        self.now = self.issue
+
+    def finish(self):
+        self.requests += 1
+        self.latency += self.done - self.issue
+        self.last = max(self.last, self.done)
+
+    #work that is not waited for (prefetches, writes to the next level) must not delay the request
+    def save(self):
+        return (self.now, self.ready)
+
+    def restore(self, saved):
+        (self.now, self.ready) = saved
+
+    def cycles(self):
+        return self.last - self.first if self.first is not None else 0
+
+    def report(self):
+        return {"requests": self.requests, "cycles": self.cycles(),
+                "average_latency": self.latency / self.requests if self.requests > 0 else 0.0}
+
+
+#miss status holding registers of a cache in the timed mode: the lines being fetched and when they
+#arrive. Accesses to a line in flight merge into its entry, and a miss with every entry busy stalls
+#until the first one is free. Memory level parallelism is the mean number of misses in flight
+#while there is at least one
+class MSHRFile:
+    #finished entries are only removed when the table grows to this size
+    PURGE = 64
+
+    def __init__(self, entries):
+        self.entries = entries if entries > 0 else math.inf
+        self.pending = {}
+        self.reset()
+
+    def reset(self):
+        self.misses = 0
+        self.merged = 0
+        self.stall_cycles = 0
+        self.miss_cycles = 0
+        self.busy_cycles = 0
+        self.covered = 0
+
+    def _purge(self, now):
+        for block in [block for (block, ready) in self.pending.items() if ready <= now]:
+            del self.pending[block]
+
+    #a hit on a line still in flight waits for it
+    def hit(self, block, clock, latency):
+        ready = self.pending.get(block)
+        if ready is not None and ready > clock.now:
+            self.merged += 1
+            clock.ready = max(ready, clock.now + latency)
+        else:
+            clock.ready = clock.now + latency
+
+    def allocate(self, clock):
+        if len(self.pending) >= min(self.entries, MSHRFile.PURGE):
+            self._purge(clock.now)
+        if len(self.pending) >= self.entries:
+            ready = min(self.pending.values())
+            self.stall_cycles += ready - clock.now
+            clock.now = ready
+            clock.blocked = max(clock.blocked, ready)
+            self._purge(clock.now)
+        return clock.now
+
+    def fill(self, block, start, ready):
+        self.pending[block] = ready
+        self.misses += 1
+        self.miss_cycles += ready - start
+        self.busy_cycles += max(0, ready - max(start, self.covered))
+        self.covered = max(self.covered, ready)
+
+    def mlp(self):
+        return self.miss_cycles / self.busy_cycles if self.busy_cycles > 0 else 0.0
+
+    def report(self):
+        return {"mshrs": self.entries if self.entries != math.inf else None, "misses": self.misses, "merged": self.merged,
+                "stall_cycles": self.stall_cycles, "mlp": self.mlp()}
+
+
+#MESI coherence of the private levels of every core, kept by a directory at the shared level.
+#For each block it holds the cores that may have a copy and the one that owns it (E, or M if
+#modified). Clean copies are dropped silently, so the sharers are a superset of the real copies.
+#Blocks are the largest line of the private levels
+class Directory:
+    COUNTERS = ('upgrades', 'invalidations', 'interventions', 'coherence_misses')
+
+    def __init__(self, memory_system, cores):
+        if cores < 1:
+            raise Exception("There must be at least one core")
+        self.memory_system = memory_system
+        self.shared = memory_system.last_level
+        #private level closest to the requests of each core, and the private levels of each core
+        self.tops = [self.shared] * cores
+        self.private = [[] for core in range(cores)]
+        self.width = 0
+        #block -> [sharers mask, owner (or -1), modified]
+        self.blocks = {}
+        #blocks each core lost to a write of another core, to count its coherence misses
+        self.invalidated = [set() for core in range(cores)]
+        self.reset()
+
+    def reset(self):
+        self.counters = {name: np.zeros(len(self.tops), dtype=np.int64) for name in Directory.COUNTERS}
+
+    def add_level(self, core, level):
+        self.private[core].append(level)
+        self.tops[core] = level
+        self.width = max(self.width, level.line_size_width)
+
+    #state of a block in a core: M, E, S or I
+    def state(self, core, addr):
+        entry = self.blocks.get(addr >> self.width)
+        if entry is None or not entry[0] & (1 << core):
+            return 'I'
+        if entry[1] == core:
+            return 'M' if entry[2] else 'E'
+        return 'S'
+
+    #coherence actions needed before a core reads or writes addr. The warm version only updates contents
+    def access(self, core, addr, write, warm = False):
+        block = addr >> self.width
+        bit = 1 << core
+        entry = self.blocks.get(block)
+        if entry is None:
+            self.blocks[block] = [bit, core, write]
+            return
+        (sharers, owner, modified) = entry
+        if sharers & bit:
+            if owner == core:
+                #E to M is silent
+                entry[2] = modified or write
+                return
+            if not write:
+                return
+            #S to M
+            if not warm:
+                self.counters['upgrades'][core] += 1
+                self.memory_system._event(EventKind.UPGRADE, block << self.width, core)
+        else:
+            if block in self.invalidated[core]:
+                self.invalidated[core].discard(block)
+                if not warm:
+                    self.counters['coherence_misses'][core] += 1
+            if not write:
+                #an owner keeps a shared copy, after writing it back if it was modified
+                if owner >= 0 and modified:
+                    if not warm:
+                        self.counters['interventions'][owner] += 1
+                        self.memory_system._event(EventKind.DOWNGRADE, block << self.width, owner)
+                    self._clean(owner, block, warm)
+                entry[0] = sharers | bit
+                entry[1] = -1
+                entry[2] = False
+                return
+        #a write leaves a single modified copy
+        for other in range(len(self.tops)):
+            if other != core and sharers & (1 << other):
+                if not warm:
+                    self.counters['invalidations'][other] += 1
+                    self.memory_system._event(EventKind.INVALIDATE, block << self.width, other)
+                self._invalidate(other, block, warm)
+        entry[0] = bit
+        entry[1] = core
+        entry[2] = True
+
+    def _clean(self, core, block, warm):
+        low = block << self.width
+        if warm:
+            self.tops[core].warm_clean(low, low + 2**self.width - 1, until = self.shared)
+        else:
+            self.tops[core].clean(low, low + 2**self.width - 1, until = self.shared)
+
+    def _invalidate(self, core, block, warm):
+        low = block << self.width
+        if warm:
+            self.tops[core].warm_clear(low, low + 2**self.width - 1, until = self.shared)
+        else:
+            self.tops[core].clear(low, low + 2**self.width - 1, until = self.shared)
+        self.invalidated[core].add(block)
+
+    def report(self):
+        report = {"cores": len(self.tops), "block_size": 2**self.width}
+        report.update({name: values.tolist() for (name, values) in self.counters.items()})
+        return report
+
+    def show(self):
+        cores = ", ".join(f"core {core} {prettyup}{self.counters['upgrades'][core]} upgrades {prettytrash}{self.counters['invalidations'][core]} invalidations "
+                          f"{prettydown}{self.counters['interventions'][core]} written back for others {Fore.RED}{self.counters['coherence_misses'][core]}{Style.RESET_ALL} coherence misses"
+                          for core in range(len(self.tops)))
+        output.write(f"Coherence: {cores}")
 
 
 class MemorySystem:
@@ -185,59 +1236,547 @@ class MemorySystem:
         self.last_level = None
         #for pretty printing
         self.virtual_address_width = virtual_address_width
+        self.name = "Requests"
+        #event log shared by every level, and inline narration of the events
+        self.event_log = None
+        self.event_id = 0
+        self.narrate = True
+        #when set, traces only simulate the accesses to a sample of the sets
+        self.sampler = None
+        #accesses left in fast forward mode (math.inf until it is disabled)
+        self.fast_forward = 0
+        #optional histogram of the latency of each request and traffic per window of requests.
+        #A virtual memory on top records its own requests instead
+        self.latency = None
+        self.traffic = None
+        self.record_requests = True
+        #with several cores, the directory of their private levels, and the core of the requests
+        self.directory = None
+        self.core = 0
+        #clock of the timed mode
+        self.clock = None
+        #inclusion policy of the caches that have a next level (None: non-inclusive, not reported)
+        self.inclusion = None
+        #records the requests of one level to the next one
+        self.recorder = None
 
-    def add_main(self, line_size_width, name = "Main Memory"):
+    def add_main(self, line_size_width, name = "Main Memory", dram = None):
         if self.last_level is not None:
             raise Exception("Can't add main memory below a cache level")
-        self.last_level = MainMemory(address_width = self.address_width, line_size_width = line_size_width, name = name, virtual_address_width=self.virtual_address_width)
+        self.last_level = MainMemory(address_width = self.address_width, line_size_width = line_size_width, name = name, virtual_address_width=self.virtual_address_width, dram = dram)
         self.levels.append(self.last_level)
+        self._setup_level(self.last_level)
 
-    def add_cache(self, name, set_width, way_width, line_size_width, replacement_policy, write_back, write_allocate, prefetch):
+    def add_cache(self, name, set_width, way_width, line_size_width, replacement_policy, write_back, write_allocate, prefetch, classify = False, reuse = False, prefetcher = None, write_buffer = 0, mshrs = 0):
         #if self.last_level is None:
         #    raise Exception("Add main memory before caches")
-        new_cache = Cache(name = name, set_width = set_width, way_width = way_width, line_size_width = line_size_width, replacement_policy = replacement_policy, write_back = write_back, write_allocate = write_allocate, parent = self.last_level, victim = None, address_width = self.address_width, prefetch = prefetch, virtual_address_width=self.virtual_address_width)
+        if self.directory is not None:
+            #one private cache per core
+            for core in range(len(self.directory.tops)):
+                new_cache = Cache(name = f"{name}.{core}", set_width = set_width, way_width = way_width, line_size_width = line_size_width, replacement_policy = replacement_policy, write_back = write_back, write_allocate = write_allocate, parent = self.directory.tops[core], victim = None, address_width = self.address_width, prefetch = prefetch, virtual_address_width=self.virtual_address_width, classify = classify, reuse = reuse, prefetcher = prefetcher, write_buffer = write_buffer, mshrs = mshrs)
+                self.directory.add_level(core, new_cache)
+                self.levels.append(new_cache)
+                self._setup_level(new_cache)
+                self._link(new_cache)
+            self.last_level = self.directory.tops[0]
+            return
+        new_cache = Cache(name = name, set_width = set_width, way_width = way_width, line_size_width = line_size_width, replacement_policy = replacement_policy, write_back = write_back, write_allocate = write_allocate, parent = self.last_level, victim = None, address_width = self.address_width, prefetch = prefetch, virtual_address_width=self.virtual_address_width, classify = classify, reuse = reuse, prefetcher = prefetcher, write_buffer = write_buffer, mshrs = mshrs)
         self.last_level = new_cache
         self.levels.append(self.last_level)
+        self._setup_level(self.last_level)
+        self._link(self.last_level)
+
+    #a new cache loads from the one below it, which back-invalidates it or takes its evicted lines
+    def _link(self, cache):
+        if isinstance(cache.parent, Cache):
+            cache.parent.children.append(cache)
+        if self.inclusion is not None and cache.parent is not None:
+            cache.inclusion = self.inclusion
+
+    #every cache with a next level follows the policy. The lines already in the hierarchy are kept
+    def set_inclusion(self, policy):
+        self.inclusion = policy
+        for level in self.levels:
+            if isinstance(level, Cache) and level.parent is not None:
+                level.inclusion = policy
+
+    #back-invalidations and lines also held above, for the levels that have caches above them
+    def inclusion_report(self):
+        report = {"policy": self.inclusion.name, "levels": {}, "duplicated_bytes": 0,
+                  "capacity_bytes": sum(2**(level.set_width + level.way_width + level.line_size_width) for level in self.levels if isinstance(level, Cache))}
+        for level in self.levels:
+            if isinstance(level, Cache) and level.children:
+                lines = sum(1 for lines in level.set_data for line in lines if line.valid)
+                duplicated = level.duplicated_lines()
+                report["levels"][level.name] = {"back_invalidations": level.statistics.back_invalidate, "lines": lines, "duplicated": duplicated}
+                report["duplicated_bytes"] += duplicated * 2**level.line_size_width
+        return report
+
+    def show_inclusion(self):
+        report = self.inclusion_report()
+        levels = ", ".join(f"{name} {prettytrash}{level['back_invalidations']} back-invalidations, {Fore.YELLOW}{level['duplicated']}{Style.RESET_ALL} of {level['lines']} lines held above"
+                           for (name, level) in report["levels"].items())
+        share = 100 * report["duplicated_bytes"] / report["capacity_bytes"] if report["capacity_bytes"] > 0 else 0
+        output.write(f"Inclusion: {Fore.YELLOW}{report['policy']}{Style.RESET_ALL}. {levels}. {report['duplicated_bytes']} B duplicated ({share:.2f}% of the cache capacity)")
+
+    #the levels created so far are shared, and the next caches are private to each of the cores
+    def add_cores(self, cores):
+        if self.last_level is None:
+            raise Exception("Add the shared levels before the cores")
+        if self.directory is not None:
+            raise Exception("The cores were already added")
+        self.directory = Directory(self, cores)
+
+    def select_core(self, core):
+        if self.directory is None or not 0 <= core < len(self.directory.tops):
+            raise Exception(f"There is no core {core}")
+        self.core = core
+
+    #level that receives the requests of a core
+    def top(self, core = None):
+        if self.directory is None:
+            return self.last_level
+        return self.directory.tops[self.core if core is None else core]
 
     def add_victim(self, name, set_width, way_width, line_size_width, replacement_policy):
         if self.last_level is None or not hasattr(self.last_level, 'victim'):
             raise Exception("Can't add victim to an empty memory system or to main memory directly. Add a cache first")
-        victim = Cache(name, set_width, way_width, line_size_width = line_size_width, replacement_policy = replacement_policy, address_width = self.address_width, virtual_address_width=self.virtual_address_width)
+        if self.directory is not None:
+            raise Exception("Victim caches are not supported in the private levels of the cores")
+        if set_width == 0:
+            victim = VictimBuffer(name, way_width, line_size_width = line_size_width, replacement_policy = replacement_policy, address_width = self.address_width, virtual_address_width=self.virtual_address_width)
+        else:
+            victim = Cache(name, set_width, way_width, line_size_width = line_size_width, replacement_policy = replacement_policy, address_width = self.address_width, virtual_address_width=self.virtual_address_width)
         self.last_level.victim = victim
+        self._setup_level(victim)
+
+    def _setup_level(self, level):
+        level.enable_timing(self.clock)
+        level.narrate = self.narrate
+        if self.event_log is not None:
+            level.event_id = self.event_log.register(level)
+        level.event_log = self.event_log
+
+    #levels and their victim caches, from the top of the hierarchy
+    def all_levels(self):
+        for level in self.levels:
+            yield level
+            if getattr(level, 'victim', None) is not None:
+                yield level.victim
+
+    def event_sources(self):
+        return [self] + list(self.all_levels())
+
+    def attach_event_log(self, event_log):
+        for source in self.event_sources():
+            if event_log is not None:
+                source.event_id = event_log.register(source)
+            source.event_log = event_log
+
+    def set_narrate(self, narrate):
+        for source in self.event_sources():
+            source.narrate = narrate
+
+    def _event(self, kind, addr, aux = 0):
+        if self.event_log is not None:
+            self.event_log.record(self.event_id, kind, addr, 0, aux)
+        if self.narrate:
+            output.write(self.render_event(kind, addr, 0, aux))
+
+    def render_event(self, kind, addr, set_idx, aux):
+        core = f" (core {aux})" if self.directory is not None else ""
+        if kind == EventKind.READ_REQUEST:
+            return f"{prettydir(addr, self.address_width, 0, 0, tagcol = Fore.YELLOW, virtualbits=self.virtual_address_width)}{Fore.YELLOW} R Read Request{core}{Style.RESET_ALL}"
+        if kind == EventKind.WRITE_REQUEST:
+            return f"{prettydir(addr, self.address_width, 0, 0, tagcol = Fore.YELLOW, virtualbits=self.virtual_address_width)}{Fore.YELLOW} W Write Request{core}{Style.RESET_ALL}"
+        if self.directory is not None:
+            prefix = prettydir(addr, self.address_width, 0, 0, virtualbits=self.virtual_address_width)
+            block = addr >> self.directory.width
+            match kind:
+                case EventKind.UPGRADE:
+                    return f"{prefix} {prettyup} Block 0x{block:0x} upgraded from shared to modified by core {aux}"
+                case EventKind.INVALIDATE:
+                    return f"{prefix} {prettytrash} Block 0x{block:0x} invalidated in core {aux}"
+                case EventKind.DOWNGRADE:
+                    return f"{prefix} {prettydown} Block 0x{block:0x} written back and shared by core {aux}"
+        raise Exception(f"Event {kind.name} not supported by the memory system")
+
+    #accesses of a given size may straddle lines of the top level, and are split in one access per line
+    def split(self, addr, size):
+        if size is None:
+            return ((addr, None),)
+        return split_access(addr, size, self.last_level.line_size_width)
 
-    def read(self, init, end = None, step = None):
+    def read(self, init, end = None, step = None, size = None, core = None, time = None):
         if end is None:
             end = init
         if step is None:
             step = 1
+        if core is None:
+            core = self.core
+        level = self.top(core)
         for i in range(init, end + 1, step):
-            print(f"{prettydir(i, self.address_width, 0, 0, tagcol = Fore.YELLOW, virtualbits=self.virtual_address_width)}{Fore.YELLOW} R Read Request{Style.RESET_ALL}")
-            self.last_level.read(i)
+            if self.fast_forward > 0:
+                self.fast_forward -= 1
+                for (addr, piece) in self.split(i, size):
+                    if self.directory is not None:
+                        self.directory.access(core, addr, False, warm = True)
+                    level.warm_read(addr)
+                continue
+            self._event(EventKind.READ_REQUEST, i, core)
+            start = self.latency_total() if self.latency is not None and self.record_requests else None
+            if self.clock is not None:
+                self.clock.start(time)
+            for (addr, piece) in self.split(i, size):
+                if self.directory is not None:
+                    self.directory.access(core, addr, False)
+                level.read(addr)
+                if self.clock is not None:
+                    self.clock.complete()
+            if self.clock is not None:
+                self.clock.finish()
+            if start is not None:
+                self.latency.add(self.clock.done - self.clock.issue if self.clock is not None else self.latency_total() - start)
+            if self.traffic is not None and self.record_requests:
+                self.traffic.tick(self)
 
-    def write(self, init, end = None, step = None):
+    def write(self, init, end = None, step = None, size = None, core = None, time = None):
         if end is None:
             end = init
         if step is None:
             step = 1
+        if core is None:
+            core = self.core
+        level = self.top(core)
         for i in range(init, end + 1, step):
-            print(f"{prettydir(i, self.address_width, 0, 0, tagcol = Fore.YELLOW, virtualbits=self.virtual_address_width)}{Fore.YELLOW} W Write Request{Style.RESET_ALL}")
-            self.last_level.write(i)
+            if self.fast_forward > 0:
+                self.fast_forward -= 1
+                for (addr, piece) in self.split(i, size):
+                    if self.directory is not None:
+                        self.directory.access(core, addr, True, warm = True)
+                    level.warm_write(addr, piece)
+                continue
+            self._event(EventKind.WRITE_REQUEST, i, core)
+            start = self.latency_total() if self.latency is not None and self.record_requests else None
+            if self.clock is not None:
+                self.clock.start(time)
+            for (addr, piece) in self.split(i, size):
+                if self.directory is not None:
+                    self.directory.access(core, addr, True)
+                level.write(addr, piece)
+                if self.clock is not None:
+                    self.clock.complete()
+            if self.clock is not None:
+                self.clock.finish()
+            if start is not None:
+                self.latency.add(self.clock.done - self.clock.issue if self.clock is not None else self.latency_total() - start)
+            if self.traffic is not None and self.record_requests:
+                self.traffic.tick(self)
+
+    #runs a TRACE_DTYPE array in chunks, so memory mapped traces larger than memory can be used
+    def run_trace(self, trace, chunk_size = 2**20):
+        level = self.top()
+        for start in range(0, len(trace), chunk_size):
+            records = trace[start:start + chunk_size]
+            warm = int(min(self.fast_forward, len(records)))
+            if warm > 0:
+                self.fast_forward -= warm
+                warm_records = records[:warm]
+                records = records[warm:]
+                if self.sampler is not None:
+                    warm_records = warm_records[self.sampler.filter(warm_records['addr'], count=False)]
+                for addr, write, size in zip(warm_records['addr'].tolist(), warm_records['write'].tolist(), trace_sizes(warm_records)):
+                    for (part, piece) in self.split(addr, size):
+                        if self.directory is not None:
+                            self.directory.access(self.core, part, write, warm = True)
+                        if write:
+                            level.warm_write(part, piece)
+                        else:
+                            level.warm_read(part)
+            if self.sampler is not None:
+                records = records[self.sampler.filter(records['addr'])]
+            times = records['time'].tolist() if 'time' in records.dtype.names else repeat(None)
+            for addr, write, size, issue in zip(records['addr'].tolist(), records['write'].tolist(), trace_sizes(records), times):
+                if write:
+                    self.write(addr, size = size, time = issue)
+                else:
+                    self.read(addr, size = size, time = issue)
+
+    #the requests the named cache sends to the next level are recorded until stop_recording
+    def record_stream(self, name):
+        if self.recorder is not None:
+            raise Exception(f"Already recording {self.recorder.level.name}")
+        if self.directory is not None:
+            raise Exception("Streams can't be recorded with several cores")
+        levels = [level for level in self.levels if isinstance(level, Cache) and level.name == name]
+        if len(levels) == 0 or levels[0].parent is None:
+            raise Exception(f"No cache named {name} with a next level")
+        self.recorder = StreamRecorder(levels[0])
+        levels[0].parent = self.recorder
+
+    def stop_recording(self):
+        if self.recorder is None:
+            raise Exception("Not recording")
+        self.recorder.level.parent = self.recorder.parent
+        stream = self.recorder.stream()
+        self.recorder = None
+        return stream
+
+    #sends a recorded stream to the top level, as the recorded cache sent it to its next level.
+    #Every record is a request, the ones recorded in fast forward mode only warm the caches
+    def replay_stream(self, stream, chunk_size = 2**20):
+        if self.directory is not None:
+            raise Exception("Streams can't be replayed with several cores")
+        if self.clock is not None:
+            raise Exception("Streams are replayed without timing")
+        level = self.last_level
+        for start in range(0, len(stream), chunk_size):
+            records = stream[start:start + chunk_size]
+            for addr, size, kind in zip(records['addr'].tolist(), records['size'].tolist(), records['kind'].tolist()):
+                if kind & StreamRecorder.WARM:
+                    match kind & ~StreamRecorder.WARM:
+                        case StreamRecorder.READ:
+                            level.warm_read(addr)
+                        case StreamRecorder.SUPPLY:
+                            level.warm_supply(addr, size)
+                        case StreamRecorder.WRITE:
+                            level.warm_write(addr, size or None)
+                        case StreamRecorder.WRITEBACK:
+                            level.warm_writeback(addr, size)
+                        case StreamRecorder.CLEAN_WRITEBACK:
+                            level.warm_writeback(addr, size, False)
+                    continue
+                begin = self.latency_total() if self.latency is not None else None
+                match kind:
+                    case StreamRecorder.READ:
+                        level.read(addr)
+                    case StreamRecorder.SUPPLY:
+                        level.supply(addr, size)
+                    case StreamRecorder.WRITE:
+                        level.write(addr, size or None)
+                    case StreamRecorder.WRITEBACK:
+                        level.writeback(addr, size)
+                    case StreamRecorder.CLEAN_WRITEBACK:
+                        level.writeback(addr, size, False)
+                    case _:
+                        raise Exception(f"Unknown stream record kind {kind}")
+                if begin is not None:
+                    self.latency.add(self.latency_total() - begin)
+                if self.traffic is not None:
+                    self.traffic.tick(self)
+
+    #runs one trace per core, interleaved one access of each core at a time, or in order of
+    #the time field of their records (ties go to the lower core)
+    def run_core_traces(self, traces, order = "round_robin"):
+        if self.directory is None or len(traces) != len(self.directory.tops):
+            raise Exception("One trace per core is needed")
+        if order == "time":
+            if any(trace.dtype.names is None or 'time' not in trace.dtype.names for trace in traces):
+                raise Exception("Every trace needs a time field to be interleaved by time")
+            keys = np.concatenate([trace['time'] for trace in traces])
+        elif order == "round_robin":
+            keys = np.concatenate([np.arange(len(trace)) for trace in traces])
+        else:
+            raise Exception(f"Unknown order {order}")
+        cores = np.concatenate([np.full(len(trace), core, dtype=np.int64) for (core, trace) in enumerate(traces)])
+        addrs = np.concatenate([trace['addr'] for trace in traces])
+        writes = np.concatenate([trace['write'] for trace in traces])
+        sizes = np.concatenate([trace['size'] if 'size' in trace.dtype.names else np.zeros(len(trace), dtype=np.uint32) for trace in traces])
+        sequence = np.lexsort((cores, keys))
+        if self.sampler is not None:
+            sequence = sequence[self.sampler.filter(addrs[sequence])]
+        times = keys[sequence].tolist() if order == "time" else repeat(None)
+        for addr, write, size, core, issue in zip(addrs[sequence].tolist(), writes[sequence].tolist(), sizes[sequence].tolist(), cores[sequence].tolist(), times):
+            if write:
+                self.write(addr, size = size or None, core = core, time = issue)
+            else:
+                self.read(addr, size = size or None, core = core, time = issue)
+
+    #only update contents, recency and dirty state for the next accesses (all of them by default)
+    def set_fast_forward(self, accesses = math.inf):
+        self.fast_forward = accesses
+
+    def warm_clear(self, initial_address, final_address):
+        self.last_level.warm_clear(initial_address, final_address)
+
+    def enable_sampling(self, ratio, seed = 0):
+        self.sampler = SetSampler([level for level in self.levels if isinstance(level, Cache)], ratio, seed)
+
+    def disable_sampling(self):
+        self.sampler = None
 
     def reset_statistics(self):
         for level in self.levels:
             level.reset_statistics()
+        if self.latency is not None:
+            self.latency.reset()
+        if self.traffic is not None:
+            self.traffic.reset(self)
+        if self.sampler is not None:
+            self.sampler.reset()
+        if self.directory is not None:
+            self.directory.reset()
+        if self.clock is not None:
+            self.clock.reset()
 
-    def show_state(self, only_stats = False):
+    def stats_dict(self):
+        levels = []
+        for level in self.levels:
+            levels.append(level.stats_dict())
+            if getattr(level, 'victim', None) is not None:
+                levels.append(level.victim.stats_dict(kind="victim", owner=level.name))
+        stats = {"levels": levels, "latency": self.latency_report(), "traffic": self.traffic_report()}
+        if self.sampler is not None:
+            stats["sampling"] = self.sampler.report()
+        if self.directory is not None:
+            stats["coherence"] = self.directory.report()
+        if self.clock is not None:
+            stats["timing"] = self.timing_report()
+        if self.inclusion is not None:
+            stats["inclusion"] = self.inclusion_report()
+        return stats
+
+    def show_state(self, only_stats = False, requests = None):
         for level in self.levels:
-            print(f"{Fore.BLUE}{Back.GREEN}{level.name}{Style.RESET_ALL}")
+            output.write(f"{Fore.BLUE}{Back.GREEN}{level.name}{Style.RESET_ALL}")
             if not only_stats:
-                print(level)
+                output.write(str(level))
             level.show_statistics()
+        self.show_traffic(requests)
+        if self.inclusion is not None:
+            self.show_inclusion()
+        if self.clock is not None:
+            self.show_timing()
+        if self.directory is not None:
+            self.directory.show()
+        if self.sampler is not None:
+            self.sampler.show()
             
-    def show_costs(self):
+    def show_costs(self, requests = None):
         for level in self.levels:
-            print(f"{Fore.BLUE}{Back.GREEN}{level.name}{Style.RESET_ALL}")
+            output.write(f"{Fore.BLUE}{Back.GREEN}{level.name}{Style.RESET_ALL}")
             level.show_costs()
+        report = self.latency_report(requests)
+        shares = ", ".join(f"{name} [{Fore.YELLOW}{latency}{Style.RESET_ALL}] {100 * latency / report['total_latency'] if report['total_latency'] > 0 else 0:.2f}%" for (name, latency) in report["levels"].items())
+        output.write(f"{Fore.BLUE}{Back.GREEN}Latency{Style.RESET_ALL}")
+        output.write(f"AMAT: [{Fore.YELLOW}{report['amat']:.2f}{Style.RESET_ALL}] cycles over {Fore.YELLOW}{report['requests']}{Style.RESET_ALL} requests, of which: {shares}")
+        if self.latency is not None:
+            self.latency.flush()
+            output.write(f"Latency histogram (max {self.latency.maximum}):")
+            self.latency.show()
+
+    def total_cost(self):
+        return sum(level.statistics.get_cost_values()["total_cost"] for level in self.levels)
+
+    #cycles spent by every level so far: a miss costs the lookup plus whatever the next level takes to resolve it
+    def latency_total(self):
+        return sum(level.latency_total() for level in self.levels)
+
+    #accesses to the top level (of every core). Write misses that are not allocated only count as written through
+    def requests(self):
+        tops = self.directory.tops if self.directory is not None else [self.last_level]
+        total = 0
+        for level in tops:
+            stats = level.statistics if level is not None else CacheStatistics()
+            total += stats.read_hit + stats.read_miss + stats.write_hit + stats.write_miss + stats.write_through
+        return total
+
+    def latency_report(self, requests = None):
+        if requests is None:
+            requests = self.requests()
+        total = self.latency_total()
+        report = {"amat": total / requests if requests > 0 else 0.0, "requests": requests, "total_latency": total,
+                  "levels": {level.name: level.latency_total() for level in self.levels}}
+        if self.latency is not None:
+            self.latency.flush()
+            report["max_latency"] = self.latency.maximum
+            report["histogram"] = [{"low": low, "high": high, "count": count} for (low, high, count) in self.latency.buckets()]
+        return report
+
+    #levels that move data to and from a next level, with the bytes read from it and written to it
+    def traffic_levels(self):
+        return [level for level in self.levels if getattr(level, 'parent', None) is not None]
+
+    def traffic_totals(self):
+        return np.array([level.statistics.traffic() for level in self.traffic_levels()], dtype=np.int64).reshape(-1, 2)
+
+    def traffic_report(self, requests = None):
+        if requests is None:
+            requests = self.requests()
+        report = {"requests": requests, "levels": {}}
+        for level in self.traffic_levels():
+            down, up = level.statistics.traffic()
+            report["levels"][level.name] = {"next": level.parent.name, "bytes_down": down, "bytes_up": up,
+                                            "bytes_per_request": (down + up) / requests if requests > 0 else 0.0}
+        if len(report["levels"]) > 0:
+            lowest = self.traffic_levels()[0]
+            report["memory_bytes"] = sum(lowest.statistics.traffic())
+            report["memory_bytes_per_request"] = report["levels"][lowest.name]["bytes_per_request"]
+        if self.traffic is not None:
+            windows = self.traffic.windows()
+            report["window"] = self.traffic.size
+            for (i, level) in enumerate(self.traffic_levels()):
+                report["levels"][level.name]["windows_down"] = windows[:, i, 0].tolist()
+                report["levels"][level.name]["windows_up"] = windows[:, i, 1].tolist()
+        return report
+
+    def show_traffic(self, requests = None):
+        report = self.traffic_report(requests)
+        if len(report["levels"]) == 0:
+            return
+        boundaries = ", ".join(f"{name}{prettyright}{level['next']} {prettydown}{level['bytes_down']} B {prettyup}{level['bytes_up']} B" for (name, level) in report["levels"].items())
+        lowest = self.traffic_levels()[0]
+        output.write(f"Traffic: {boundaries}. {Fore.YELLOW}{report['memory_bytes_per_request']:.2f}{Style.RESET_ALL} B per request reach {lowest.parent.name}")
+        if self.traffic is not None and len(self.traffic.samples) > 0:
+            windows = self.traffic.windows().sum(axis=2)
+            peaks = ", ".join(f"{level.name} {Fore.YELLOW}{windows[:, i].mean():.1f}{Style.RESET_ALL} B mean, {Fore.RED}{windows[:, i].max()}{Style.RESET_ALL} B peak" for (i, level) in enumerate(self.traffic_levels()))
+            output.write(f"Windows of {self.traffic.size} requests ({len(self.traffic.samples)} complete): {peaks}")
+
+    def enable_traffic_windows(self, size):
+        if size <= 0:
+            raise Exception("Windows must have at least one request")
+        self.traffic = TrafficWindows(self, size)
+
+    def disable_traffic_windows(self):
+        self.traffic = None
+
+    #timed mode: requests have an issue time and misses are tracked in the MSHRs of every cache
+    def enable_timing(self):
+        if self.clock is None:
+            self.clock = Clock()
+            for level in self.all_levels():
+                level.enable_timing(self.clock)
+
+    def disable_timing(self):
+        self.clock = None
+        for level in self.all_levels():
+            level.enable_timing(None)
+
+    def timing_report(self):
+        report = self.clock.report()
+        report["levels"] = {level.name: level.mshr.report() for level in self.levels if getattr(level, 'mshr', None) is not None}
+        return report
+
+    def show_timing(self):
+        report = self.timing_report()
+        levels = ", ".join(f"{name} {level['mshrs'] or 'unlimited'} MSHRs {Fore.GREEN}{level['merged']}{Style.RESET_ALL} merged {Fore.RED}{level['stall_cycles']}{Style.RESET_ALL} stall cycles MLP {Fore.YELLOW}{level['mlp']:.2f}{Style.RESET_ALL}"
+                           for (name, level) in report["levels"].items())
+        output.write(f"Timing: {Fore.YELLOW}{report['requests']}{Style.RESET_ALL} requests in {Fore.YELLOW}{report['cycles']}{Style.RESET_ALL} cycles, {Fore.YELLOW}{report['average_latency']:.2f}{Style.RESET_ALL} cycles each. {levels}")
+
+    def enable_latency_histogram(self):
+        if self.latency is None:
+            self.latency = LatencyHistogram()
+
+    def disable_latency_histogram(self):
+        self.latency = None
+
+    #every level by default, or only the one with the given name
+    def reset_costs(self, cost_hit, cost_miss, cost_through, cost_access, name = None):
+        levels = [level for level in self.all_levels() if name is None or level.name == name]
+        if len(levels) == 0:
+            raise Exception(f"No level named {name}")
+        for level in levels:
+            level.reset_costs(cost_hit = cost_hit, cost_miss = cost_miss, cost_through = cost_through, cost_access = cost_access)
             
     #clear from bottom up
     def clear(self, initial_address, final_address):
@@ -257,12 +1796,26 @@ class CacheLine:
         self.addr = addr
         self.tag = tag
         self.valid = valid
+        #brought by the prefetch engine and not used yet, and when it was issued
+        self.prefetched = False
+        self.prefetch_time = 0
         
     def prettyprint(self, tag_width):
+        if not colour_enabled:
+            return f"{'V' if self.valid else '-'}{'D' if self.dirty else '-'} {prettydir(self.tag, tag_width, 0, 0, brackets = False)}"
         return f"{Fore.BLACK if not self.valid else Fore.GREEN}V{Style.RESET_ALL}{Fore.BLACK if not self.dirty else Fore.YELLOW}D{Style.RESET_ALL} {prettydir(self.tag, tag_width, 0, 0, brackets = False)}"
     
         
 class CacheStatistics:
+    #plain counters, in the order they are reported
+    COUNTERS = ('read_hit', 'read_miss', 'write_hit', 'write_miss', 'write_through',
+                'victim_swap', 'victim_push', 'victim_evict',
+                'line_evict', 'line_miss', 'line_hit', 'line_pull', 'line_prefetch',
+                'miss_compulsory', 'miss_capacity', 'miss_conflict',
+                'prefetch_issued', 'prefetch_useful', 'prefetch_late', 'prefetch_useless',
+                'bytes_fill', 'bytes_prefetch', 'bytes_writeback', 'bytes_through', 'bytes_victim',
+                'write_forward', 'buffer_merge', 'buffer_stall', 'buffer_drain', 'back_invalidate')
+
     def __init__(self):
         self.reset()
         
@@ -289,7 +1842,36 @@ class CacheStatistics:
         self.line_pull = 0
         self.line_prefetch = 0
 
-    def get_statistics(self, show_wt = True, show_prefetch = True, show_victim = True):
+        #3C classification of line misses (only if enabled in the cache)
+        self.miss_compulsory = 0
+        self.miss_capacity = 0
+        self.miss_conflict = 0
+
+        #prefetch engine: lines requested, used in time, used before arriving, and evicted unused
+        self.prefetch_issued = 0
+        self.prefetch_useful = 0
+        self.prefetch_late = 0
+        self.prefetch_useless = 0
+
+        #bytes read from the next level (demand and prefetch fills), written to it (writebacks
+        #and write-through words) and moved to and from the victim cache
+        self.bytes_fill = 0
+        self.bytes_prefetch = 0
+        self.bytes_writeback = 0
+        self.bytes_through = 0
+        self.bytes_victim = 0
+
+        #write-through: writes forwarded to the next level, and the coalescing write buffer
+        #(writes merged into a pending entry, writes that waited for a full buffer, entries sent)
+        self.write_forward = 0
+        self.buffer_merge = 0
+        self.buffer_stall = 0
+        self.buffer_drain = 0
+
+        #lines of the levels above removed when an inclusive level evicted them
+        self.back_invalidate = 0
+
+    def get_statistics(self, show_wt = True, show_prefetch = True, show_victim = True, show_3c = False, show_prefetcher = False, buffer_pending = None, show_inclusion = False):
         total_reads = self.read_hit + self.read_miss
         hitrate_read = float(self.read_hit) / float(total_reads) * 100.0 if total_reads > 0 else 0
         total_writes = self.write_hit + self.write_miss
@@ -298,37 +1880,195 @@ class CacheStatistics:
         mis_width = math.ceil(math.log10(1+max(self.read_miss, self.write_miss, self.line_miss)))
         tot_width = math.ceil(math.log10(1+max(total_reads, total_writes)))
         
-        wttext = f"[{Fore.LIGHTMAGENTA_EX}{self.write_through}{Style.RESET_ALL}{prettyup} written through]" if show_wt else ""
+        wttext = f"[{Fore.LIGHTMAGENTA_EX}{self.write_through + self.write_forward}{Style.RESET_ALL}{prettyup} written through]" if show_wt else ""
         pftext = f"({prettydowndown}{self.line_prefetch} prefetched) " if show_prefetch else ""
         vctext = f"\nVictim: {prettyswap}{self.victim_swap} swapped {prettyright}{self.victim_push} pushed to victim {prettyupyellow}{self.victim_evict} evicted from victim" if show_victim else ""
+        if show_3c:
+            vctext += f"\nMisses: {Fore.RED}{self.miss_compulsory}{Style.RESET_ALL} compulsory, {Fore.RED}{self.miss_capacity}{Style.RESET_ALL} capacity and {Fore.RED}{self.miss_conflict}{Style.RESET_ALL} conflict"
+        if show_prefetcher:
+            vctext += f"\nPrefetcher: {prettydowndown}{self.prefetch_issued} issued, {Fore.GREEN}{self.prefetch_useful}{Style.RESET_ALL} useful, {Fore.YELLOW}{self.prefetch_late}{Style.RESET_ALL} late and {Fore.RED}{self.prefetch_useless}{Style.RESET_ALL} useless " + \
+                f"({100 * self.prefetch_accuracy():.2f} accuracy, {100 * self.prefetch_coverage():.2f} coverage)"
+        if buffer_pending is not None:
+            vctext += f"\nWrite buffer: {Fore.GREEN}{self.buffer_merge}{Style.RESET_ALL} merged, {Fore.RED}{self.buffer_stall}{Style.RESET_ALL} stalls, {prettyup}{self.buffer_drain} drained ({buffer_pending} pending)"
+        if show_inclusion:
+            vctext += f"\nInclusion: {prettytrash}{self.back_invalidate} back-invalidated above"
         return f'Reads:  {Fore.GREEN}{self.read_hit:{hit_width}d}{Style.RESET_ALL} hits and {Fore.RED}{self.read_miss:{mis_width}d}{Style.RESET_ALL} misses out of {Fore.YELLOW}{total_reads:{tot_width}d}{Style.RESET_ALL} requests ({hitrate_read:.2f} hit rate) \n'+\
             f'Writes: {Fore.GREEN}{self.write_hit:{hit_width}d}{Style.RESET_ALL} hits and {Fore.RED}{self.write_miss:{mis_width}d}{Style.RESET_ALL} misses out of {Fore.YELLOW}{total_writes:{tot_width}d}{Style.RESET_ALL} requests ({hitrate_write:.2f} hit rate) {wttext}\n' + \
             f"Blocks: {Fore.GREEN}{self.line_hit:{hit_width}d}{Style.RESET_ALL} hits and {Fore.RED}{self.line_miss:{mis_width}d}{Style.RESET_ALL} misses. {prettydown}{self.line_pull} fetched {pftext}{prettyup}{self.line_evict} written back" + \
             vctext
             
-    def get_cost(self, show_through=False):
+    #bytes towards the requests and towards memory
+    def traffic(self):
+        return (self.bytes_fill + self.bytes_prefetch, self.bytes_writeback + self.bytes_through)
+
+    def get_counters(self):
+        return {name: getattr(self, name) for name in CacheStatistics.COUNTERS}
+
+    #share of the issued prefetches that were used
+    def prefetch_accuracy(self):
+        return (self.prefetch_useful + self.prefetch_late) / self.prefetch_issued if self.prefetch_issued > 0 else 0.0
+
+    #share of the lines that would have been fetched on demand which the prefetcher brought instead
+    def prefetch_coverage(self):
+        covered = self.prefetch_useful + self.prefetch_late
+        return covered / (covered + self.line_pull) if covered + self.line_pull > 0 else 0.0
+
+    def get_cost_values(self):
         total_hit = self.read_hit + self.write_hit
-        cost_hit = total_hit * self.cost_hit
         total_miss = self.read_miss + self.write_miss
-        cost_miss = total_miss * self.cost_miss
         total_access = total_hit + total_miss
-        cost_access = total_access * self.cost_access
         total_through = self.write_through
+        cost_hit = total_hit * self.cost_hit
+        cost_miss = total_miss * self.cost_miss
+        cost_access = total_access * self.cost_access
         cost_through = total_through * self.cost_through
-        total_cost = cost_access + cost_hit + cost_miss + cost_through
+        return {
+            "total_cost": cost_access + cost_hit + cost_miss + cost_through,
+            "total_access": total_access, "cost_access": cost_access,
+            "total_hit": total_hit, "cost_hit": cost_hit,
+            "total_miss": total_miss, "cost_miss": cost_miss,
+            "total_through": total_through, "cost_through": cost_through,
+        }
+
+    #plain data view of every counter plus derived rates and costs. Cheap enough for monitoring loops
+    def as_dict(self):
+        stats = self.get_counters()
+        total_reads = self.read_hit + self.read_miss
+        total_writes = self.write_hit + self.write_miss
+        total_lines = self.line_hit + self.line_miss
+        stats["read_hit_rate"] = self.read_hit / total_reads if total_reads > 0 else 0.0
+        stats["write_hit_rate"] = self.write_hit / total_writes if total_writes > 0 else 0.0
+        stats["hit_rate"] = (self.read_hit + self.write_hit) / (total_reads + total_writes) if total_reads + total_writes > 0 else 0.0
+        stats["line_hit_rate"] = self.line_hit / total_lines if total_lines > 0 else 0.0
+        stats["prefetch_accuracy"] = self.prefetch_accuracy()
+        stats["prefetch_coverage"] = self.prefetch_coverage()
+        stats.update(self.get_cost_values())
+        return stats
+
+    def get_cost(self, show_through=False):
+        costs = self.get_cost_values()
+        total_cost = costs["total_cost"]
+        total_access, cost_access = costs["total_access"], costs["cost_access"]
+        total_hit, cost_hit = costs["total_hit"], costs["cost_hit"]
+        total_miss, cost_miss = costs["total_miss"], costs["cost_miss"]
+        total_through, cost_through = costs["total_through"], costs["cost_through"]
         wttext = f". {Fore.BLUE}{total_through}{Style.RESET_ALL} write-through cost [{Fore.YELLOW}{cost_through}{Style.RESET_ALL}]" if show_through else ""
         return f'Cost: [{Fore.YELLOW}{total_cost}{Style.RESET_ALL}] total cost, of which: {Fore.YELLOW}{total_access}{Style.RESET_ALL} accesses cost [{Fore.YELLOW}{cost_access}{Style.RESET_ALL}], {Fore.GREEN}{total_hit}{Style.RESET_ALL} hits cost [{Fore.YELLOW}{cost_hit}{Style.RESET_ALL}], and {Fore.RED}{total_miss}{Style.RESET_ALL} misses cost [{Fore.YELLOW}{cost_miss}{Style.RESET_ALL}]{wttext}'
 
 
-class MainMemory:
+#DRAM behind the main memory. Addresses are split in row, rank, bank, channel and column fields in
+#the order of the mapping, most significant first. Each bank keeps a row open in its row buffer: an
+#access to the open row only takes the column access (tCAS), to a closed bank also the activation
+#(tRCD), and to another row the precharge first (tRP). The closed page policy precharges after
+#every access. In the timed mode a bank serves one access at a time
+class DRAM:
+    FIELDS = ('row', 'rank', 'bank', 'channel', 'column')
+    POLICIES = ('open', 'closed')
+
+    def __init__(self, address_width, channels = 1, ranks = 1, banks = 8, row_size = 8192, mapping = "row:rank:bank:channel:column", policy = "open", trcd = 14, tcas = 14, trp = 14):
+        counts = {"channel": channels, "rank": ranks, "bank": banks, "column": row_size}
+        for (field, count) in counts.items():
+            if count < 1 or count & (count - 1):
+                raise Exception(f"The number of {field}s must be a power of two")
+        fields = mapping.split(':')
+        if sorted(fields) != sorted(DRAM.FIELDS):
+            raise Exception(f"The mapping must order the fields {', '.join(DRAM.FIELDS)} separated by ':'")
+        if policy not in DRAM.POLICIES:
+            raise Exception(f"Unknown page policy {policy}")
+        widths = {field: count.bit_length() - 1 for (field, count) in counts.items()}
+        widths["row"] = address_width - sum(widths.values())
+        if widths["row"] < 0:
+            raise Exception("The DRAM is larger than the address space")
+        #(shift, mask) of every field
+        self.fields = {}
+        shift = 0
+        for field in reversed(fields):
+            self.fields[field] = (shift, (1 << widths[field]) - 1)
+            shift += widths[field]
+        self.channels = channels
+        self.ranks = ranks
+        self.banks = banks
+        self.row_size = row_size
+        self.mapping = mapping
+        self.policy = policy
+        self.trcd = trcd
+        self.tcas = tcas
+        self.trp = trp
+        #open row of every bank (-1 if precharged) and when it is free in the timed mode
+        self.open_rows = [-1] * (channels * ranks * banks)
+        self.bank_ready = [0] * (channels * ranks * banks)
+        self.reset()
+
+    def reset(self):
+        self.row_hits = 0
+        self.row_empty = 0
+        self.row_conflicts = 0
+        self.latency = 0
+
+    def field(self, addr, field):
+        (shift, mask) = self.fields[field]
+        return (addr >> shift) & mask
+
+    def locate(self, addr):
+        bank = (self.field(addr, 'channel') * self.ranks + self.field(addr, 'rank')) * self.banks + self.field(addr, 'bank')
+        return (bank, self.field(addr, 'row'))
 
-    def __init__(self, address_width, line_size_width, name = "Main memory", virtual_address_width = 0):
+    #latency of an access issued at now (None outside the timed mode)
+    def access(self, addr, now = None, count = True):
+        (bank, row) = self.locate(addr)
+        open_row = self.open_rows[bank]
+        if open_row == row:
+            latency = self.tcas
+            if count:
+                self.row_hits += 1
+        elif open_row < 0:
+            latency = self.trcd + self.tcas
+            if count:
+                self.row_empty += 1
+        else:
+            latency = self.trp + self.trcd + self.tcas
+            if count:
+                self.row_conflicts += 1
+        self.open_rows[bank] = row if self.policy == 'open' else -1
+        if now is not None:
+            start = max(now, self.bank_ready[bank])
+            self.bank_ready[bank] = start + latency + (self.trp if self.policy == 'closed' else 0)
+            latency += start - now
+        if count:
+            self.latency += latency
+        return latency
+
+    def report(self):
+        accesses = self.row_hits + self.row_empty + self.row_conflicts
+        return {"channels": self.channels, "ranks": self.ranks, "banks": self.banks, "row_size": self.row_size, "mapping": self.mapping, "policy": self.policy,
+                "row_hits": self.row_hits, "row_empty": self.row_empty, "row_conflicts": self.row_conflicts,
+                "row_hit_rate": self.row_hits / accesses if accesses > 0 else 0.0, "latency": self.latency}
+
+    def show(self):
+        report = self.report()
+        output.write(f"DRAM: {Fore.GREEN}{self.row_hits}{Style.RESET_ALL} row hits, {Fore.YELLOW}{self.row_empty}{Style.RESET_ALL} to closed rows and {Fore.RED}{self.row_conflicts}{Style.RESET_ALL} row conflicts "
+                     f"({100 * report['row_hit_rate']:.2f} row hit rate, {self.policy} page). [{Fore.YELLOW}{self.latency}{Style.RESET_ALL}] cycles")
+
+
+class MainMemory(Observable):
+
+    def __init__(self, address_width, line_size_width, name = "Main memory", virtual_address_width = 0, dram = None):
         self.name = name
         self.address_width = address_width
         self.line_size_width = line_size_width
         self.statistics = CacheStatistics()
+        self.hit_latency = 100
+        self.clock = None
+        #optional DRAM model, which replaces the fixed latency
+        self.dram = dram
+        #main memory keeps every line, whatever the levels above do
+        self.inclusion = InclusionPolicy.NINE
         #for pretty printing
         self.virtual_address_width = virtual_address_width
+        self.event_log = None
+        self.event_id = 0
+        self.narrate = True
+        self.init_hooks()
         
     def __contains__(self, key):
         return key < (1 << self.address_width)
@@ -336,40 +2076,426 @@ class MainMemory:
     def get_block(self, addr):
         return addr >> self.line_size_width
 
+    def _event(self, kind, addr):
+        if self.event_log is not None:
+            self.event_log.record(self.event_id, kind, addr)
+        if self.narrate:
+            output.write(self.render_event(kind, addr, 0, 0))
+
+    def render_event(self, kind, addr, set_idx, aux):
+        if kind == EventKind.MEMORY_READ:
+            return f"{prettydir(addr, self.address_width, 0, self.line_size_width, virtualbits=self.virtual_address_width)} {prettydown} Block 0x{self.get_block(addr):0x} read from main memory"
+        if kind == EventKind.MEMORY_WRITE:
+            return f"{prettydir(addr, self.address_width, 0, self.line_size_width, virtualbits=self.virtual_address_width)} {prettyup} Block 0x{self.get_block(addr):0x} written to main memory"
+        raise Exception(f"Event {kind.name} not supported by main memory")
+
     def read(self, addr):
         self.statistics.read_hit += 1
-        print(f"{prettydir(addr, self.address_width, 0, self.line_size_width, virtualbits=self.virtual_address_width)} {prettydown} Block 0x{self.get_block(addr):0x} read from main memory")
+        if self.dram is not None:
+            latency = self.dram.access(addr, self.clock.now if self.clock is not None else None)
+            if self.clock is not None:
+                self.clock.ready = self.clock.now + latency
+        elif self.clock is not None:
+            self.clock.ready = self.clock.now + self.hit_latency
+        self._event(EventKind.MEMORY_READ, addr)
+        if self.hooks[HookEvent.HIT] is not None:
+            self.hooks[HookEvent.HIT].notify(addr)
         return True
 
-    def write(self, addr):
+    #a line read by a level above. Main memory always keeps its copy
+    def supply(self, addr, size):
+        self.read(addr)
+        return False
+
+    def write(self, addr, size = None):
         self.statistics.write_hit += 1
-        print(f"{prettydir(addr, self.address_width, 0, self.line_size_width, virtualbits=self.virtual_address_width)} {prettyup} Block 0x{self.get_block(addr):0x} written to main memory")
+        if self.dram is not None:
+            self.dram.access(addr, self.clock.now if self.clock is not None else None)
+        self._event(EventKind.MEMORY_WRITE, addr)
+        if self.hooks[HookEvent.WRITEBACK] is not None:
+            self.hooks[HookEvent.WRITEBACK].notify(addr, Hook.DIRTY)
         return True
 
     def write_line(self, line):
         return self.write(line.addr)
 
+    #a whole line written back from the level above, one write per block it covers. Clean lines are dropped
+    def writeback(self, addr, size, dirty = True):
+        if not dirty:
+            return
+        for part in covered_lines(addr, size, self.line_size_width):
+            self.write(part)
+
+    #main memory only has the open rows of the DRAM to warm up
+    def warm_read(self, addr):
+        if self.dram is not None:
+            self.dram.access(addr, count = False)
+        return True
+
+    def warm_supply(self, addr, size):
+        self.warm_read(addr)
+        return False
+
+    def warm_write(self, addr, size = None):
+        if self.dram is not None:
+            self.dram.access(addr, count = False)
+        return True
+
+    def warm_writeback(self, addr, size, dirty = True):
+        if self.dram is not None and dirty:
+            for part in covered_lines(addr, size, self.line_size_width):
+                self.dram.access(part, count = False)
+        return True
+
     def show_statistics(self):
-        print(f"{self.statistics.get_statistics(show_prefetch=False, show_victim=False, show_wt=False)}")
+        output.write(f"{self.statistics.get_statistics(show_prefetch=False, show_victim=False, show_wt=False)}")
+        if self.dram is not None:
+            self.dram.show()
         
     def show_costs(self):
-        print(f"{self.statistics.get_cost(show_through=False)}")
+        output.write(f"{self.statistics.get_cost(show_through=False)}")
+
+    def stats_dict(self):
+        stats = {"name": self.name, "kind": "memory", "line_size": 2**self.line_size_width}
+        stats.update(self.statistics.as_dict())
+        stats["latency"] = self.latency_total()
+        if self.dram is not None:
+            stats["dram"] = self.dram.report()
+        return stats
 
     def reset_statistics(self):
         self.statistics.reset()
+        if self.dram is not None:
+            self.dram.reset()
         
-    def reset_costs(self, cost_hit, cost_miss, cost_through):
+    def reset_costs(self, cost_hit, cost_miss, cost_through, cost_access):
         self.statistics.cost_hit = cost_hit
         self.statistics.cost_miss = cost_miss
         self.statistics.cost_through = cost_through
+        self.statistics.cost_access = cost_access
+
+    def set_latency(self, hit_latency, through_latency = 0, swap_latency = 0):
+        self.hit_latency = hit_latency
+
+    def enable_timing(self, clock):
+        self.clock = clock
+
+    def latency_total(self):
+        if self.dram is not None:
+            return self.dram.latency
+        return self.hit_latency * (self.statistics.read_hit + self.statistics.write_hit)
         
     def __str__(self):
         return f"{self.name}: {bits_to_power(self.address_width, 'B')} ({bits_to_power(self.address_width-self.line_size_width, ' Blocks')} of {bits_to_power(self.line_size_width, 'B')})"
 
 
-class Cache:
+class MissClassifier:
+    #classifies misses as compulsory (block never seen), capacity (it would also miss
+    #in a fully associative LRU cache of the same size) or conflict (otherwise)
+    COMPULSORY = 0
+    CAPACITY = 1
+    CONFLICT = 2
+
+    #the blocks seen so far are kept exactly in a sparse bitmap: pages of 2^PAGE_WIDTH bits
+    #are allocated only for the regions that are touched. Its memory grows with the real
+    #footprint, about 1/8 byte per block in dense regions and ~300 bytes per isolated block
+    PAGE_WIDTH = 10
+
+    def __init__(self, number_of_lines):
+        self.capacity = number_of_lines
+        #shadow fully associative LRU: hash map + doubly linked list, oldest first
+        self.shadow = OrderedDict()
+        self.seen = {}
+
+    #marks a block as seen and returns whether it was seen before
+    def _seen(self, block):
+        page = self.seen.get(block >> MissClassifier.PAGE_WIDTH)
+        if page is None:
+            page = bytearray(2**MissClassifier.PAGE_WIDTH // 8)
+            self.seen[block >> MissClassifier.PAGE_WIDTH] = page
+        offset = block & (2**MissClassifier.PAGE_WIDTH - 1)
+        (byte, bit) = (offset >> 3, 1 << (offset & 7))
+        was = page[byte] & bit
+        page[byte] |= bit
+        return was != 0
+
+    #bytes of the pages of seen blocks
+    def seen_bytes(self):
+        return len(self.seen) * 2**MissClassifier.PAGE_WIDTH // 8
+
+    #updates the shadow structures with an access and returns what a miss on it would be
+    def access(self, block):
+        if block in self.shadow:
+            self.shadow.move_to_end(block)
+            kind = MissClassifier.CONFLICT
+        else:
+            self.shadow[block] = None
+            if len(self.shadow) > self.capacity:
+                self.shadow.popitem(last = False)
+            kind = MissClassifier.CAPACITY
+        if not self._seen(block):
+            kind = MissClassifier.COMPULSORY
+        return kind
+
+
+class ReuseDistance:
+    #reuse distance: distinct lines touched since the previous access to the same line.
+    #A Fenwick tree over access times marks only the last access of every line, so the
+    #distance is the number of marks after that last access, in O(log n)
+    BUCKETS = 65
+
+    def __init__(self, capacity = 1024):
+        self.capacity = capacity
+        self.tree = [0] * (capacity + 1)
+        self.last = {}
+        self.time = 0
+        #bucket 0 is distance 0, bucket b holds distances in [2^(b-1), 2^b)
+        self.histogram = np.zeros(ReuseDistance.BUCKETS, dtype=np.int64)
+        self.cold = 0
+
+    def _add(self, position, value):
+        tree = self.tree
+        while position <= self.capacity:
+            tree[position] += value
+            position += position & -position
+
+    def _prefix(self, position):
+        tree = self.tree
+        total = 0
+        while position > 0:
+            total += tree[position]
+            position -= position & -position
+        return total
+
+    #renumbers the live lines 1..n keeping their order, so times never run out
+    def _compact(self):
+        ordered = sorted(self.last.items(), key=lambda item: item[1])
+        if 2 * len(ordered) > self.capacity:
+            self.capacity *= 2
+        self.last = {block: i + 1 for (i, (block, _)) in enumerate(ordered)}
+        self.time = len(ordered)
+        #linear time build of a tree with a mark in every position up to time
+        self.tree = [0] * (self.capacity + 1)
+        for position in range(1, self.capacity + 1):
+            if position <= self.time:
+                self.tree[position] += 1
+            parent = position + (position & -position)
+            if parent <= self.capacity:
+                self.tree[parent] += self.tree[position]
+
+    def access(self, block):
+        if self.time == self.capacity:
+            self._compact()
+        self.time += 1
+        previous = self.last.get(block)
+        if previous is None:
+            self.cold += 1
+        else:
+            distance = self._prefix(self.time - 1) - self._prefix(previous)
+            self.histogram[distance.bit_length()] += 1
+            self._add(previous, -1)
+        self._add(self.time, 1)
+        self.last[block] = self.time
+
+    def reset(self):
+        self.histogram[:] = 0
+        self.cold = 0
+
+    #fraction of the reuses with a distance below number_of_lines (those that fit in that many lines)
+    def fraction_within(self, number_of_lines):
+        total = self.histogram.sum()
+        if total == 0:
+            return 0.0
+        buckets = np.arange(ReuseDistance.BUCKETS)
+        #upper bound (exclusive) of every bucket
+        upper = np.where(buckets == 0, 1, 2.0**buckets)
+        return float(self.histogram[upper <= number_of_lines].sum()) / float(total)
+
+
+#Prefetch engines of a cache, trained with its demand accesses. They return the lines to
+#prefetch, which the cache issues one after another from a queue
+class Prefetcher:
+    name = "none"
+
+    def __init__(self, degree = 1, latency = 8):
+        self.degree = degree
+        #demand accesses of the cache a prefetch takes to arrive. Lines used sooner are late
+        self.latency = latency
+
+    def train(self, cache, addr, missed, prefetch_hit):
+        return []
+
+    #lines kept outside the cache can serve a demand miss. Returns when the line was issued
+    def supply(self, cache, addr):
+        return None
+
+    def describe(self):
+        return f"{self.name} {self.degree}"
+
+
+#tagged next-N-line: triggered by misses and by the first use of a prefetched line
+class NextLinePrefetcher(Prefetcher):
+    name = "next_line"
+
+    def train(self, cache, addr, missed, prefetch_hit):
+        if not (missed or prefetch_hit):
+            return []
+        line = 2**cache.line_size_width
+        base = addr - addr % line
+        return [base + i * line for i in range(1, self.degree + 1)]
+
+
+#without program counters, strides are detected per memory region
+class StridePrefetcher(Prefetcher):
+    name = "stride"
+
+    def __init__(self, degree = 1, region_width = 12, entries = 64, latency = 8):
+        super().__init__(degree, latency)
+        self.region_width = region_width
+        self.entries = entries
+        #region -> [last block, stride, confidence], least recently used first
+        self.table = OrderedDict()
+
+    def train(self, cache, addr, missed, prefetch_hit):
+        block = addr >> cache.line_size_width
+        region = addr >> self.region_width
+        entry = self.table.get(region)
+        if entry is None:
+            self.table[region] = [block, 0, 0]
+            if len(self.table) > self.entries:
+                self.table.popitem(last = False)
+            return []
+        self.table.move_to_end(region)
+        stride = block - entry[0]
+        if stride == 0:
+            return []
+        entry[0] = block
+        if stride != entry[1]:
+            #a new stride needs to be seen twice in a row
+            entry[2] = max(entry[2] - 1, 0)
+            if entry[2] == 0:
+                entry[1] = stride
+            return []
+        entry[2] = min(entry[2] + 1, 3)
+        return [(block + i * stride) << cache.line_size_width for i in range(1, self.degree + 1)]
+
+    def describe(self):
+        return f"{self.name} {self.degree} {self.region_width}"
+
+
+#prefetched lines wait in FIFO buffers beside the cache, and move into it when a demand miss finds them
+class StreamBufferPrefetcher(Prefetcher):
+    name = "stream"
+
+    def __init__(self, buffers = 4, depth = 4, latency = 8):
+        super().__init__(depth, latency)
+        #(block, issue time) entries. Least recently used buffer first
+        self.buffers = [deque() for i in range(buffers)]
+        self.supplied = False
+
+    def supply(self, cache, addr):
+        block = addr >> cache.line_size_width
+        for (i, buffer) in enumerate(self.buffers):
+            for (j, (buffered, issued)) in enumerate(buffer):
+                if buffered == block:
+                    #lines before it were skipped by the stream
+                    for k in range(j + 1):
+                        buffer.popleft()
+                    cache.statistics.prefetch_useless += j
+                    self.buffers.append(self.buffers.pop(i))
+                    self.supplied = True
+                    return issued
+        return None
+
+    def train(self, cache, addr, missed, prefetch_hit):
+        if not missed:
+            return []
+        block = addr >> cache.line_size_width
+        if self.supplied:
+            #keep the stream that supplied the line running ahead
+            self.supplied = False
+            buffer = self.buffers[-1]
+            next_block = buffer[-1][0] + 1 if buffer else block + 1
+            wanted = self.degree - len(buffer)
+        else:
+            #start a new stream in the least recently used buffer
+            buffer = self.buffers.pop(0)
+            cache.statistics.prefetch_useless += len(buffer)
+            buffer.clear()
+            self.buffers.append(buffer)
+            next_block = block + 1
+            wanted = self.degree
+        for next_block in range(next_block, next_block + wanted):
+            next_addr = next_block << cache.line_size_width
+            if cache.prefetchable(next_addr):
+                buffer.append((next_block, cache.prefetch_fetch(next_addr)))
+        return []
+
+    def describe(self):
+        return f"{self.name} {len(self.buffers)} {self.degree}"
+
+
+PREFETCHERS = {'next_line': NextLinePrefetcher, 'stride': StridePrefetcher, 'stream': StreamBufferPrefetcher}
+
+def create_prefetcher(kind, params = (), latency = 8):
+    if kind == 'none':
+        return None
+    if kind not in PREFETCHERS:
+        raise Exception(f"Unknown prefetcher {kind}, use one of: none, {', '.join(PREFETCHERS)}")
+    return PREFETCHERS[kind](*params, latency = latency)
+
+
+#bytes of a write through, requests don't carry their size
+WORD_SIZE = 4
+
+#coalescing write buffer between a cache and its parent. Each entry is a line with a mask of
+#the bytes written, so writes to the same line merge. Entries leave in order of arrival
+class WriteBuffer:
+    def __init__(self, entries, line_size_width):
+        if entries <= 0:
+            raise Exception("A write buffer needs at least one entry")
+        self.entries = entries
+        self.line_size_width = line_size_width
+        self.lines = OrderedDict()
+
+    def __len__(self):
+        return len(self.lines)
 
-    def __init__(self, name, set_width, way_width, line_size_width, replacement_policy = ReplacementPolicy.LRU, write_back = True, write_allocate = True, parent = None, victim = None, address_width = 32, prefetch = None, virtual_address_width=0):
+    def __contains__(self, addr):
+        return (addr >> self.line_size_width) in self.lines
+
+    def full(self):
+        return len(self.lines) >= self.entries
+
+    #marks the bytes written. Returns True if they merged with a pending entry
+    def insert(self, addr, size):
+        block = addr >> self.line_size_width
+        offset = addr - (block << self.line_size_width)
+        mask = (((1 << size) - 1) << offset) & ((1 << 2**self.line_size_width) - 1)
+        if block in self.lines:
+            self.lines[block] |= mask
+            return True
+        self.lines[block] = mask
+        return False
+
+    #takes out the entry of addr (the oldest one by default) as the (address, size) span it writes
+    def pop(self, addr = None):
+        if addr is None:
+            block, mask = self.lines.popitem(last=False)
+        else:
+            block = addr >> self.line_size_width
+            mask = self.lines.pop(block)
+        low = (mask & -mask).bit_length() - 1
+        return ((block << self.line_size_width) + low, mask.bit_length() - low)
+
+    #addresses of the pending lines between two addresses
+    def between(self, address_low, address_high):
+        return [block << self.line_size_width for block in self.lines
+                if address_low >> self.line_size_width <= block <= address_high >> self.line_size_width]
+
+class Cache(Observable):
+
+    def __init__(self, name, set_width, way_width, line_size_width, replacement_policy = ReplacementPolicy.LRU, write_back = True, write_allocate = True, parent = None, victim = None, address_width = 32, prefetch = None, virtual_address_width=0, classify = False, reuse = False, prefetcher = None, write_buffer = 0, mshrs = 0):
         self.replacement_policy = replacement_policy
 
         #Log base two of the number of sets, ways and bytes per line
@@ -380,20 +2506,53 @@ class Cache:
         #write back policy (only write when evicted)
         #if disabled it is write-through (write always to cache and behind (avoid dirty)
         self.write_back = write_back        
+        #optional coalescing buffer for the writes sent to the parent (write-through and not allocated)
+        self.write_buffer = WriteBuffer(write_buffer, line_size_width) if write_buffer > 0 else None
         #write allocate policy. If enabled, blocks are brought to cache when writing
         #if not enabled, blocks are written to main memory
         self.write_allocate = write_allocate
         #prefetch, when a block fails to be located, bring the X ones as well
         self.prefetch = prefetch
+        #prefetch engine, its prefetches are not demand accesses. The clock counts demand accesses
+        self.prefetcher = prefetcher
+        self.prefetch_clock = 0
 
         self.parent = parent  #memory where we load from / write to. Might be None (e.g:victim)
         self.victim = victim        #victim cache. Might be None (e.g:mainmemory)
+        #levels that load from this one, and whether their lines are also kept here
+        self.children = []
+        self.inclusion = InclusionPolicy.NINE
 
         #for pretty printing and statistics
         self.address_width = address_width 
         self.virtual_address_width = virtual_address_width
         self.name = name
         self.statistics = CacheStatistics()
+        #cycles of a lookup, extra cycles of a write through (a stall, with a write buffer) and of a swap with the victim cache
+        self.hit_latency = 1
+        self.through_latency = 0
+        self.swap_latency = 1
+        #timed mode: misses in flight, at most mshrs of them (0 for no limit)
+        self.mshrs = mshrs
+        self.clock = None
+        self.mshr = None
+        self.event_log = None
+        self.event_id = 0
+        self.narrate = True
+        self.init_hooks()
+        #optional 3C classification of misses
+        self.classifier = None
+        if classify:
+            self.enable_classification()
+        #optional reuse distance histogram
+        self.reuse = None
+        if reuse:
+            self.enable_reuse()
+
+        #per set counters, to find conflict hotspots
+        self.set_accesses = np.zeros(2**self.set_width, dtype=np.int64)
+        self.set_misses = np.zeros(2**self.set_width, dtype=np.int64)
+        self.set_evictions = np.zeros(2**self.set_width, dtype=np.int64)
 
         #initialize set structure: list of lists
         self.set_data = []
@@ -417,11 +2576,67 @@ class Cache:
         return tag_num
 
     def __contains__(self, key):
-        candidate_set = self.get_set(key)
-        for line in candidate_set:
-            if line.valid and line.tag == self.get_tag(key):
+        tag = self.get_tag(key)
+        for line in self.get_set(key):
+            if line.valid and line.tag == tag:
                 return True
         return False
+
+    def enable_classification(self):
+        if self.classifier is None:
+            self.classifier = MissClassifier(2**(self.set_width + self.way_width))
+
+    def enable_reuse(self):
+        if self.reuse is None:
+            self.reuse = ReuseDistance()
+
+    def enable_timing(self, clock):
+        self.clock = clock
+        self.mshr = MSHRFile(self.mshrs) if clock is not None else None
+
+    def _event(self, kind, addr):
+        if self.event_log is not None:
+            self.event_log.record(self.event_id, kind, addr, self.get_set_idx(addr))
+        if self.narrate:
+            output.write(self.render_event(kind, addr, self.get_set_idx(addr), 0))
+
+    def render_event(self, kind, addr, set_idx, aux):
+        prefix = prettydir(addr, self.address_width, self.set_width, self.line_size_width, virtualbits=self.virtual_address_width)
+        tag = self.get_tag(addr)
+        match kind:
+            case EventKind.HIT:
+                return f"{prefix} {prettytick} Tag 0x{tag:0x} in {self.name} set 0x{set_idx:0x}"
+            case EventKind.MISS:
+                return f"{prefix} {prettyfail} Tag 0x{tag:0x} not in {self.name} set 0x{set_idx:0x}"
+            case EventKind.FILL:
+                return f"{prefix} {prettyleft} Tag 0x{tag:0x} from {self.parent.name} to {self.name} set 0x{set_idx:0x}"
+            case EventKind.EVICT:
+                return f"{prefix} {prettyright} Tag 0x{tag:0x} from {self.name} to {self.parent.name}"
+            case EventKind.VICTIM_HIT:
+                return f"{prefix} {prettytick} Addr 0x{addr:0x} in {self.victim.name}"
+            case EventKind.VICTIM_MISS:
+                return f"{prefix} {prettyfail} Tag 0x{tag:0x} not in {self.name}"
+            case EventKind.SWAP_OUT | EventKind.VICTIM_PUSH:
+                return f"{prefix} {prettyright} Tag 0x{tag:0x} from {self.name} to {self.victim.name}"
+            case EventKind.SWAP_IN:
+                return f"{prefix} {prettyleft} Tag 0x{tag:0x} from {self.victim.name} to {self.name}"
+            case EventKind.VICTIM_EVICT:
+                return f"{prefix} {prettyright} Tag 0x{tag:0x} from {self.victim.name} to {self.parent.name}"
+            case EventKind.CLEAR_PUSH:
+                return f"{prefix} {prettyup} Tag 0x{tag:0x} from {self.name} pushed to {self.parent.name}"
+            case EventKind.CLEAR:
+                return f"{prefix} {prettytrash} Tag 0x{tag:0x} cleared from set 0x{set_idx:0x} @ {self.name}"
+            case EventKind.PREFETCH_FILL:
+                return f"{prefix} {prettydowndown} Tag 0x{tag:0x} prefetched from {self.parent.name} to {self.name} set 0x{set_idx:0x}"
+            case EventKind.PREFETCH_BUFFER:
+                return f"{prefix} {prettydowndown} Block 0x{addr >> self.line_size_width:0x} prefetched from {self.parent.name} to a stream buffer of {self.name}"
+            case EventKind.PREFETCH_SUPPLY:
+                return f"{prefix} {prettyleft} Tag 0x{tag:0x} from a stream buffer to {self.name} set 0x{set_idx:0x}"
+            case EventKind.BUFFER_DRAIN:
+                return f"{prefix} {prettyup} Block 0x{addr >> self.line_size_width:0x} drained from the write buffer of {self.name} to {self.parent.name}"
+            case EventKind.BACK_INVALIDATE:
+                return f"{prefix} {prettytrash} Tag 0x{tag:0x} back-invalidated from set 0x{set_idx:0x} @ {self.name}"
+        raise Exception(f"Event {kind.name} not supported by a cache")
         
 
     def read(self, addr):
@@ -432,96 +2647,594 @@ class Cache:
         self.get(addr)
         self._update(addr) #update LRU, etc
 
-    def write(self, addr):
-        #allocate space before updating
-        if self.write_allocate:
+    #a level above reads one of its lines. An exclusive level gives its copy away and does not keep the
+    #lines it fetches for it, unless the line asked for is smaller than ours. Returns whether it is dirty
+    def supply(self, addr, size):
+        if self.inclusion is not InclusionPolicy.EXCLUSIVE or size < 2**self.line_size_width:
+            self.read(addr)
+            return False
+        set_idx = self.get_set_idx(addr)
+        self.set_accesses[set_idx] += 1
+        if self.reuse is not None:
+            self.reuse.access(addr >> self.line_size_width)
+        if addr in self:
+            self.statistics.read_hit += 1
+            self.statistics.line_hit += 1
+            self._event(EventKind.HIT, addr)
+            if self.clock is not None:
+                self.mshr.hit(addr >> self.line_size_width, self.clock, self.hit_latency)
+            if self.hooks[HookEvent.HIT] is not None:
+                self.hooks[HookEvent.HIT].notify(addr, 0)
+            return self.remove(addr).dirty
+        self.statistics.read_miss += 1
+        self.statistics.line_miss += 1
+        self.set_misses[set_idx] += 1
+        if self.hooks[HookEvent.MISS] is not None:
+            self.hooks[HookEvent.MISS].notify(addr, 0)
+        if self.victim and addr in self.victim:
+            self._event(EventKind.VICTIM_HIT, addr)
+            return self.victim.extract(addr).dirty
+        self._event(EventKind.MISS, addr)
+        #the line goes through without being allocated here
+        self.statistics.bytes_fill += 2**self.line_size_width
+        self._drain_line(addr)
+        if self.clock is not None:
+            self.clock.now += self.hit_latency
+        dirty = False
+        for part in self._parent_lines(addr):
+            dirty |= self.parent.supply(part, 2**self.line_size_width)
+        return dirty
+
+    def write(self, addr, size = None):
+        #allocate space before updating. An exclusive level does not allocate the writes of the levels above
+        if self.write_allocate and (self.inclusion is not InclusionPolicy.EXCLUSIVE or not self.children):
             if addr in self:
                 self.statistics.write_hit += 1
             else:
                 self.statistics.write_miss += 1
 
             self.get(addr)
-            self._update(addr, dirty=True) #update LRU, etc
+            self._update(addr, dirty=self.write_back) #update LRU, etc
+            if not self.write_back:
+                self._forward(addr, size)
         else: 
             #if the block is here, write it
             if addr in self:
                 self.statistics.write_hit += 1
                 self.get(addr)
-                self._update(addr, dirty=True) #update LRU, etc
+                self._update(addr, dirty=self.write_back) #update LRU, etc
+                if not self.write_back:
+                    self._forward(addr, size)
             #if not, write next level
             else:
                 self.statistics.write_through += 1
-                self.parent.write(addr)
+                if self.clock is not None:
+                    self.clock.ready = self.clock.now + self.hit_latency
+                self._send(addr, size)
+
+    #write-through: the written line stays clean and the write also goes to the next level
+    def _forward(self, addr, size):
+        self.statistics.write_forward += 1
+        self._send(addr, size)
+
+    def _send(self, addr, size):
+        saved = self.clock.save() if self.clock is not None else None
+        if self.write_buffer is not None:
+            self._buffer_write(addr, size)
+        else:
+            self.statistics.bytes_through += size or WORD_SIZE
+            self._send_write(addr, size)
+        if saved is not None:
+            self.clock.restore(saved)
+
+    def _send_write(self, addr, size):
+        if size is None:
+            self.parent.write(addr)
+        else:
+            for (part, piece) in split_access(addr, size, self.parent.line_size_width):
+                self.parent.write(part, piece)
+
+    #a write to a new line waits for the oldest entry to leave if the buffer is full
+    def _buffer_write(self, addr, size):
+        for (part, piece) in split_access(addr, size or WORD_SIZE, self.line_size_width):
+            if part not in self.write_buffer and self.write_buffer.full():
+                self.statistics.buffer_stall += 1
+                self._drain()
+            if self.write_buffer.insert(part, piece):
+                self.statistics.buffer_merge += 1
+
+    def _drain(self, addr = None):
+        (start, span) = self.write_buffer.pop(addr)
+        self.statistics.buffer_drain += 1
+        self.statistics.bytes_through += span
+        self._event(EventKind.BUFFER_DRAIN, start)
+        self._send_write(start, span)
+
+    #pending writes of a line leave before the line is read from the parent or evicted
+    def _drain_line(self, addr):
+        if self.write_buffer is not None and addr in self.write_buffer:
+            self._drain(addr)
 
 
     #gets an address for this cache. Internal statistics are updated, and data is brought if needed
     def get(self, addr, prefetched = 0):
+        if self.prefetcher is not None:
+            return self._get_prefetching(addr)
         value = self._get(addr, prefetched)
         self._update(addr)
         return value
+
+    #fast forward versions of read and write. They leave the same contents, recency and
+    #dirty state, without statistics, events or hooks. The prefetch engine is not run
+    def warm_read(self, addr):
+        self.warm_get(addr)
+        self._update(addr)
+
+    def warm_supply(self, addr, size):
+        if self.inclusion is not InclusionPolicy.EXCLUSIVE or size < 2**self.line_size_width:
+            self.warm_read(addr)
+            return False
+        if addr in self:
+            return self.remove(addr).dirty
+        if self.victim and addr in self.victim:
+            return self.victim.extract(addr).dirty
+        self._warm_drain_line(addr)
+        dirty = False
+        for part in self._parent_lines(addr):
+            dirty |= self.parent.warm_supply(part, 2**self.line_size_width)
+        return dirty
+
+    def warm_write(self, addr, size = None):
+        if (self.write_allocate and (self.inclusion is not InclusionPolicy.EXCLUSIVE or not self.children)) or addr in self:
+            self.warm_get(addr)
+            self._update(addr, dirty=self.write_back)
+            if self.write_back:
+                return
+        self._warm_send(addr, size)
+
+    def _warm_send(self, addr, size):
+        if self.write_buffer is None:
+            self._warm_send_write(addr, size)
+            return
+        for (part, piece) in split_access(addr, size or WORD_SIZE, self.line_size_width):
+            if part not in self.write_buffer and self.write_buffer.full():
+                self._warm_send_write(*self.write_buffer.pop())
+            self.write_buffer.insert(part, piece)
+
+    def _warm_send_write(self, addr, size):
+        if size is None:
+            self.parent.warm_write(addr)
+        else:
+            for (part, piece) in split_access(addr, size, self.parent.line_size_width):
+                self.parent.warm_write(part, piece)
+
+    def _warm_drain_line(self, addr):
+        if self.write_buffer is not None and addr in self.write_buffer:
+            self._warm_send_write(*self.write_buffer.pop(addr))
+
+    def warm_get(self, addr):
+        #prefetched lines are followed in a loop, and updated from the last one as get does.
+        #The requested line is updated by the caller
+        fetched = []
+        prefetched = 0
+        while True:
+            fetched.append(addr)
+            if addr in self:
+                break
+            if self.victim and addr in self.victim:
+                line_from_cache = self.allocate_for(addr)
+                line_from_victim = self.victim.extract(addr)
+                self.victim.write_line(line_from_cache)
+                self.write_line(line_from_victim)
+                break
+            self._warm_evict_for(addr)
+            self._warm_drain_line(addr)
+            dirty = False
+            for part in self._parent_lines(addr):
+                dirty |= self.parent.warm_supply(part, 2**self.line_size_width)
+            self._write(addr, dirty=dirty)
+            if self.prefetch is None or prefetched >= self.prefetch:
+                break
+            prefetched += 1
+            addr += 2**self.line_size_width
+        for addr in reversed(fetched[1:]):
+            self._update(addr)
+
+    def _warm_evict_for(self, addr):
+        line_from_cache = self.allocate_for(addr)
+        if line_from_cache.valid:
+            self._warm_drain_line(line_from_cache.addr)
+        if self.victim:
+            if line_from_cache.valid:
+                line_from_victim = self.victim.allocate_for(line_from_cache.addr)
+                self.victim.write_line(line_from_cache)
+                if line_from_victim.valid and self.inclusion is InclusionPolicy.INCLUSIVE and self.children:
+                    line_from_victim.dirty |= self._back_invalidate(line_from_victim.addr, warm=True)
+                if line_from_victim.valid and (line_from_victim.dirty or self.parent.inclusion is InclusionPolicy.EXCLUSIVE):
+                    self.parent.warm_writeback(line_from_victim.addr, 2**self.line_size_width, line_from_victim.dirty)
+        elif line_from_cache.valid:
+            if self.inclusion is InclusionPolicy.INCLUSIVE and self.children:
+                line_from_cache.dirty |= self._back_invalidate(line_from_cache.addr, warm=True)
+            if line_from_cache.dirty or self.parent.inclusion is InclusionPolicy.EXCLUSIVE:
+                self.parent.warm_writeback(line_from_cache.addr, 2**self.line_size_width, line_from_cache.dirty)
+
+    def warm_writeback(self, addr, size, dirty = True):
+        line_size = 2**self.line_size_width
+        for part in covered_lines(addr, size, self.line_size_width):
+            if part not in self:
+                in_victim = self.victim is not None and part in self.victim
+                if in_victim:
+                    self.victim.extract(part)
+                self._warm_evict_for(part)
+                if size < line_size and not in_victim and self.parent is not None:
+                    self._warm_drain_line(part)
+                    for parent_part in self._parent_lines(part):
+                        self.parent.warm_supply(parent_part, line_size)
+            if not dirty and part in self:
+                self._update(part)
+                continue
+            self._write(part, dirty=dirty and self.write_back)
+            if dirty and not self.write_back:
+                self._warm_send(part, min(size, line_size))
+
+    def warm_clear(self, address_low, address_high, until = None):
+        if self.victim is not None:
+            raise Exception("Clear function not implemented for the case where a victim is present")
+        if self.write_buffer is not None:
+            for address in self.write_buffer.between(address_low, address_high):
+                self._warm_drain_line(address)
+        for address in range(address_low, address_high, 2**self.line_size_width):
+            if address in self:
+                line = self.extract(address)
+                if self.parent and line.dirty:
+                    self.parent.warm_writeback(line.addr, 2**self.line_size_width)
+        if self.parent and self.parent is not until:
+            self.parent.warm_clear(address_low, address_high, until)
+
+    def warm_clean(self, address_low, address_high, until = None):
+        if self.write_buffer is not None:
+            for address in self.write_buffer.between(address_low, address_high):
+                self._warm_drain_line(address)
+        for address in range(address_low, address_high, 2**self.line_size_width):
+            line = self.find_line(address)
+            if line is not None and line.dirty:
+                line.dirty = False
+                self.parent.warm_writeback(line.addr, 2**self.line_size_width)
+        if self.parent is not until:
+            self.parent.warm_clean(address_low, address_high, until)
         
     def _get(self, addr, prefetched = 0):
+        #next-N-line prefetch follows the chain of missing lines in a loop
+        chained = []
+        flags = None
+        saved = None
+        while True:
+            state = self._lookup(addr, prefetched)
+            if state != Cache.LOOKUP_FILL or self.prefetch is None or prefetched >= self.prefetch:
+                break
+            if self.clock is not None and saved is None:
+                saved = self.clock.save()
+            self.statistics.line_prefetch += 1
+            if self.hooks[HookEvent.PREFETCH] is not None:
+                self.hooks[HookEvent.PREFETCH].notify(addr + 2**self.line_size_width, Hook.PREFETCH)
+            #mark every event caused by the prefetch
+            if self.event_log is not None and flags is None:
+                flags = self.event_log.flags
+                self.event_log.flags |= EventLog.PREFETCH
+            addr += 2**self.line_size_width
+            prefetched += 1
+            chained.append(addr)
+        #prefetched lines are updated from the last one, as nested gets would
+        for line_addr in reversed(chained):
+            self._update(line_addr)
+        if flags is not None:
+            self.event_log.flags = flags
+        if saved is not None:
+            self.clock.restore(saved)
+        return state != Cache.LOOKUP_FAIL
+
+    #result of looking up a single line
+    LOOKUP_HIT = 0
+    LOOKUP_SWAP = 1
+    LOOKUP_FILL = 2
+    LOOKUP_FAIL = 3
+
+    def _lookup(self, addr, prefetched = 0):
+        hook_flags = Hook.PREFETCH if prefetched else 0
+        miss_kind = self.classifier.access(addr >> self.line_size_width) if self.classifier is not None else None
+        if self.reuse is not None:
+            self.reuse.access(addr >> self.line_size_width)
+        set_idx = self.get_set_idx(addr)
+        self.set_accesses[set_idx] += 1
         if addr in self: #Data found!
-            print(f"{prettydir(addr, self.address_width, self.set_width, self.line_size_width, virtualbits=self.virtual_address_width)} {prettytick} Tag 0x{self.get_tag(addr):0x} in {self.name} set 0x{self.get_set_idx(addr):0x}")
+            self._event(EventKind.HIT, addr)
             self.statistics.line_hit += 1
-            return True
+            if self.clock is not None:
+                self.mshr.hit(addr >> self.line_size_width, self.clock, self.hit_latency)
+            if self.hooks[HookEvent.HIT] is not None:
+                self.hooks[HookEvent.HIT].notify(addr, hook_flags)
+            return Cache.LOOKUP_HIT
         else: #data not found
             self.statistics.line_miss += 1
+            self.set_misses[set_idx] += 1
+            if miss_kind is not None:
+                if miss_kind == MissClassifier.COMPULSORY:
+                    self.statistics.miss_compulsory += 1
+                elif miss_kind == MissClassifier.CAPACITY:
+                    self.statistics.miss_capacity += 1
+                else:
+                    self.statistics.miss_conflict += 1
+            if self.hooks[HookEvent.MISS] is not None:
+                self.hooks[HookEvent.MISS].notify(addr, hook_flags)
             if self.victim:
                 if addr in self.victim: #data found in victim
-                    print(f"{prettydir(addr, self.address_width, self.set_width, self.line_size_width, virtualbits=self.virtual_address_width)} {prettytick} Addr 0x{addr:0x} in {self.victim.name}")
+                    self._event(EventKind.VICTIM_HIT, addr)
                     line_from_cache = self.allocate_for(addr)
                     line_from_victim = self.victim.extract(addr)
                     self.victim.write_line(line_from_cache)
                     self.write_line(line_from_victim)
-                    print(f"{prettydir(line_from_cache.addr, self.address_width, self.set_width, self.line_size_width, virtualbits=self.virtual_address_width)} {prettyright} Tag 0x{self.get_tag(line_from_cache.addr):0x} from {self.name} to {self.victim.name}")
-                    print(f"{prettydir(line_from_victim.addr, self.address_width, self.set_width, self.line_size_width, virtualbits=self.virtual_address_width)} {prettyleft} Tag 0x{self.get_tag(line_from_victim.addr):0x} from {self.victim.name} to {self.name}")
+                    self._event(EventKind.SWAP_OUT, line_from_cache.addr)
+                    self._event(EventKind.SWAP_IN, line_from_victim.addr)
                     self.statistics.victim_swap += 1
-                    return True
+                    self.statistics.bytes_victim += 2 * 2**self.line_size_width
+                    if self.clock is not None:
+                        self.clock.ready = self.clock.now + self.hit_latency + self.swap_latency
+                    if self.hooks[HookEvent.VICTIM_SWAP] is not None:
+                        self.hooks[HookEvent.VICTIM_SWAP].notify(addr, hook_flags)
+                    return Cache.LOOKUP_SWAP
                 else: #data not in victim
-                    print(f"{prettydir(addr, self.address_width, self.set_width, self.line_size_width, virtualbits=self.virtual_address_width)} {prettyfail} Tag 0x{self.get_tag(addr):0x} not in {self.name}")
-                    line_from_cache = self.allocate_for(addr)
-                    if line_from_cache.valid: #needs to go to victim cache
-                        line_from_victim = self.victim.allocate_for(line_from_cache.addr)
-                        self.victim.write_line(line_from_cache)
-                        self.statistics.victim_push += 1
-                        if line_from_victim.valid and line_from_victim.dirty: #needs to go to upper level
-                            print(f"{prettydir(line_from_victim.addr, self.address_width, self.set_width, self.line_size_width, virtualbits=self.virtual_address_width)} {prettyright} Tag 0x{self.get_tag(line_from_victim.addr):0x} from {self.victim.name} to {self.parent.name}")
-                            self.parent.write_line(line_from_victim)
-                            self.statistics.victim_evict += 1
-                        print(f"{prettydir(line_from_cache.addr, self.address_width, self.set_width, self.line_size_width, virtualbits=self.virtual_address_width)} {prettyright} Tag 0x{self.get_tag(line_from_cache.addr):0x} from {self.name} to {self.victim.name}")
+                    self._event(EventKind.VICTIM_MISS, addr)
+                    self._evict_for(addr)
 
             else: #no victim cache
-                print(f"{prettydir(addr, self.address_width, self.set_width, self.line_size_width, virtualbits=self.virtual_address_width)} {prettyfail} Tag 0x{self.get_tag(addr):0x} not in {self.name} set 0x{self.get_set_idx(addr):0x}")
-                line_from_cache = self.allocate_for(addr)
-                if line_from_cache.valid and line_from_cache.dirty:
-                    self.statistics.line_evict += 1
-                    self.parent.write_line(line_from_cache)
-                    print(f"{prettydir(line_from_cache.addr, self.address_width, self.set_width, self.line_size_width, virtualbits=self.virtual_address_width)} {prettyright} Tag 0x{self.get_tag(line_from_cache.addr):0x} from {self.name} to {self.parent.name}")
+                self._event(EventKind.MISS, addr)
+                self._evict_for(addr)
 
 
+            #a stream buffer may already hold the line
+            if self.prefetcher is not None:
+                issued = self.prefetcher.supply(self, addr)
+                if issued is not None:
+                    self._count_prefetch_use(issued)
+                    self._event(EventKind.PREFETCH_SUPPLY, addr)
+                    if self.clock is not None:
+                        self.clock.ready = self.clock.now + self.hit_latency
+                    self._write(addr, dirty=False)
+                    if self.hooks[HookEvent.FILL] is not None:
+                        self.hooks[HookEvent.FILL].notify(addr, hook_flags)
+                    return Cache.LOOKUP_FILL
+
             #ask higher level for data since we did not find it inside or in victim
             self.statistics.line_pull += 1
-            self.parent.read(addr)
-            if addr not in self.parent:
-                print("An address was requested to a memory that does not have it nor does it have a higher order memory connected")
-                return False
-            print(f"{prettydir(addr, self.address_width, self.set_width, self.line_size_width, virtualbits=self.virtual_address_width)} {prettyleft} Tag 0x{self.get_tag(addr):0x} from {self.parent.name} to {self.name} set 0x{self.get_set_idx(addr):0x}")
-            self._write(addr, dirty=False)
-
-            if self.prefetch is not None:
-                if prefetched >= self.prefetch:
-                    return True
-                else:
-                    self.statistics.line_prefetch += 1
-                    return self.get(addr + 2**self.line_size_width, prefetched + 1)
+            self.statistics.bytes_fill += 2**self.line_size_width
+            self._drain_line(addr)
+            if self.clock is not None:
+                start = self.mshr.allocate(self.clock)
+                self.clock.now += self.hit_latency
+            dirty = False
+            for part in self._parent_lines(addr):
+                dirty |= self.parent.supply(part, 2**self.line_size_width)
+            if self.clock is not None:
+                self.mshr.fill(addr >> self.line_size_width, start, self.clock.ready)
+            if self.parent.inclusion is not InclusionPolicy.EXCLUSIVE and addr not in self.parent:
+                output.write("An address was requested to a memory that does not have it nor does it have a higher order memory connected")
+                return Cache.LOOKUP_FAIL
+            self._event(EventKind.FILL, addr)
+            self._write(addr, dirty=dirty)
+            if self.hooks[HookEvent.FILL] is not None:
+                self.hooks[HookEvent.FILL].notify(addr, hook_flags)
+            return Cache.LOOKUP_FILL
+
+    #makes room for addr, pushing the outgoing line to the victim cache or writing it back
+    def _evict_for(self, addr):
+        set_idx = self.get_set_idx(addr)
+        if self.victim:
+            line_from_cache = self.allocate_for(addr)
+            if line_from_cache.valid: #needs to go to victim cache
+                self._drain_line(line_from_cache.addr)
+                self.set_evictions[set_idx] += 1
+                if self.hooks[HookEvent.EVICT] is not None:
+                    self.hooks[HookEvent.EVICT].notify(line_from_cache.addr, Hook.DIRTY if line_from_cache.dirty else 0)
+                line_from_victim = self.victim.allocate_for(line_from_cache.addr)
+                self.victim.write_line(line_from_cache)
+                self.statistics.victim_push += 1
+                self.statistics.bytes_victim += 2**self.line_size_width
+                if line_from_victim.valid and self.inclusion is InclusionPolicy.INCLUSIVE and self.children:
+                    line_from_victim.dirty |= self._back_invalidate(line_from_victim.addr)
+                #needs to go to upper level (even if clean when it is exclusive)
+                if line_from_victim.valid and (line_from_victim.dirty or self.parent.inclusion is InclusionPolicy.EXCLUSIVE):
+                    self._event(EventKind.VICTIM_EVICT, line_from_victim.addr)
+                    self.parent.writeback(line_from_victim.addr, 2**self.line_size_width, line_from_victim.dirty)
+                    self.statistics.victim_evict += 1
+                    self.statistics.bytes_writeback += 2**self.line_size_width
+                    if line_from_victim.dirty and self.hooks[HookEvent.WRITEBACK] is not None:
+                        self.hooks[HookEvent.WRITEBACK].notify(line_from_victim.addr, Hook.DIRTY)
+                self._event(EventKind.VICTIM_PUSH, line_from_cache.addr)
+        else:
+            line_from_cache = self.allocate_for(addr)
+            if line_from_cache.valid:
+                self._drain_line(line_from_cache.addr)
+                self.set_evictions[set_idx] += 1
+                if self.inclusion is InclusionPolicy.INCLUSIVE and self.children:
+                    line_from_cache.dirty |= self._back_invalidate(line_from_cache.addr)
+                if self.hooks[HookEvent.EVICT] is not None:
+                    self.hooks[HookEvent.EVICT].notify(line_from_cache.addr, Hook.DIRTY if line_from_cache.dirty else 0)
+            #an exclusive parent also takes the clean lines
+            if line_from_cache.valid and (line_from_cache.dirty or self.parent.inclusion is InclusionPolicy.EXCLUSIVE):
+                self.statistics.line_evict += 1
+                self.statistics.bytes_writeback += 2**self.line_size_width
+                self.parent.writeback(line_from_cache.addr, 2**self.line_size_width, line_from_cache.dirty)
+                self._event(EventKind.EVICT, line_from_cache.addr)
+                if line_from_cache.dirty and self.hooks[HookEvent.WRITEBACK] is not None:
+                    self.hooks[HookEvent.WRITEBACK].notify(line_from_cache.addr, Hook.DIRTY)
+
+    #an inclusive level evicts a line: the levels above lose their copies of it. Returns whether one of
+    #them was dirty, their data is then written back with the evicted line
+    def _back_invalidate(self, addr, warm = False):
+        removed = 0
+        dirty = False
+        addr -= addr % 2**self.line_size_width
+        for child in self.children:
+            (child_removed, child_dirty) = child.invalidate(addr, 2**self.line_size_width, warm)
+            removed += child_removed
+            dirty |= child_dirty
+        if not warm:
+            self.statistics.back_invalidate += removed
+        return dirty
+
+    #removes the copies of a range written by a level below, from this level and the ones above it.
+    #Pending writes of the write buffer are dropped too, they are part of the dirty data handed down
+    def invalidate(self, addr, size, warm = False):
+        removed = 0
+        dirty = False
+        for child in self.children:
+            (child_removed, child_dirty) = child.invalidate(addr, size, warm)
+            removed += child_removed
+            dirty |= child_dirty
+        if self.write_buffer is not None:
+            for address in self.write_buffer.between(addr, addr + size - 1):
+                self._keep_dirty(*self.write_buffer.pop(address), addr, size)
+                dirty = True
+        for part in covered_lines(addr, size, self.line_size_width):
+            if part in self:
+                line = self.remove(part)
+            elif self.victim and part in self.victim:
+                line = self.victim.extract(part)
             else:
-                return True        
-        
+                continue
+            removed += 1
+            if line.dirty:
+                self._keep_dirty(part - part % 2**self.line_size_width, 2**self.line_size_width, addr, size)
+                dirty = True
+            if warm:
+                continue
+            if line.prefetched:
+                self.statistics.prefetch_useless += 1
+            self.set_evictions[self.get_set_idx(part)] += 1
+            self._event(EventKind.BACK_INVALIDATE, part)
+            if self.hooks[HookEvent.EVICT] is not None:
+                self.hooks[HookEvent.EVICT].notify(line.addr, Hook.DIRTY if line.dirty else 0)
+        return (removed, dirty)
+
+    #dirty data removed from this level that falls outside the invalidated range. The next level still
+    #holds those lines, which now keep the data
+    def _keep_dirty(self, start, size, addr, range_size):
+        line_size = 2**self.parent.line_size_width
+        for part in covered_lines(start, size, self.parent.line_size_width):
+            part -= part % line_size
+            if part + line_size <= addr or part >= addr + range_size:
+                line = self.parent.find_line(part)
+                if line is not None:
+                    line.dirty = True
+
+    #lines of this level that are also held by a level above it
+    def duplicated_lines(self):
+        above = set()
+        pending = list(self.children)
+        while pending:
+            child = pending.pop()
+            pending.extend(child.children)
+            for lines in child.set_data:
+                above.update(line.addr >> self.line_size_width for line in lines if line.valid)
+        return sum(1 for lines in self.set_data for line in lines if line.valid and line.addr >> self.line_size_width in above)
+
+
+    #demand access with the prefetch engine: trains it and issues its prefetches one by one
+    def _get_prefetching(self, addr):
+        self.prefetch_clock += 1
+        line = self.find_line(addr)
+        prefetch_hit = line is not None and line.prefetched
+        if prefetch_hit:
+            line.prefetched = False
+            self._count_prefetch_use(line.prefetch_time)
+        value = self._get(addr)
+        self._update(addr)
+        flags = None
+        if self.event_log is not None:
+            flags = self.event_log.flags
+            self.event_log.flags |= EventLog.PREFETCH
+        saved = self.clock.save() if self.clock is not None else None
+        queue = deque(self.prefetcher.train(self, addr, line is None, prefetch_hit))
+        while queue:
+            self._prefetch_line(queue.popleft())
+        if flags is not None:
+            self.event_log.flags = flags
+        if saved is not None:
+            self.clock.restore(saved)
+        return value
+
+    def _count_prefetch_use(self, issued):
+        if self.prefetch_clock - issued < self.prefetcher.latency:
+            self.statistics.prefetch_late += 1
+        else:
+            self.statistics.prefetch_useful += 1
+
+    def find_line(self, addr):
+        tag = self.get_tag(addr)
+        for line in self.get_set(addr):
+            if line.valid and line.tag == tag:
+                return line
+        return None
+
+    def prefetchable(self, addr):
+        return 0 <= addr < 2**self.address_width and addr not in self and not (self.victim and addr in self.victim)
+
+    #reads a line from the parent on behalf of the prefetcher. Returns when it was issued
+    def prefetch_fetch(self, addr, kind = EventKind.PREFETCH_BUFFER):
+        self.statistics.prefetch_issued += 1
+        self.statistics.bytes_prefetch += 2**self.line_size_width
+        if self.hooks[HookEvent.PREFETCH] is not None:
+            self.hooks[HookEvent.PREFETCH].notify(addr, Hook.PREFETCH)
+        self._drain_line(addr)
+        for part in self._parent_lines(addr):
+            self.parent.read(part)
+        self._event(kind, addr)
+        return self.prefetch_clock
+
+    def _prefetch_line(self, addr):
+        if not self.prefetchable(addr):
+            return
+        self._evict_for(addr)
+        issued = self.prefetch_fetch(addr, EventKind.PREFETCH_FILL)
+        self._write(addr, dirty=False)
+        line = self.find_line(addr)
+        if line is not None:
+            line.prefetched = True
+            line.prefetch_time = issued
 
     def write_line(self, line):
         self._write(line.addr, line.dirty)
 
+    #addresses of the lines of the next level that hold one of our lines
+    def _parent_lines(self, addr):
+        return covered_lines(addr, 2**self.line_size_width, self.parent.line_size_width)
+
+    #a level above writes back a whole line, which may cover several of our lines or only part of one.
+    #Missing lines are allocated, reading the rest of the line first if it is not fully written.
+    #Above an exclusive level, clean lines are also moved down when they are evicted
+    def writeback(self, addr, size, dirty = True):
+        line_size = 2**self.line_size_width
+        for part in covered_lines(addr, size, self.line_size_width):
+            if part not in self:
+                #a copy in the victim cache is merged with the written part
+                in_victim = self.victim is not None and part in self.victim
+                if in_victim:
+                    self.victim.extract(part)
+                self._evict_for(part)
+                if size < line_size and not in_victim and self.parent is not None:
+                    self.statistics.line_pull += 1
+                    self.statistics.bytes_fill += line_size
+                    self._drain_line(part)
+                    for parent_part in self._parent_lines(part):
+                        self.parent.supply(parent_part, line_size)
+                    self._event(EventKind.FILL, part)
+            if not dirty and part in self:
+                self._update(part)
+                continue
+            self._write(part, dirty=dirty and self.write_back)
+            if dirty and not self.write_back:
+                self._forward(part, min(size, line_size))
+
     def _write(self, addr, dirty=True):
         if addr in self:
             candidate_set = self.get_set(addr)
@@ -565,12 +3278,14 @@ class Cache:
     #set last=True so the updated address goes to the last position
     def _update(self, addr, dirty=False, last=False):
         candidate_set = self.get_set(addr)
+        tag = self.get_tag(addr)
         for (i, line) in enumerate(candidate_set):
-            if line.tag == self.get_tag(addr):
+            if line.tag == tag:
+                #a later read must not clean a line that was written
+                line.dirty |= dirty
                 match self.replacement_policy:
                     case ReplacementPolicy.LRU | ReplacementPolicy.MRU:
                         elem = candidate_set.pop(i)
-                        elem.dirty = dirty
                         if last:
                             candidate_set.append(elem)
                         else:
@@ -604,8 +3319,22 @@ class Cache:
             case _:
                 raise Exception("Using an unsupported policy")
 
+        if outgoing.valid and outgoing.prefetched:
+            self.statistics.prefetch_useless += 1
         return outgoing
 
+    #takes a line out of its set. The free way goes to the end, where the next allocation takes it from,
+    #so a fill in progress in the same set keeps the way it allocated
+    def remove(self, addr):
+        candidate_set = self.get_set(addr)
+        tag = self.get_tag(addr)
+        for (i, line) in enumerate(candidate_set):
+            if line.valid and line.tag == tag:
+                candidate_set.pop(i)
+                candidate_set.append(CacheLine(0, 0, False, False))
+                return line
+        raise Exception("Did not find line for extraction")
+
     def extract(self, addr):
         candidate_set = self.get_set(addr)
         elem = None
@@ -643,28 +3372,57 @@ class Cache:
         else:
             return title + "\n".join(setstr)
         
-    def clear(self, address_low, address_high):
+    #removes the lines between two addresses, writing back the dirty ones, in every level down to until
+    def clear(self, address_low, address_high, until = None):
         if self.victim is not None:
             raise Exception("Clear function not implemented for the case where a victim is present")
         
-        #print(f"Clearing from {address_low} to {address_high}")
+        #output.write(f"Clearing from {address_low} to {address_high}")
+        if self.write_buffer is not None:
+            for address in self.write_buffer.between(address_low, address_high):
+                self._drain(address)
         
         #clear just the possible lines that contain these addresses
         for address in range(address_low, address_high, 2**self.line_size_width):
             if address in self:
                 line =  self.extract(address)
+                if line.prefetched:
+                    self.statistics.prefetch_useless += 1
                 self.statistics.line_evict += 1
+                self.set_evictions[self.get_set_idx(address)] += 1
+                if self.hooks[HookEvent.EVICT] is not None:
+                    self.hooks[HookEvent.EVICT].notify(line.addr, Hook.DIRTY if line.dirty else 0)
                 if self.parent:
                     if line.dirty:
-                        self.parent.write_line(line)
-                        print(f"{prettydir(line.addr, self.address_width, self.set_width, self.line_size_width, virtualbits=self.virtual_address_width)} {prettyup} Tag 0x{self.get_tag(line.addr):0x} from {self.name} pushed to {self.parent.name}")
+                        self.parent.writeback(line.addr, 2**self.line_size_width)
+                        self.statistics.bytes_writeback += 2**self.line_size_width
+                        self._event(EventKind.CLEAR_PUSH, line.addr)
+                        if self.hooks[HookEvent.WRITEBACK] is not None:
+                            self.hooks[HookEvent.WRITEBACK].notify(line.addr, Hook.DIRTY)
                     else:
-                        print(f"{prettydir(line.addr, self.address_width, self.set_width, self.line_size_width, virtualbits=self.virtual_address_width)} {prettytrash} Tag 0x{self.get_tag(line.addr):0x} cleared from set 0x{self.get_set_idx(line.addr):0x} @ {self.name}")
+                        self._event(EventKind.CLEAR, line.addr)
                 else:
-                    print(f"{prettydir(line.addr, self.address_width, self.set_width, self.line_size_width, virtualbits=self.virtual_address_width)} {prettytrash} Tag 0x{self.get_tag(line.addr):0x} cleared from set 0x{self.get_set_idx(line.addr):0x} @ {self.name}")
+                    self._event(EventKind.CLEAR, line.addr)
                 
-        if self.parent:
-            self.parent.clear(address_low, address_high)
+        if self.parent and self.parent is not until:
+            self.parent.clear(address_low, address_high, until)
+
+    #writes back the dirty lines between two addresses and keeps them clean, in every level down to until
+    def clean(self, address_low, address_high, until = None):
+        if self.write_buffer is not None:
+            for address in self.write_buffer.between(address_low, address_high):
+                self._drain(address)
+        for address in range(address_low, address_high, 2**self.line_size_width):
+            line = self.find_line(address)
+            if line is not None and line.dirty:
+                line.dirty = False
+                self.parent.writeback(line.addr, 2**self.line_size_width)
+                self.statistics.bytes_writeback += 2**self.line_size_width
+                self._event(EventKind.CLEAR_PUSH, line.addr)
+                if self.hooks[HookEvent.WRITEBACK] is not None:
+                    self.hooks[HookEvent.WRITEBACK].notify(line.addr, Hook.DIRTY)
+        if self.parent is not until:
+            self.parent.clean(address_low, address_high, until)
                 
         
         
@@ -674,13 +3432,85 @@ class Cache:
         self._write(address, dirty=False) #no questions asked above. When calling this function address should not be in this memory
 
     def show_statistics(self):
-        print(f"{self.statistics.get_statistics(show_prefetch=self.prefetch, show_victim=self.victim is not None, show_wt=not self.write_allocate)}")
+        pending = len(self.write_buffer) if self.write_buffer is not None else None
+        show_inclusion = self.inclusion is InclusionPolicy.INCLUSIVE and len(self.children) > 0
+        output.write(f"{self.statistics.get_statistics(show_prefetch=self.prefetch, show_victim=self.victim is not None, show_wt=not self.write_allocate or not self.write_back, show_3c=self.classifier is not None, show_prefetcher=self.prefetcher is not None, buffer_pending=pending, show_inclusion=show_inclusion)}")
     
     def show_costs(self):
-        print(f"{self.statistics.get_cost(show_through=not self.write_allocate)}")
+        output.write(f"{self.statistics.get_cost(show_through=not self.write_allocate)}")
+
+    def stats_dict(self, kind="cache", owner=None):
+        stats = {"name": self.name, "kind": kind, "sets": 2**self.set_width, "ways": 2**self.way_width, "line_size": 2**self.line_size_width}
+        if owner is not None:
+            stats["owner"] = owner
+        if self.prefetcher is not None:
+            stats["prefetcher"] = self.prefetcher.describe()
+        if self.write_buffer is not None:
+            stats["write_buffer"] = {"entries": self.write_buffer.entries, "pending": len(self.write_buffer)}
+        stats.update(self.statistics.as_dict())
+        stats["latency"] = self.latency_total()
+        if self.reuse is not None:
+            stats["reuse_cold"] = self.reuse.cold
+            stats["reuse_histogram"] = self.reuse.histogram.tolist()
+        return stats
+
+    def show_reuse(self):
+        if self.reuse is None:
+            output.write("Reuse distance not tracked for this level")
+            return
+        histogram = self.reuse.histogram
+        number_of_lines = 2**(self.set_width + self.way_width)
+        total = int(histogram.sum())
+        last = int(np.nonzero(histogram)[0].max()) if total > 0 else 0
+        peak = max(int(histogram.max()), 1)
+        for bucket in range(last + 1):
+            low = 0 if bucket == 0 else 2**(bucket - 1)
+            high = 0 if bucket == 0 else 2**bucket - 1
+            fits = (high < number_of_lines)
+            label = f"{low}" if low == high else f"{low}-{high}"
+            bar = "█" * int(round(30 * histogram[bucket] / peak))
+            output.write(f"{label:>13} {Fore.GREEN if fits else Fore.RED}{bar:<30}{Style.RESET_ALL} {histogram[bucket]}")
+        output.write(f"Reuses: {Fore.YELLOW}{total}{Style.RESET_ALL}, cold: {Fore.YELLOW}{self.reuse.cold}{Style.RESET_ALL}. "
+                     f"{Fore.GREEN}{100 * self.reuse.fraction_within(number_of_lines):.2f}%{Style.RESET_ALL} of the reuses fit in the {number_of_lines} lines of {self.name}")
+
+    #one character per set, from cold to hot
+    HEAT_SHADES = " ░▒▓█"
+
+    def show_heatmap(self, counter = "misses", width = 64, top = 8, max_rows = 16):
+        values = {"accesses": self.set_accesses, "misses": self.set_misses, "evictions": self.set_evictions}[counter]
+        #with many sets every character covers a power of two of consecutive sets
+        group = 1
+        while len(values) // group > width * max_rows:
+            group *= 2
+        binned = values.reshape(-1, group).sum(axis=1)
+        peak = int(binned.max())
+        shades = Cache.HEAT_SHADES
+        if peak > 0:
+            levels = np.ceil(binned * (len(shades) - 1) / peak).astype(int)
+        else:
+            levels = np.zeros(len(binned), dtype=int)
+        if group > 1:
+            output.write(f"Each character covers {group} sets")
+        for start in range(0, len(binned), width):
+            row = "".join(shades[level] for level in levels[start:start + width])
+            output.write(f"0x{start * group:04x} {Fore.RED}{row}{Style.RESET_ALL}")
+        total = int(values.sum())
+        hottest = np.argsort(values, kind='stable')[::-1][:top]
+        hottest = [i for i in hottest if values[i] > 0]
+        share = f"{100 * values[hottest].sum() / total:.2f}%" if total > 0 else "0%"
+        output.write(f"{counter.capitalize()}: {Fore.YELLOW}{total}{Style.RESET_ALL} over {len(values)} sets. Hottest sets hold {Fore.RED}{share}{Style.RESET_ALL}: " +
+                     ", ".join(f"0x{i:0x} ({values[i]})" for i in hottest))
+
+    def heatmap_arrays(self):
+        return {"accesses": self.set_accesses.copy(), "misses": self.set_misses.copy(), "evictions": self.set_evictions.copy()}
 
     def reset_statistics(self):
         self.statistics.reset()
+        if self.reuse is not None:
+            self.reuse.reset()
+        self.set_accesses[:] = 0
+        self.set_misses[:] = 0
+        self.set_evictions[:] = 0
         
     def reset_costs(self, cost_hit, cost_miss, cost_through, cost_access):
         self.statistics.cost_hit = cost_hit
@@ -688,9 +3518,401 @@ class Cache:
         self.statistics.cost_through = cost_through
         self.statistics.cost_access = cost_access
 
+    def set_latency(self, hit_latency, through_latency = 0, swap_latency = 1):
+        self.hit_latency = hit_latency
+        self.through_latency = through_latency
+        self.swap_latency = swap_latency
 
+    #misses are not charged here: their latency is that of the next level
+    def latency_total(self):
+        stats = self.statistics
+        #writes to the parent only wait when the write buffer is full
+        through = stats.buffer_stall if self.write_buffer is not None else stats.write_through + stats.write_forward
+        return self.hit_latency * (stats.read_hit + stats.read_miss + stats.write_hit + stats.write_miss + stats.write_through) + \
+            self.through_latency * through + self.swap_latency * stats.victim_swap
+
+
+
+#one record per access of a trace
+TRACE_DTYPE = np.dtype([('addr', '<u8'), ('write', 'u1')])
+
+#traces may also give the size of every access. Size 0 is an access of unknown size
+SIZED_TRACE_DTYPE = np.dtype([('addr', '<u8'), ('write', 'u1'), ('size', '<u4')])
+
+def trace_sizes(records):
+    if 'size' not in records.dtype.names:
+        return [None] * len(records)
+    return [size or None for size in records['size'].tolist()]
+
+#lines of 2**width bytes holding the aligned block of size bytes around addr. A block
+#within a single line is represented by addr itself
+def covered_lines(addr, size, width):
+    if size <= 2**width:
+        return (addr,)
+    base = addr - addr % size
+    return range(base, base + size, 2**width)
+
+#pieces (address, size) of an access, one per aligned block of 2**width bytes it touches
+def split_access(addr, size, width):
+    pieces = []
+    end = addr + size
+    while addr < end:
+        block_end = ((addr >> width) + 1) << width
+        pieces.append((addr, min(end, block_end) - addr))
+        addr = block_end
+    return pieces
+
+def parse_address(text):
+    try:
+        return int(text, 10)
+    except ValueError:
+        return int(text, 16)
+
+#(address, write, size) of the fields of a text trace line, "address" or "R|W address [size]"
+def parse_trace_fields(fields):
+    if len(fields) == 1:
+        return (parse_address(fields[0]), False, 0)
+    if len(fields) in (2, 3) and fields[0].upper() in ('R', 'W'):
+        return (parse_address(fields[1]), fields[0].upper() == 'W', parse_address(fields[2]) if len(fields) == 3 else 0)
+    raise ValueError()
+
+#files read by the commands run so far (traces, streams and scripts), which their results depend on
+input_files = {}
+
+def track_input(filename):
+    input_files[os.path.abspath(filename)] = True
+
+#.npy files hold TRACE_DTYPE records (or plain addresses, all reads) and are memory mapped.
+#Text files have one "[R|W] address" per line, # starts a comment
+def load_trace(filename):
+    track_input(filename)
+    if filename.endswith('.npy'):
+        data = np.load(filename, mmap_mode='r')
+        if data.dtype == TRACE_DTYPE or data.dtype == SIZED_TRACE_DTYPE:
+            return data
+        sized = data.dtype.names is not None and 'size' in data.dtype.names
+        #per core traces may be interleaved by the time of their records
+        timed = data.dtype.names is not None and 'time' in data.dtype.names
+        dtype = SIZED_TRACE_DTYPE if sized else TRACE_DTYPE
+        if timed:
+            dtype = np.dtype(dtype.descr + [('time', '<u8')])
+        trace = np.zeros(len(data), dtype=dtype)
+        if data.dtype.names is None:
+            trace['addr'] = data
+        else:
+            trace['addr'] = data['addr']
+            if 'write' in data.dtype.names:
+                trace['write'] = data['write']
+            if sized:
+                trace['size'] = data['size']
+            if timed:
+                trace['time'] = data['time']
+        return trace
+    addrs = []
+    writes = []
+    sizes = []
+    with open(filename) as f:
+        for number, line in enumerate(f, 1):
+            fields = line.split('#')[0].split()
+            if not fields:
+                continue
+            try:
+                (addr, write, size) = parse_trace_fields(fields)
+                addrs.append(addr)
+                writes.append(write)
+                sizes.append(size)
+            except ValueError:
+                raise Exception(f"Invalid trace line {number} in {filename}: {line.strip()}")
+    trace = np.zeros(len(addrs), dtype=SIZED_TRACE_DTYPE if any(sizes) else TRACE_DTYPE)
+    trace['addr'] = addrs
+    trace['write'] = writes
+    if any(sizes):
+        trace['size'] = sizes
+    return trace
+
+def save_trace(filename, trace):
+    sized = trace.dtype.names is not None and 'size' in trace.dtype.names
+    np.save(filename, np.asarray(trace, dtype=SIZED_TRACE_DTYPE if sized else TRACE_DTYPE))
+
+#one record per request a level sent to the next one. kind is one of the StreamRecorder kinds,
+#plus StreamRecorder.WARM for the requests sent in fast forward mode. Size 0 is an unknown size
+STREAM_DTYPE = np.dtype([('addr', '<u8'), ('size', '<u4'), ('kind', 'u1')])
+
+#stands in for the next level of a cache, recording every request the cache sends to it in order:
+#demand fills, prefetches, writes and write backs. Anything else is looked up in the next level
+class StreamRecorder:
+    READ, SUPPLY, WRITE, WRITEBACK, CLEAN_WRITEBACK = range(5)
+    WARM = 0x80
+    #records are kept in python lists until there are this many
+    CHUNK = 2**16
+
+    def __init__(self, level):
+        self.level = level
+        self.parent = level.parent
+        self.chunks = []
+        self.addrs = []
+        self.sizes = []
+        self.kinds = []
+
+    def __getattr__(self, name):
+        return getattr(self.parent, name)
+
+    def __contains__(self, key):
+        return key in self.parent
+
+    def _record(self, addr, size, kind):
+        self.addrs.append(addr)
+        self.sizes.append(size or 0)
+        self.kinds.append(kind)
+        if len(self.addrs) >= StreamRecorder.CHUNK:
+            self._flush()
+
+    def _flush(self):
+        chunk = np.zeros(len(self.addrs), dtype=STREAM_DTYPE)
+        chunk['addr'] = self.addrs
+        chunk['size'] = self.sizes
+        chunk['kind'] = self.kinds
+        self.chunks.append(chunk)
+        self.addrs, self.sizes, self.kinds = [], [], []
+
+    def __len__(self):
+        return sum(len(chunk) for chunk in self.chunks) + len(self.addrs)
+
+    def stream(self):
+        self._flush()
+        return np.concatenate(self.chunks)
+
+    def read(self, addr):
+        self._record(addr, 0, StreamRecorder.READ)
+        return self.parent.read(addr)
+
+    def supply(self, addr, size):
+        self._record(addr, size, StreamRecorder.SUPPLY)
+        return self.parent.supply(addr, size)
+
+    def write(self, addr, size = None):
+        self._record(addr, size, StreamRecorder.WRITE)
+        return self.parent.write(addr, size)
+
+    def writeback(self, addr, size, dirty = True):
+        self._record(addr, size, StreamRecorder.WRITEBACK if dirty else StreamRecorder.CLEAN_WRITEBACK)
+        return self.parent.writeback(addr, size, dirty)
+
+    def warm_read(self, addr):
+        self._record(addr, 0, StreamRecorder.READ | StreamRecorder.WARM)
+        return self.parent.warm_read(addr)
+
+    def warm_supply(self, addr, size):
+        self._record(addr, size, StreamRecorder.SUPPLY | StreamRecorder.WARM)
+        return self.parent.warm_supply(addr, size)
+
+    def warm_write(self, addr, size = None):
+        self._record(addr, size, StreamRecorder.WRITE | StreamRecorder.WARM)
+        return self.parent.warm_write(addr, size)
+
+    def warm_writeback(self, addr, size, dirty = True):
+        self._record(addr, size, (StreamRecorder.WRITEBACK if dirty else StreamRecorder.CLEAN_WRITEBACK) | StreamRecorder.WARM)
+        return self.parent.warm_writeback(addr, size, dirty)
+
+def save_stream(filename, stream):
+    np.save(filename, np.asarray(stream, dtype=STREAM_DTYPE))
+
+def load_stream(filename):
+    track_input(filename)
+    stream = np.load(filename, mmap_mode='r')
+    if stream.dtype != STREAM_DTYPE:
+        raise Exception(f"{filename} is not a recorded request stream")
+    return stream
+
+
+#Simulates only a hash selected fraction of the sets. The selection uses address bits that are
+#part of the set index of every cache, so a sampled access only ever touches sampled sets
+#(victim caches are shared by all sets, so their estimates are biased).
+#Hit rates are estimated per level as a ratio over the sampled sets (cluster sampling)
+class SetSampler:
+    MAX_GROUP_BITS = 20
+
+    def __init__(self, caches, ratio, seed = 0):
+        if not caches:
+            raise Exception("Set sampling needs at least one cache level")
+        if ratio < 1:
+            raise Exception("The sampling ratio must be at least 1")
+        low = max(cache.line_size_width for cache in caches)
+        high = min(cache.line_size_width + cache.set_width for cache in caches)
+        if high - low < 0 or 2**(high - low) < ratio:
+            raise Exception(f"Sampling 1/{ratio} of the sets needs {math.ceil(math.log2(ratio))} set index bits shared by every cache, only {max(high - low, 0)} are")
+        self.caches = caches
+        self.ratio = ratio
+        self.seed = seed
+        self.shift = low
+        self.bits = min(high - low, SetSampler.MAX_GROUP_BITS)
+        #keep the groups with the smallest hash so the fraction is exact
+        groups = np.arange(2**self.bits, dtype=np.uint64)
+        hashed = (groups + np.uint64(seed)) * np.uint64(0x9E3779B97F4A7C15)
+        hashed ^= hashed >> np.uint64(29)
+        chosen = np.argsort(hashed, kind='stable')[:2**self.bits // ratio]
+        self.selected = np.zeros(2**self.bits, dtype=bool)
+        self.selected[chosen] = True
+        self.fraction = len(chosen) / 2**self.bits
+        self.reset()
+
+    def reset(self):
+        self.accesses = 0
+        self.simulated = 0
+
+    #boolean mask of the addresses that map to sampled sets
+    def filter(self, addrs, count = True):
+        groups = (np.asarray(addrs, dtype=np.uint64) >> np.uint64(self.shift)) & np.uint64(2**self.bits - 1)
+        mask = self.selected[groups]
+        if count:
+            self.accesses += len(mask)
+            self.simulated += int(np.count_nonzero(mask))
+        return mask
+
+    def sampled_sets(self, cache):
+        groups = (np.arange(2**cache.set_width) >> (self.shift - cache.line_size_width)) & (2**self.bits - 1)
+        return self.selected[groups]
+
+    #line hit rate with the half width of its 95% confidence interval, and the counters scaled to the whole trace
+    def estimate(self, cache):
+        sampled = self.sampled_sets(cache)
+        accesses = cache.set_accesses[sampled]
+        hits = accesses - cache.set_misses[sampled]
+        total = int(accesses.sum())
+        rate = int(hits.sum()) / total if total > 0 else 0.0
+        margin = None
+        if len(accesses) > 1 and total > 0:
+            mean = total / len(accesses)
+            variance = (1 - self.fraction) * float(np.sum((hits - rate * accesses)**2)) / (len(accesses) - 1) / (len(accesses) * mean**2)
+            margin = 1.96 * math.sqrt(variance)
+        counters = {name: round(value / self.fraction) for (name, value) in cache.statistics.get_counters().items()}
+        return {"name": cache.name, "sampled_sets": int(np.count_nonzero(sampled)),
+                "line_hit_rate": rate, "line_hit_rate_margin": margin, "estimated": counters}
+
+    def report(self):
+        return {"ratio": self.ratio, "seed": self.seed, "fraction": self.fraction,
+                "accesses": self.accesses, "simulated": self.simulated,
+                "levels": [self.estimate(cache) for cache in self.caches]}
+
+    def show(self):
+        output.write(f"{Fore.BLUE}{Back.GREEN}Sampling{Style.RESET_ALL}")
+        output.write(f"Simulated {Fore.YELLOW}{self.simulated}{Style.RESET_ALL} of {Fore.YELLOW}{self.accesses}{Style.RESET_ALL} trace accesses ({100 * self.fraction:.2f}% of the sets)")
+        for estimate in (self.estimate(cache) for cache in self.caches):
+            margin = f"± {100 * estimate['line_hit_rate_margin']:.2f}" if estimate['line_hit_rate_margin'] is not None else "(no interval)"
+            counters = estimate["estimated"]
+            output.write(f"{estimate['name']}: block hit rate {Fore.GREEN}{100 * estimate['line_hit_rate']:.2f} {margin}{Style.RESET_ALL} (95%). "
+                         f"Estimated {Fore.GREEN}{counters['line_hit']}{Style.RESET_ALL} hits and {Fore.RED}{counters['line_miss']}{Style.RESET_ALL} misses, "
+                         f"{prettyup}{counters['line_evict']} written back")
+
+
+#Fully associative victim cache. Lines are kept in a hash map by block number whose order is the
+#recency (most recent first), so probing, inserting, extracting and evicting never scan the lines
+class VictimBuffer(Observable):
+
+    def __init__(self, name, way_width, line_size_width, replacement_policy = ReplacementPolicy.LRU, address_width = 32, virtual_address_width = 0):
+        self.name = name
+        self.set_width = 0
+        self.way_width = way_width
+        self.line_size_width = line_size_width
+        self.replacement_policy = replacement_policy
+        self.capacity = 2**way_width
+        self.address_width = address_width
+        self.virtual_address_width = virtual_address_width
+        self.statistics = CacheStatistics()
+        self.event_log = None
+        self.event_id = 0
+        self.narrate = True
+        self.init_hooks()
+        self.lines = OrderedDict()
+
+    #the cache that owns the buffer accounts for the time of its lookups
+    def enable_timing(self, clock):
+        pass
+
+    def get_block(self, addr):
+        return addr >> self.line_size_width
+
+    def get_set_idx(self, addr):
+        return 0
+
+    def get_tag(self, addr):
+        return addr >> self.line_size_width
+
+    def __contains__(self, key):
+        return (key >> self.line_size_width) in self.lines
+
+    #can return an invalid line when there is free space
+    def allocate_for(self, addr, force = False):
+        if addr in self and not force:
+            raise Exception("Cannot allocate for already existing address")
+        if len(self.lines) < self.capacity:
+            return CacheLine(0, 0, False, False)
+        match self.replacement_policy:
+            case ReplacementPolicy.FIFO | ReplacementPolicy.LRU:
+                block, outgoing = self.lines.popitem(last = True)
+            case ReplacementPolicy.MRU:
+                block, outgoing = self.lines.popitem(last = False)
+            case ReplacementPolicy.RANDOM:
+                block = next(islice(self.lines, int(rng.integers(len(self.lines))), None))
+                outgoing = self.lines.pop(block)
+            case _:
+                raise Exception("Using an unsupported policy")
+        return outgoing
+
+    def write_line(self, line):
+        if not line.valid:
+            return
+        block = line.addr >> self.line_size_width
+        if block in self.lines:
+            self.lines[block].dirty |= line.dirty
+        else:
+            if len(self.lines) >= self.capacity:
+                raise Exception(f"No space left in {self.name}")
+            self.lines[block] = CacheLine(line.addr, block, valid=True, dirty=line.dirty)
+        self.lines.move_to_end(block, last = False)
+
+    def extract(self, addr):
+        line = self.lines.pop(addr >> self.line_size_width, None)
+        if line is None:
+            raise Exception("Did not find line for extraction")
+        return line
+
+    def render_event(self, kind, addr, set_idx, aux):
+        raise Exception(f"Event {kind.name} not supported by a victim buffer")
+
+    def __str__(self):
+        lines = list(self.lines.values()) + [CacheLine(0, 0, False, False) for i in range(self.capacity - len(self.lines))]
+        hex_fmt = '0' + str((self.address_width + 3) // 4) + 'x'
+        linestr = []
+        for line in lines:
+            base_addr = line.tag * 2**self.line_size_width if line.valid else 0
+            high_addr = base_addr + 2**(self.line_size_width) - 1 if line.valid else 0
+            linestr.append(f"{line.prettyprint(self.address_width - self.line_size_width)}{prettydir(0, self.line_size_width, 0, self.line_size_width, brackets=False)} [{Fore.YELLOW if line.valid else Fore.BLACK}0x{format(base_addr, hex_fmt)}-0x{format(high_addr, hex_fmt)}{Style.RESET_ALL}]")
+        printwidth = (11+self.address_width+2*((self.address_width + 3) // 4))
+        return f"{'-'*printwidth}\n" + "\n".join(linestr)
+
+    def show_statistics(self):
+        output.write(f"{self.statistics.get_statistics(show_prefetch=False, show_victim=False, show_wt=False)}")
+
+    def show_costs(self):
+        output.write(f"{self.statistics.get_cost(show_through=False)}")
+
+    def stats_dict(self, kind="victim", owner=None):
+        stats = {"name": self.name, "kind": kind, "sets": 1, "ways": self.capacity, "line_size": 2**self.line_size_width}
+        if owner is not None:
+            stats["owner"] = owner
+        stats.update(self.statistics.as_dict())
+        return stats
+
+    def reset_statistics(self):
+        self.statistics.reset()
+
+    def reset_costs(self, cost_hit, cost_miss, cost_through, cost_access):
+        self.statistics.cost_hit = cost_hit
+        self.statistics.cost_miss = cost_miss
+        self.statistics.cost_through = cost_through
+        self.statistics.cost_access = cost_access
 
-import cmd2
 
 class Cacheasy(cmd2.Cmd):
     """Command processor for the Cacheasy App"""
@@ -706,13 +3928,40 @@ class Cacheasy(cmd2.Cmd):
         self.replacement_policy = ReplacementPolicy.LRU
         self.write_back = True
         self.write_allocate = True
+        self.write_buffer = 0
+        self.mshrs = 0
         self.prefetch = 0
+        self.classify = False
+        self.reuse = False
+        self.prefetcher = ['none']
+        self.prefetch_latency = 8
+        self.page_policy = PagePolicy.LRU
+        self.page_interval = 64
+        self.page_walk = None
+        self.dram = None
+        #file of the request stream being recorded
+        self.record_file = None
+        #live ingestion, which simulates in the background
+        self.live = None
         
         self.cost_hit = 0
         self.cost_miss = 200
         self.cost_through = 50
         self.cost_access = 1
+
+        self.latency_hit = 1
+        self.latency_through = 0
+        self.latency_swap = 1
+        self.latency_memory = 100
+
+        self.narrate = True
         super().__init__()
+        #a failing command skips postcmd, so flush once more when it finishes
+        self.register_cmdfinalization_hook(self._flush_output)
+
+    def _flush_output(self, data: cmd2.plugin.CommandFinalizationData) -> cmd2.plugin.CommandFinalizationData:
+        output.flush()
+        return data
         
 
         
@@ -730,13 +3979,14 @@ class Cacheasy(cmd2.Cmd):
         return result
     
     def do_read(self, args):
-        """read <address> [final_address] [word_size]
+        """read <address> [final_address] [word_size] [access_size]
         Requests a read from memory. If final address 
         is specified, it reads the whole range (inclusive).
         If word_size is specified, the requests are performed
-        only for multiples of that size"""
+        only for multiples of that size. Each request accesses
+        access_size bytes if given, touching every line they span"""
         if not args:
-            print("An address must be specified")
+            output.write("An address must be specified")
         
         parsed_args = [self.parse_number(s) for s in args.split()]
 
@@ -746,17 +3996,20 @@ class Cacheasy(cmd2.Cmd):
             self.memsys.read(parsed_args[0], parsed_args[1])
         elif len(parsed_args) == 3:
             self.memsys.read(parsed_args[0], parsed_args[1], parsed_args[2])
+        elif len(parsed_args) == 4:
+            self.memsys.read(parsed_args[0], parsed_args[1], parsed_args[2], size = parsed_args[3])
         else:
-            print("Too many args")
+            output.write("Too many args")
             
     def do_write(self, args):
-        """write <address> [final_address] [word_size]
+        """write <address> [final_address] [word_size] [access_size]
         Requests a write to memory. If final address 
         is specified, it writes the whole range (inclusive).
         If word_size is specified, the requests are performed
-        only for multiples of that size"""
+        only for multiples of that size. Each request accesses
+        access_size bytes if given, touching every line they span"""
         if not args:
-            print("An address must be specified")
+            output.write("An address must be specified")
         
         parsed_args = [self.parse_number(s) for s in args.split()]
 
@@ -766,43 +4019,305 @@ class Cacheasy(cmd2.Cmd):
             self.memsys.write(parsed_args[0], parsed_args[1])
         elif len(parsed_args) == 3:
             self.memsys.write(parsed_args[0], parsed_args[1], parsed_args[2])
+        elif len(parsed_args) == 4:
+            self.memsys.write(parsed_args[0], parsed_args[1], parsed_args[2], size = parsed_args[3])
         else:
-            print("Too many args")
+            output.write("Too many args")
 
     def do_show_config(self, args):
-        print(f"Address width: {self.address_width}")
-        print(f"Set width: {self.set_width}")
-        print(f"Way width: {self.way_width}")
-        print(f"Line size width: {self.line_size_width}")
-        print(f"Memory name: {self.memory_name}")
-        print(f"Memory policy: {self.replacement_policy}")
-        print(f"Write back: {self.write_back}")
-        print(f"Write allocate: {self.write_allocate}")
-        print(f"Prefetch blocks: {self.prefetch}")
+        output.write(f"Address width: {self.address_width}")
+        output.write(f"Set width: {self.set_width}")
+        output.write(f"Way width: {self.way_width}")
+        output.write(f"Line size width: {self.line_size_width}")
+        output.write(f"Memory name: {self.memory_name}")
+        output.write(f"Memory policy: {self.replacement_policy}")
+        output.write(f"Write back: {self.write_back}")
+        output.write(f"Write allocate: {self.write_allocate}")
+        output.write(f"Write buffer: {self.write_buffer}")
+        output.write(f"MSHRs: {self.mshrs}")
+        output.write(f"Prefetch blocks: {self.prefetch}")
+        output.write(f"Classify misses: {self.classify}")
+        output.write(f"Reuse distance: {self.reuse}")
+        output.write(f"Prefetcher: {' '.join(self.prefetcher)} (latency {self.prefetch_latency})")
+        output.write(f"Page policy: {self.page_policy.name} (interval {self.page_interval})")
+        output.write(f"Page walk: {self.page_walk}")
+        output.write(f"DRAM: {self.dram}")
+        output.write(f"Latency: {self.latency_hit} hit, {self.latency_through} write through, {self.latency_swap} victim swap, {self.latency_memory} memory")
+
+    show_state_parser = cmd2.Cmd2ArgumentParser(description="Show the contents and statistics of every level")
+    show_state_parser.add_argument('mode', nargs='?', choices=['stats'], help="only show the statistics")
+    show_state_parser.add_argument('-f', '--format', choices=['text', 'json', 'csv'], default='text', help="json and csv print plain statistics, without colours")
 
+    @cmd2.with_argparser(show_state_parser)
     def do_show_state(self, args):
-        print(f"{Fore.GREEN}{Back.BLUE}Memory State{Style.RESET_ALL}")
-        self.memsys.show_state(only_stats=args == "stats")
+        """show_state [stats] [--format text|json|csv]
+        Shows the contents and statistics of the memory system.
+        With json or csv only the statistics are printed, as plain data"""
+        if args.format == 'json':
+            output.write(json.dumps(self.memsys.stats_dict(), indent=2))
+        elif args.format == 'csv':
+            buffer = io.StringIO()
+            write_stats_csv(buffer, stats_rows(self.memsys.stats_dict()))
+            output.write(buffer.getvalue().rstrip("\n"))
+        else:
+            output.write(f"{Fore.GREEN}{Back.BLUE}Memory State{Style.RESET_ALL}")
+            self.memsys.show_state(only_stats=args.mode == "stats")
         
+    def do_show_reuse(self, args):
+        """show_reuse [level]
+        Shows the reuse distance histogram (log2 buckets) of every cache
+        tracking it. Reuses that fit in the level are shown in green"""
+        if self.memsys is None:
+            output.write("Initialize memory first")
+            return
+        memsys = self.memsys.memory_system if isinstance(self.memsys, VirtualMemory) else self.memsys
+        for level in memsys.levels:
+            if getattr(level, 'reuse', None) is None or (args and level.name != args.strip()):
+                continue
+            output.write(f"{Fore.BLUE}{Back.GREEN}{level.name}{Style.RESET_ALL}")
+            level.show_reuse()
+
+    show_heatmap_parser = cmd2.Cmd2ArgumentParser(description="Show per set counters of every cache as a heat map")
+    show_heatmap_parser.add_argument('level', nargs='?', help="only this cache")
+    show_heatmap_parser.add_argument('-c', '--counter', choices=['accesses', 'misses', 'evictions'], default='misses', help="counter to draw")
+    show_heatmap_parser.add_argument('-w', '--width', type=int, default=64, help="sets per row")
+    show_heatmap_parser.add_argument('-e', '--export', default=None, help="write the per set arrays of every cache to a .npz or .csv file")
+
+    @cmd2.with_argparser(show_heatmap_parser)
+    def do_show_heatmap(self, args):
+        """show_heatmap [level] [-c accesses|misses|evictions] [-w width] [-e file]
+        Draws one character per set, darker for hotter sets, and
+        lists the hottest ones"""
+        if self.memsys is None:
+            output.write("Initialize memory first")
+            return
+        memsys = self.memsys.memory_system if isinstance(self.memsys, VirtualMemory) else self.memsys
+        caches = [level for level in memsys.all_levels() if isinstance(level, Cache) and (args.level is None or level.name == args.level)]
+        for cache in caches:
+            output.write(f"{Fore.BLUE}{Back.GREEN}{cache.name}{Style.RESET_ALL}")
+            cache.show_heatmap(counter = args.counter, width = max(1, args.width))
+        if args.export is not None:
+            arrays = {f"{cache.name}_{counter}": values for cache in caches for (counter, values) in cache.heatmap_arrays().items()}
+            if args.export.endswith('.csv'):
+                with open(args.export, 'w', newline='') as f:
+                    writer = csv.writer(f)
+                    writer.writerow(['level', 'set', 'accesses', 'misses', 'evictions'])
+                    for cache in caches:
+                        for i in range(2**cache.set_width):
+                            writer.writerow([cache.name, i, cache.set_accesses[i], cache.set_misses[i], cache.set_evictions[i]])
+            else:
+                np.savez(args.export, **arrays)
+            output.write(f"{Fore.BLUE}Heat map written to {args.export}{Style.RESET_ALL}")
+
+    trace_parser = cmd2.Cmd2ArgumentParser(description="Run the accesses of a trace file through the memory system")
+    trace_parser.add_argument('file', nargs='+', help=".npy file of (addr, write) records or plain addresses, or text file with one '[R|W] address' per line. One per core with several cores")
+    trace_parser.add_argument('-n', '--limit', type=int, default=None, help="only run the first accesses (of each trace)")
+    trace_parser.add_argument('-o', '--order', choices=['round_robin', 'time'], default='round_robin', help="how the traces of the cores are interleaved")
+
+    @cmd2.with_argparser(trace_parser)
+    def do_trace(self, args):
+        """trace <file...> [-n limit] [-o round_robin|time]
+        Runs every access of a trace. With sampling enabled, only
+        the accesses to the sampled sets are simulated. With several
+        cores, one trace per core is interleaved one access at a time
+        or by the time field of their records"""
+        if self.memsys is None:
+            output.write("Initialize memory first")
+            return
+        try:
+            traces = [load_trace(file) for file in args.file]
+        except Exception as e:
+            output.write(str(e))
+            return
+        if args.limit is not None:
+            traces = [trace[:args.limit] for trace in traces]
+        start = time.perf_counter()
+        try:
+            if len(traces) == 1:
+                self.memsys.run_trace(traces[0])
+            else:
+                if not isinstance(self.memsys, MemorySystem):
+                    raise Exception("One trace per core is needed")
+                self.memsys.run_core_traces(traces, args.order)
+        except Exception as e:
+            output.write(str(e))
+            return
+        output.write(f"{Fore.BLUE}Ran {sum(len(trace) for trace in traces)} accesses in {time.perf_counter() - start:.3f}s{Style.RESET_ALL}")
+        sampler = getattr(self.memsys, 'sampler', None)
+        if sampler is not None:
+            sampler.show()
+
+    def do_record(self, args):
+        """record <cache> <file>|off
+        Records every request the cache sends to the next level
+        (fills, prefetches, writes and write backs) until 'record
+        off', which saves them to the file for 'replay'"""
+        if self.memsys is None:
+            output.write("Initialize memory first")
+            return
+        fields = args.split()
+        try:
+            if not isinstance(self.memsys, MemorySystem):
+                raise Exception("Streams can't be recorded with virtual memory")
+            if fields == ['off']:
+                stream = self.memsys.stop_recording()
+                save_stream(self.record_file, stream)
+                output.write(f"{Fore.BLUE}Saved {len(stream)} requests to {self.record_file}{Style.RESET_ALL}")
+                self.record_file = None
+                return
+            if len(fields) != 2:
+                raise Exception("Usage: record <cache> <file>|off")
+            self.memsys.record_stream(fields[0])
+        except Exception as e:
+            output.write(str(e))
+            return
+        self.record_file = fields[1]
+        output.write(f"{Fore.BLUE}Recording the requests of {fields[0]}{Style.RESET_ALL}")
+
+    replay_parser = cmd2.Cmd2ArgumentParser(description="Send a recorded request stream to the top level of the memory system")
+    replay_parser.add_argument('file', help=".npy file saved by 'record'")
+    replay_parser.add_argument('-n', '--limit', type=int, default=None, help="only replay the first requests")
+
+    @cmd2.with_argparser(replay_parser)
+    def do_replay(self, args):
+        """replay <file> [-n limit]
+        Sends the requests recorded from a cache to the top level,
+        as if that cache were above it. Sweeps of the lower levels
+        do not simulate the recorded cache again"""
+        if self.memsys is None:
+            output.write("Initialize memory first")
+            return
+        start = time.perf_counter()
+        try:
+            if not isinstance(self.memsys, MemorySystem):
+                raise Exception("Streams can't be replayed with virtual memory")
+            stream = load_stream(args.file)
+            if args.limit is not None:
+                stream = stream[:args.limit]
+            self.memsys.replay_stream(stream)
+        except Exception as e:
+            output.write(str(e))
+            return
+        output.write(f"{Fore.BLUE}Replayed {len(stream)} requests in {time.perf_counter() - start:.3f}s{Style.RESET_ALL}")
+
+    live_parser = cmd2.Cmd2ArgumentParser(description="Simulate the accesses of a running process as they arrive")
+    live_parser.add_argument('source', help="'-' for stdin, a FIFO, 'unix:<path>' to listen on a socket, or status|wait|stop")
+    live_parser.add_argument('-b', '--binary', action='store_true', help="(addr, write) records of 9 bytes, as in .npy traces, instead of text lines")
+    live_parser.add_argument('-s', '--sized', action='store_true', help="binary records also have a 4 byte size")
+    live_parser.add_argument('-c', '--chunk', type=int, default=2**16, help="records simulated at a time")
+    live_parser.add_argument('-q', '--queue', type=int, default=8, help="chunks waiting to be simulated before the reads stop")
+    live_parser.add_argument('--stats', default=None, help="unix socket that answers every connection with the statistics in json")
+
+    @cmd2.with_argparser(live_parser)
+    def do_live(self, args):
+        """live <source>|status|wait|stop [-b] [-s] [-c chunk] [-q queue] [--stats socket]
+        Simulates the accesses read from stdin, a FIFO or a unix
+        socket while the prompt keeps working, in chunks that wait in
+        a bounded queue. Text sources have one '[R|W] address [size]'
+        per line. 'wait' blocks until the source ends"""
+        if args.source in ('status', 'wait', 'stop'):
+            if self.live is None:
+                output.write("Nothing is being ingested")
+                return
+            if args.source == 'stop':
+                self.live.stop()
+            if args.source != 'status':
+                try:
+                    self.live.wait()
+                except KeyboardInterrupt:
+                    pass
+            self.live.show()
+            if args.source != 'status' and self.live.state != "running":
+                self.live = None
+            return
+        if self.memsys is None:
+            output.write("Initialize memory first")
+            return
+        if self.live is not None:
+            output.write(f"Already ingesting {self.live.source}, stop it first")
+            return
+        if self.narrate:
+            output.write("Disable the narration first (narrate False)")
+            return
+        try:
+            self.live = LiveIngest(self.memsys, args.source, binary = args.binary, sized = args.sized, chunk = args.chunk, queue = args.queue, stats = args.stats)
+        except Exception as e:
+            output.write(str(e))
+            return
+        self.live.start()
+        output.write(f"{Fore.BLUE}Ingesting {args.source}{Style.RESET_ALL}")
+
+    def do_fast_forward(self, args):
+        """fast_forward [on|off|<accesses>]
+        Runs the next accesses (all of them until 'fast_forward off'
+        if no count is given) only updating cache contents, recency,
+        dirty state and the page table. No statistics, log or costs"""
+        if self.memsys is None:
+            output.write("Initialize memory first")
+            return
+        fields = args.split()
+        if not fields:
+            left = self.memsys.fast_forward
+            output.write("Fast forward disabled" if left == 0 else "Fast forward until disabled" if left == math.inf else f"Fast forward for {left} more accesses")
+            return
+        if fields[0] == 'on':
+            self.memsys.set_fast_forward()
+            output.write(f"{Fore.BLUE}Fast forward enabled{Style.RESET_ALL}")
+        elif fields[0] == 'off':
+            self.memsys.set_fast_forward(0)
+            output.write(f"{Fore.BLUE}Fast forward disabled{Style.RESET_ALL}")
+        else:
+            try:
+                accesses = self.parse_number(fields[0])
+            except ValueError as e:
+                output.write(str(e))
+                return
+            self.memsys.set_fast_forward(accesses)
+            output.write(f"{Fore.BLUE}Fast forward for {accesses} accesses{Style.RESET_ALL}")
+
+    def do_sample(self, args):
+        """sample <ratio> [seed] | off
+        Simulates only a hash selected 1/ratio of the sets of
+        every cache when running traces. Statistics are estimated
+        for the whole trace, with 95% confidence intervals"""
+        if self.memsys is None:
+            output.write("Initialize memory first")
+            return
+        fields = args.split()
+        if not fields:
+            sampler = getattr(self.memsys, 'sampler', None)
+            output.write(f"Sampling 1/{sampler.ratio} of the sets (seed {sampler.seed})" if sampler is not None else "Sampling disabled")
+            return
+        if fields[0] == 'off':
+            self.memsys.disable_sampling()
+            output.write(f"{Fore.BLUE}Sampling disabled{Style.RESET_ALL}")
+            return
+        try:
+            self.memsys.enable_sampling(int(fields[0]), int(fields[1]) if len(fields) > 1 else 0)
+        except Exception as e:
+            output.write(str(e))
+            return
+        output.write(f"{Fore.BLUE}Sampling 1/{self.memsys.sampler.ratio} of the sets{Style.RESET_ALL}")
+
     def do_show_costs(self, args):
         self.memsys.show_costs()
 
     def parseint(self, oldval, args, name=""):
         try:
             data = int(args)
-            print(f"{Fore.GREEN}{name}{Style.RESET_ALL}set to {Fore.YELLOW}{data}{Style.RESET_ALL}")
+            output.write(f"{Fore.GREEN}{name}{Style.RESET_ALL}set to {Fore.YELLOW}{data}{Style.RESET_ALL}")
             return data
         except Exception as e:
-            print(e)
+            output.write(str(e))
             return oldval
     
     def parsebool(self, oldval, args, name=""):
         try:
             data = args == "True"
-            print(f"{Fore.GREEN}{name}{Style.RESET_ALL}set to {Fore.YELLOW}{data}{Style.RESET_ALL}")
+            output.write(f"{Fore.GREEN}{name}{Style.RESET_ALL}set to {Fore.YELLOW}{data}{Style.RESET_ALL}")
             return data
         except Exception as e:
-            print(e)
+            output.write(str(e))
             return oldval
 
     def parsestr(self, oldval, args, name=""):
@@ -810,19 +4325,19 @@ class Cacheasy(cmd2.Cmd):
             if args is None:
                 raise Exception()
             data = str(args)
-            print(f"{Fore.GREEN}{name}{Style.RESET_ALL}set to {Fore.YELLOW}{data}{Style.RESET_ALL}")
+            output.write(f"{Fore.GREEN}{name}{Style.RESET_ALL}set to {Fore.YELLOW}{data}{Style.RESET_ALL}")
             return data
         except Exception as e:
-            print(e)
+            output.write(str(e))
             return oldval
 
     def parsepolicy(self, oldval, args, name=""):
         try:
             data = ReplacementPolicy[str(args)]
-            print(f"{Fore.GREEN}{name}{Style.RESET_ALL}set to {Fore.YELLOW}{data}{Style.RESET_ALL}")
+            output.write(f"{Fore.GREEN}{name}{Style.RESET_ALL}set to {Fore.YELLOW}{data}{Style.RESET_ALL}")
             return data
         except Exception as e:
-            print(e)
+            output.write(str(e))
             return oldval
 
     def do_virtual_address_width(self, args):
@@ -843,6 +4358,112 @@ class Cacheasy(cmd2.Cmd):
         self.write_back = self.parsebool(self.write_back, args, name="Write back ")
     def do_write_allocate(self, args):
         self.write_allocate = self.parsebool(self.write_allocate, args, name="Write allocate ")
+    def do_write_buffer(self, args):
+        """write_buffer <entries>
+        Entries of the coalescing buffer of the next caches for the writes
+        sent to the level above (write through). 0 to write them directly"""
+        self.write_buffer = self.parseint(self.write_buffer, args, name="Write buffer ")
+    def do_mshrs(self, args):
+        """mshrs <entries>
+        Misses the next caches can have in flight in the timed
+        mode before stalling. 0 for no limit"""
+        self.mshrs = self.parseint(self.mshrs, args, name="MSHRs ")
+    def do_classify(self, args):
+        """classify <True|False>
+        Classify the misses of the next caches as compulsory, capacity or conflict"""
+        self.classify = self.parsebool(self.classify, args, name="Classify misses ")
+    def do_reuse(self, args):
+        """reuse <True|False>
+        Track the reuse distance histogram of the next caches"""
+        self.reuse = self.parsebool(self.reuse, args, name="Reuse distance ")
+    def do_prefetcher(self, args):
+        """prefetcher <none|next_line|stride|stream> [parameters]
+        Prefetch engine of the next caches. Its prefetches are not
+        counted as demand accesses (unlike 'prefetch'):
+            next_line [degree]              tagged next-N-line
+            stride [degree] [region_width]  strides detected per memory region
+            stream [buffers] [depth]        FIFO stream buffers beside the cache"""
+        fields = args.split()
+        try:
+            if not fields:
+                raise Exception("A prefetcher must be specified")
+            create_prefetcher(fields[0], [int(field) for field in fields[1:]])
+        except Exception as e:
+            output.write(str(e))
+            return
+        self.prefetcher = fields
+        output.write(f"{Fore.GREEN}Prefetcher {Style.RESET_ALL}set to {Fore.YELLOW}{' '.join(fields)}{Style.RESET_ALL}")
+    def do_prefetch_latency(self, args):
+        """prefetch_latency <accesses>
+        Demand accesses a prefetch takes to arrive. Prefetched lines
+        used sooner are counted as late"""
+        self.prefetch_latency = self.parseint(self.prefetch_latency, args, name="Prefetch latency ")
+    def do_page_policy(self, args):
+        """page_policy <FIFO|LRU|CLOCK|SECOND_CHANCE|NRU|AGING> [interval]
+        Page replacement policy of the next virtual memory. NRU and
+        AGING update the referenced bits every interval accesses"""
+        fields = args.split()
+        try:
+            policy = PagePolicy[fields[0]]
+            interval = int(fields[1]) if len(fields) > 1 else self.page_interval
+        except Exception as e:
+            output.write(f"Invalid page policy, use one of: {', '.join(policy.name for policy in PagePolicy)}")
+            return
+        self.page_policy, self.page_interval = policy, interval
+        output.write(f"{Fore.GREEN}Page policy {Style.RESET_ALL}set to {Fore.YELLOW}{policy.name}{Style.RESET_ALL}")
+    page_walk_parser = cmd2.Cmd2ArgumentParser(description="Radix page table of the next virtual memory, walked on every TLB miss")
+    page_walk_parser.add_argument('bits', nargs='+', help="bits of the virtual page number translated by each level, top level first, or 'off'")
+    page_walk_parser.add_argument('-t', '--tlb', type=int, default=64, help="TLB entries (0: walk on every translation)")
+    page_walk_parser.add_argument('-c', '--walk-cache', type=int, default=0, help="page-walk cache entries")
+    page_walk_parser.add_argument('-r', '--reserved', type=int, default=None, help="physical pages reserved for the page table (default: one per level)")
+
+    @cmd2.with_argparser(page_walk_parser)
+    def do_page_walk(self, args):
+        """page_walk <bits per level...|off> [-t tlb] [-c walk cache] [-r reserved pages]
+        Page table entries are read through the memory system on
+        every TLB miss, and written when pages are loaded or evicted"""
+        if args.bits == ['off']:
+            self.page_walk = None
+            output.write(f"{Fore.GREEN}Page walk {Style.RESET_ALL}set to {Fore.YELLOW}off{Style.RESET_ALL}")
+            return
+        try:
+            levels = [int(bits) for bits in args.bits]
+        except ValueError as e:
+            output.write(str(e))
+            return
+        self.page_walk = {"walk_levels": levels, "tlb_entries": args.tlb, "walk_cache_entries": args.walk_cache, "reserved_frames": args.reserved}
+        output.write(f"{Fore.GREEN}Page walk {Style.RESET_ALL}set to {Fore.YELLOW}{' '.join(args.bits)}{Style.RESET_ALL}")
+
+    dram_parser = cmd2.Cmd2ArgumentParser(description="DRAM behind the next main memory, with row buffers and their timings")
+    dram_parser.add_argument('geometry', nargs='+', help="channels, ranks per channel, banks per rank and row size in bytes, or 'off'")
+    dram_parser.add_argument('-m', '--mapping', default="row:rank:bank:channel:column", help="address fields, most significant first")
+    dram_parser.add_argument('-p', '--policy', choices=DRAM.POLICIES, default='open', help="keep rows open, or precharge after every access")
+    dram_parser.add_argument('--trcd', type=int, default=14, help="cycles to activate a row")
+    dram_parser.add_argument('--tcas', type=int, default=14, help="cycles of a column access")
+    dram_parser.add_argument('--trp', type=int, default=14, help="cycles to precharge a row")
+
+    @cmd2.with_argparser(dram_parser)
+    def do_dram(self, args):
+        """dram <channels> <ranks> <banks> <row size>|off [-m mapping] [-p open|closed] [--trcd] [--tcas] [--trp]
+        The next main memory is a DRAM: its latency depends on
+        whether each access finds its row open in the bank"""
+        if args.geometry == ['off']:
+            self.dram = None
+            output.write(f"{Fore.GREEN}DRAM {Style.RESET_ALL}set to {Fore.YELLOW}off{Style.RESET_ALL}")
+            return
+        try:
+            if len(args.geometry) != 4:
+                raise Exception("Give the channels, ranks, banks and row size")
+            (channels, ranks, banks, row_size) = [self.parse_number(field) for field in args.geometry]
+            dram = {"channels": channels, "ranks": ranks, "banks": banks, "row_size": row_size, "mapping": args.mapping,
+                    "policy": args.policy, "trcd": args.trcd, "tcas": args.tcas, "trp": args.trp}
+            DRAM(self.address_width, **dram)
+        except Exception as e:
+            output.write(str(e))
+            return
+        self.dram = dram
+        output.write(f"{Fore.GREEN}DRAM {Style.RESET_ALL}set to {Fore.YELLOW}{' '.join(args.geometry)}{Style.RESET_ALL}")
+
     def do_policy(self, args):
         self.replacement_policy = self.parsepolicy(self.replacement_policy, args, name="Replacement policy ")
     def do_cost_access(self, args):
@@ -853,13 +4474,209 @@ class Cacheasy(cmd2.Cmd):
         self.cost_miss = self.parseint(self.cost_miss, args, name="Cost miss ")
     def do_cost_through(self, args):
         self.cost_through = self.parseint(self.cost_through, args, name="Cost through ")
+    def do_latency_hit(self, args):
+        """latency_hit <cycles>
+        Lookup latency of the next cache levels"""
+        self.latency_hit = self.parseint(self.latency_hit, args, name="Latency hit ")
+    def do_latency_through(self, args):
+        """latency_through <cycles>
+        Extra latency of each write through of the next cache levels"""
+        self.latency_through = self.parseint(self.latency_through, args, name="Latency through ")
+    def do_latency_swap(self, args):
+        """latency_swap <cycles>
+        Latency of a swap with the victim cache of the next cache levels"""
+        self.latency_swap = self.parseint(self.latency_swap, args, name="Latency swap ")
+    def do_latency_histogram(self, args):
+        """latency_histogram <True|False>
+        Records the latency of every request, shown by show_costs
+        in power of two buckets"""
+        if self.memsys is None:
+            output.write("Initialize memory first")
+            return
+        memsys = self.memsys.memory_system if isinstance(self.memsys, VirtualMemory) else self.memsys
+        if self.parsebool(memsys.latency is not None, args, name="Latency histogram "):
+            memsys.enable_latency_histogram()
+        else:
+            memsys.disable_latency_histogram()
+    def do_timing(self, args):
+        """timing <True|False>
+        Timed mode: requests issue one cycle apart without waiting
+        for each other (or at the time of their trace records), and
+        the misses in flight use the MSHRs of every cache. Merged
+        misses, stall cycles and memory level parallelism are shown"""
+        if self.memsys is None:
+            output.write("Initialize memory first")
+            return
+        memsys = self.memsys.memory_system if isinstance(self.memsys, VirtualMemory) else self.memsys
+        if self.parsebool(memsys.clock is not None, args, name="Timing "):
+            memsys.enable_timing()
+        else:
+            memsys.disable_timing()
+    def do_inclusion(self, args):
+        """inclusion <NINE|INCLUSIVE|EXCLUSIVE>
+        Inclusion policy of every cache with a next level. An
+        inclusive level back-invalidates the levels above when it
+        evicts a line, an exclusive one hands its lines to the level
+        above and takes the lines it evicts, clean or dirty. The
+        back-invalidations and the lines held twice are shown"""
+        if self.memsys is None:
+            output.write("Initialize memory first")
+            return
+        try:
+            policy = InclusionPolicy[args.strip()]
+        except Exception as e:
+            output.write(f"Invalid inclusion policy, use one of: {', '.join(policy.name for policy in InclusionPolicy)}")
+            return
+        memsys = self.memsys.memory_system if isinstance(self.memsys, VirtualMemory) else self.memsys
+        memsys.set_inclusion(policy)
+        output.write(f"{Fore.GREEN}Inclusion policy {Style.RESET_ALL}set to {Fore.YELLOW}{policy.name}{Style.RESET_ALL}")
+    def do_traffic_window(self, args):
+        """traffic_window <requests>|off
+        Also records the bytes moved across every level boundary
+        in windows of that many requests"""
+        if self.memsys is None:
+            output.write("Initialize memory first")
+            return
+        memsys = self.memsys.memory_system if isinstance(self.memsys, VirtualMemory) else self.memsys
+        if args.strip() == "off":
+            memsys.disable_traffic_windows()
+            output.write(f"{Fore.GREEN}Traffic window {Style.RESET_ALL}set to {Fore.YELLOW}off{Style.RESET_ALL}")
+            return
+        size = self.parseint(memsys.traffic.size if memsys.traffic is not None else 0, args, name="Traffic window ")
+        try:
+            memsys.enable_traffic_windows(size)
+        except Exception as e:
+            output.write(str(e))
+    def do_latency_memory(self, args):
+        """latency_memory <cycles>
+        Access latency of the next main memory"""
+        self.latency_memory = self.parseint(self.latency_memory, args, name="Latency memory ")
+    def do_narrate(self, args):
+        """narrate <True|False>
+        Enables or disables the inline log of events after each request"""
+        self.narrate = self.parsebool(self.narrate, args, name="Narrate ")
+        if self.memsys is not None:
+            self.memsys.set_narrate(self.narrate)
+
+    def do_event_log(self, args):
+        """event_log <start|stop|clear|save|load|info> [file]
+        Records every event of the hierarchy in a compact binary log
+        that can be rendered later with render_log. Combine with
+        'narrate False' to skip the inline log while recording"""
+        if self.memsys is None:
+            output.write("Initialize memory first")
+            return
+        parts = args.split()
+        if not parts:
+            output.write("An action must be specified")
+            return
+        action = parts[0]
+        event_log = self.memsys.event_log
+        match action:
+            case "start":
+                self.memsys.attach_event_log(event_log if event_log is not None else EventLog())
+                output.write(f"{Fore.BLUE}Event log started{Style.RESET_ALL}")
+            case "stop":
+                #keep the log around for rendering
+                self.memsys.attach_event_log(None)
+                self.stopped_event_log = event_log
+                output.write(f"{Fore.BLUE}Event log stopped{Style.RESET_ALL}")
+            case "clear":
+                for candidate in (event_log, getattr(self, 'stopped_event_log', None)):
+                    if candidate is not None:
+                        candidate.clear()
+                output.write(f"{Fore.BLUE}Event log cleared{Style.RESET_ALL}")
+            case "save" | "load" if len(parts) < 2:
+                output.write("A file must be specified")
+            case "save":
+                event_log = self._current_event_log()
+                if event_log is not None:
+                    event_log.save(parts[1])
+                    output.write(f"{Fore.BLUE}Saved {event_log.size} events to {parts[1]}{Style.RESET_ALL}")
+            case "load":
+                try:
+                    self.stopped_event_log = EventLog.load(parts[1], self.memsys.event_sources())
+                except Exception as e:
+                    output.write(str(e))
+                    return
+                output.write(f"{Fore.BLUE}Loaded {self.stopped_event_log.size} events from {parts[1]}{Style.RESET_ALL}")
+            case "info":
+                event_log = self._current_event_log()
+                if event_log is not None:
+                    output.write(f"{event_log.size} events for {event_log.access + 1} requests ({event_log.get_events().nbytes} bytes)")
+            case _:
+                output.write(f"Unknown action {action}")
+
+    def _current_event_log(self):
+        event_log = self.memsys.event_log if self.memsys.event_log is not None else getattr(self, 'stopped_event_log', None)
+        if event_log is None:
+            output.write("No event log recorded")
+        return event_log
+
+    render_log_parser = cmd2.Cmd2ArgumentParser(description="Print the recorded event log, optionally filtered")
+    render_log_parser.add_argument('-l', '--level', nargs='+', help="level names")
+    render_log_parser.add_argument('-s', '--set', nargs='+', help="set indexes (physical page for virtual memory events)")
+    render_log_parser.add_argument('-a', '--addr', nargs=2, metavar=('LOW', 'HIGH'), help="address range (inclusive)")
+    render_log_parser.add_argument('-k', '--kind', nargs='+', help=f"event kinds or categories ({', '.join(list(EVENT_CATEGORIES) + ['prefetch'])})")
+    render_log_parser.add_argument('-i', '--access', nargs=2, metavar=('FIRST', 'LAST'), help="request index range (inclusive)")
+    render_log_parser.add_argument('-n', '--numbered', action='store_true', help="prefix every event with its request index")
+
+    @cmd2.with_argparser(render_log_parser)
+    def do_render_log(self, args):
+        """render_log [-l levels] [-s sets] [-a low high] [-k kinds] [-i first last] [-n]
+        Prints the recorded events with the usual styling"""
+        if self.memsys is None:
+            output.write("Initialize memory first")
+            return
+        event_log = self._current_event_log()
+        if event_log is None:
+            return
+        try:
+            levels = None
+            if args.level is not None:
+                levels = [i for (i, name) in enumerate(event_log.level_names) if name in args.level]
+            kinds = None
+            prefetch = False
+            if args.kind is not None:
+                kinds = []
+                for kind in args.kind:
+                    if kind.lower() == 'prefetch':
+                        prefetch = True
+                    elif kind.lower() in EVENT_CATEGORIES:
+                        kinds.extend(EVENT_CATEGORIES[kind.lower()])
+                    else:
+                        kinds.append(EventKind[kind.upper()])
+                kinds = [int(kind) for kind in kinds] if kinds or not prefetch else None
+            events = event_log.select(
+                levels = levels,
+                sets = [self.parse_number(v) for v in args.set] if args.set is not None else None,
+                addr_range = [self.parse_number(v) for v in args.addr] if args.addr is not None else None,
+                kinds = kinds, prefetch = prefetch,
+                access_range = [self.parse_number(v) for v in args.access] if args.access is not None else None)
+        except (KeyError, ValueError) as e:
+            output.write(f"Invalid filter: {e}")
+            return
+        event_log.render(events, numbered = args.numbered)
+
     def do_reset_stats(self, args):
         self.memsys.reset_statistics()
-        print(f"{Fore.BLUE}Reset statistics{Style.RESET_ALL}")
+        output.write(f"{Fore.BLUE}Reset statistics{Style.RESET_ALL}")
         
     def do_reset_costs(self, args):
-        self.memsys.last_level.reset_costs(cost_hit = self.cost_hit, cost_miss = self.cost_miss, cost_through = self.cost_through, cost_access = self.cost_access)
-        print(f"{Fore.BLUE}Reset costs{Style.RESET_ALL}")
+        """reset_costs [all|<level>]
+        Applies the configured costs to the last level created,
+        to every level or to the named one"""
+        memsys = self.memsys.memory_system if isinstance(self.memsys, VirtualMemory) else self.memsys
+        costs = {"cost_hit": self.cost_hit, "cost_miss": self.cost_miss, "cost_through": self.cost_through, "cost_access": self.cost_access}
+        try:
+            if args.strip() == "":
+                memsys.last_level.reset_costs(**costs)
+            else:
+                memsys.reset_costs(**costs, name = None if args.strip() == "all" else args.strip())
+        except Exception as e:
+            output.write(str(e))
+            return
+        output.write(f"{Fore.BLUE}Reset costs{Style.RESET_ALL}")
         
 
     def do_create(self, args):
@@ -867,69 +4684,607 @@ class Cacheasy(cmd2.Cmd):
         Create a memory system with the configured address width and line width
         """
         self.memsys = MemorySystem(self.address_width, self.virtual_address_width)
-        print(f"{Fore.BLUE}{Back.GREEN}Created memory system {Fore.RED}{args}{Style.RESET_ALL}")
+        self.memsys.set_narrate(self.narrate)
+        output.write(f"{Fore.BLUE}{Back.GREEN}Created memory system {Fore.RED}{args}{Style.RESET_ALL}")
         
     def do_virtual(self, args):
         """virtual
         Create a virtual memory on top of the existing memory system. 
         Last level must be a cache of line size equal to page size"""
         if self.memsys is None:
-            print("Initialize memory first")
+            output.write("Initialize memory first")
         else:
-            virmem = VirtualMemory(self.memory_name, self.virtual_address_width, self.address_width, self.line_size_width)
-            virmem.add_memory_system(self.memsys)
+            try:
+                virmem = VirtualMemory(self.memory_name, self.virtual_address_width, self.address_width, self.line_size_width, page_policy = self.page_policy, page_interval = self.page_interval, **(self.page_walk or {}))
+                virmem.add_memory_system(self.memsys)
+            except Exception as e:
+                output.write(str(e))
+                return
             #replace the memory system for the virtual one
             self.memsys = virmem
-        print(f"{Fore.BLUE}Added virtual memory{Style.RESET_ALL}")    
+        output.write(f"{Fore.BLUE}Added virtual memory{Style.RESET_ALL}")    
         
 
     def do_memory(self, args):
         """memory
         Create the main memory with the configured parameters"""
         if self.memsys is None:
-            print("Initialize memory first")
+            output.write("Initialize memory first")
         else:
             try:
-                self.memsys.add_main(self.line_size_width, name = self.memory_name)
+                dram = DRAM(self.address_width, **self.dram) if self.dram is not None else None
+                self.memsys.add_main(self.line_size_width, name = self.memory_name, dram = dram)
+                self.memsys.last_level.set_latency(self.latency_memory)
             except Exception as e:
-                print(e)
+                output.write(str(e))
                 return
-        print(f"{Fore.BLUE}Added main memory{Style.RESET_ALL}")
+        output.write(f"{Fore.BLUE}Added main memory{Style.RESET_ALL}")
 
     def do_cache(self, args):
         """cache 
         Create a cache level with the configured parameters"""
         if self.memsys is None:
-            print("Initialize memory first")
+            output.write("Initialize memory first")
         else:
             try:
-                self.memsys.add_cache(name = self.memory_name, set_width = self.set_width, way_width = self.way_width, line_size_width = self.line_size_width, replacement_policy = self.replacement_policy, write_back = self.write_back, write_allocate = self.write_allocate, prefetch = self.prefetch)
+                self.memsys.add_cache(name = self.memory_name, set_width = self.set_width, way_width = self.way_width, line_size_width = self.line_size_width, replacement_policy = self.replacement_policy, write_back = self.write_back, write_allocate = self.write_allocate, prefetch = self.prefetch, classify = self.classify, reuse = self.reuse,
+                                      prefetcher = create_prefetcher(self.prefetcher[0], [int(field) for field in self.prefetcher[1:]], self.prefetch_latency), write_buffer = self.write_buffer, mshrs = self.mshrs)
+                self.memsys.last_level.set_latency(self.latency_hit, self.latency_through, self.latency_swap)
             except Exception as e:
-                print(e)
+                output.write(str(e))
                 return
-        print(f"{Fore.BLUE}Added cache level{Style.RESET_ALL}")
+        output.write(f"{Fore.BLUE}Added cache level{Style.RESET_ALL}")
+
+    def do_cores(self, args):
+        """cores <count>
+        The levels created so far are shared by that many cores,
+        and every cache created next is private, one per core"""
+        if self.memsys is None:
+            output.write("Initialize memory first")
+            return
+        try:
+            if not isinstance(self.memsys, MemorySystem):
+                raise Exception("Add the cores before the virtual memory")
+            self.memsys.add_cores(self.parse_number(args))
+        except Exception as e:
+            output.write(str(e))
+            return
+        output.write(f"{Fore.BLUE}Added {args} cores{Style.RESET_ALL}")
+
+    def do_core(self, args):
+        """core <index>
+        Core that issues the next read and write requests"""
+        if self.memsys is None:
+            output.write("Initialize memory first")
+            return
+        try:
+            if not isinstance(self.memsys, MemorySystem):
+                raise Exception("There are no cores")
+            self.memsys.select_core(self.parse_number(args))
+        except Exception as e:
+            output.write(str(e))
+            return
+        output.write(f"Core set to {args}")
 
     def do_victim(self, args):
         """victim
         Create a victim cache with the configured parameters"""
         if self.memsys is None:
-            print("Initialize memory first")
+            output.write("Initialize memory first")
         else:
             try:
                 self.memsys.add_victim(name = self.memory_name, set_width = self.set_width, way_width = self.way_width, line_size_width = self.line_size_width, replacement_policy = self.replacement_policy)
             except Exception as e:
-                print(e)
+                output.write(str(e))
                 return
-        print(f"{Fore.BLUE}Added victim cache{Style.RESET_ALL}")
+        output.write(f"{Fore.BLUE}Added victim cache{Style.RESET_ALL}")
     
+    batch_parser = cmd2.Cmd2ArgumentParser(description="Run many scripts concurrently, each in its own simulator, and report their final statistics")
+    batch_parser.add_argument('paths', nargs='+', help="script files (.chs / .py), directories or glob patterns")
+    batch_parser.add_argument('-j', '--jobs', type=int, default=None, help="number of worker processes (default: number of CPUs)")
+    batch_parser.add_argument('-t', '--timeout', type=float, default=None, help="maximum seconds per script")
+    batch_parser.add_argument('-l', '--logs', action='store_true', help="keep the output log of every script in the report")
+    batch_parser.add_argument('-o', '--report', default=None, help="file where the aggregated report is written")
+    batch_parser.add_argument('-f', '--format', choices=['json', 'csv'], default=None, help="report format (default: from the report extension, else json)")
+    batch_parser.add_argument('--no-cache', action='store_true', help="run every script, ignoring the cached results")
+    batch_parser.add_argument('--cache-dir', default=None, help="directory of the cached results (default: .cacheasy_cache)")
+    batch_parser.add_argument('--cache-size', type=int, default=None, help="maximum megabytes of cached results (default: 256), the least recently used go first")
+
+    @cmd2.with_argparser(batch_parser)
+    def do_batch(self, args):
+        """batch <paths...> [-j jobs] [-t timeout] [-l] [-o report] [-f json|csv] [--no-cache]
+        Runs every script in a pool of reused worker processes and
+        collects the final per-level statistics and costs of each one.
+        Results are always reported in the order of the script paths.
+        Scripts whose text and input files did not change since they
+        last ran fine take their results from the cache"""
+        paths = expand_batch_paths(args.paths)
+        if not paths:
+            output.write("No scripts found")
+            return
+        cache = None if args.no_cache else ResultCache(args.cache_dir, args.cache_size)
+        results = run_batch(paths, jobs=args.jobs, timeout=args.timeout, capture_logs=args.logs, cache=cache)
+        for result in results:
+            status_color = Fore.GREEN if result["status"] == "ok" else Fore.RED
+            cached = " (cached)" if result.get("cached") else ""
+            output.write(f"{status_color}{result['status']:>7}{Style.RESET_ALL} {result['elapsed']:8.3f}s {result['script']}{cached}")
+        if args.report is not None:
+            fmt = args.format
+            if fmt is None:
+                fmt = 'csv' if args.report.endswith('.csv') else 'json'
+            write_batch_report(results, args.report, fmt)
+            output.write(f"{Fore.BLUE}Report written to {args.report}{Style.RESET_ALL}")
+
+    #while records are ingested live, commands run between their chunks
+    def onecmd(self, statement, *, add_to_history = True):
+        if self.live is None or getattr(statement, 'command', None) == 'live':
+            return super().onecmd(statement, add_to_history=add_to_history)
+        with self.live.lock:
+            return super().onecmd(statement, add_to_history=add_to_history)
+
+    #scripts run from a script are inputs of its results, like the traces it loads
+    def precmd(self, statement):
+        if statement.command in ('run_script', 'run_pyscript') and len(statement.argv) > 1:
+            track_input(statement.argv[1])
+        elif statement.command == '_relative_run_script' and len(statement.argv) > 1:
+            track_input(os.path.join(self._current_script_dir or "", statement.argv[1]))
+        return statement
+
+    def postcmd(self, stop, statement):
+        output.flush()
+        return stop
+
+    def do_flush(self, args):
+        """flush
+        Writes out any buffered output"""
+        output.flush()
+
+    def do_output_buffer(self, args):
+        """output_buffer <lines>
+        Number of buffered lines after which output is written out
+        even if the command has not finished (1 disables buffering)"""
+        output.flush_lines = max(1, self.parseint(output.flush_lines, args, name="Output buffer "))
+
+    def do_colour(self, args):
+        """colour <True|False|auto>
+        Enables or disables coloured output. By default colours
+        are only used when the output is a terminal"""
+        output.flush()
+        if args.strip() == "auto":
+            set_colour(sys.stdout.isatty())
+        else:
+            set_colour(args.strip() == "True")
+        output.write(f"{Fore.GREEN}Colour {Style.RESET_ALL}set to {Fore.YELLOW}{colour_enabled}{Style.RESET_ALL}")
+
     def do_quit(self, line):
+        output.flush()
         return True
 
     def do_EOF(self, line):
         return True
     
     def postloop(self):
-        print
+        output.flush()
+
+#hash of this very file: any change to the simulator invalidates the cached results
+with open(__file__, 'rb') as f:
+    SIMULATOR_VERSION = hashlib.sha256(f.read()).hexdigest()
+
+#files a script opens for reading are inputs of its results. numpy.load and np.memmap
+#open their files through the same builtin
+@contextlib.contextmanager
+def tracking_reads():
+    builtin_open = builtins.open
+    def tracked_open(file, mode = 'r', *args, **kwargs):
+        if isinstance(file, (str, bytes, os.PathLike)) and not any(flag in mode for flag in 'wax+'):
+            track_input(os.fsdecode(file))
+        return builtin_open(file, mode, *args, **kwargs)
+    builtins.open = tracked_open
+    try:
+        yield
+    finally:
+        builtins.open = builtin_open
+
+
+#derives from BaseException so neither cmd2 command handling nor the scripts swallow it
+class ScriptTimeout(BaseException):
+    pass
+
+
+def expand_batch_paths(paths):
+    scripts = []
+    for path in paths:
+        if os.path.isdir(path):
+            candidates = sorted(glob.glob(os.path.join(path, '*.chs')) + glob.glob(os.path.join(path, '*.py')))
+        elif os.path.isfile(path):
+            candidates = [path]
+        else:
+            candidates = sorted(glob.glob(path))
+        for candidate in candidates:
+            if candidate not in scripts:
+                scripts.append(candidate)
+    return scripts
+
+
+#flattens a stats_dict into one row per level (translation first, if any)
+def stats_rows(stats):
+    rows = []
+    if "translation" in stats:
+        rows.append(stats["translation"])
+    rows.extend(stats["levels"])
+    return rows
+
+
+def write_stats_csv(f, rows, prefix=None):
+    prefix = prefix or {}
+    columns = list(prefix.keys())
+    for row in rows:
+        for key in row:
+            if key not in columns:
+                columns.append(key)
+    writer = csv.DictWriter(f, fieldnames=columns, restval='')
+    writer.writeheader()
+    for row in rows:
+        writer.writerow({**prefix, **{key: " ".join(map(str, value)) if isinstance(value, list) else value for (key, value) in row.items()}})
+
+
+#runs a single script in a fresh simulator. Executed inside the worker processes
+def run_batch_script(path, timeout=None, capture_logs=False):
+    result = {"script": path, "status": "ok", "elapsed": 0.0, "statistics": {"levels": []}}
+    input_files.clear()
+    log = io.StringIO() if capture_logs else open(os.devnull, 'w')
+    errors = io.StringIO()
+    timed_out = False
+
+    def on_alarm(signum, frame):
+        nonlocal timed_out
+        timed_out = True
+        raise ScriptTimeout(f"Script exceeded {timeout}s")
+
+    #SIGALRM keeps the worker alive after a timeout so it can be reused (not available on Windows)
+    use_alarm = timeout is not None and hasattr(signal, 'SIGALRM')
+    start = time.perf_counter()
+    try:
+        #logs are files, never terminals: leave the colours out
+        set_colour(False)
+        with contextlib.redirect_stdout(log), contextlib.redirect_stderr(errors):
+            app = Cacheasy()
+            command = 'run_pyscript' if path.endswith('.py') else 'run_script'
+            if use_alarm:
+                previous_handler = signal.signal(signal.SIGALRM, on_alarm)
+                signal.setitimer(signal.ITIMER_REAL, timeout)
+            try:
+                with tracking_reads():
+                    app.onecmd_plus_hooks(f'{command} "{path}"', add_to_history=False)
+            except ScriptTimeout:
+                pass
+            finally:
+                if use_alarm:
+                    signal.setitimer(signal.ITIMER_REAL, 0)
+                    signal.signal(signal.SIGALRM, previous_handler)
+                output.flush()
+        if app.memsys is not None:
+            result["statistics"] = app.memsys.stats_dict()
+    except Exception as e:
+        result["status"] = "error"
+        errors.write(str(e))
+    result["elapsed"] = time.perf_counter() - start
+    
+    if timed_out:
+        result["status"] = "timeout"
+    elif errors.getvalue() and result["status"] == "ok":
+        result["status"] = "error"
+    if errors.getvalue():
+        result["errors"] = errors.getvalue()
+    result["inputs"] = list(input_files)
+    if capture_logs:
+        result["log"] = log.getvalue()
+    else:
+        log.close()
+    return result
+
+
+#final statistics of the scripts that ran fine, one json file per script. A result is found by the
+#simulator version and the text of the script, and is only used while the files the script read
+#(traces, streams and other scripts) keep the contents they had. The least recently used results
+#are removed when the directory grows over its size
+class ResultCache:
+    DIRECTORY = ".cacheasy_cache"
+    SIZE = 256
+    CHUNK = 2**20
+
+    def __init__(self, directory = None, megabytes = None):
+        self.directory = directory if directory is not None else ResultCache.DIRECTORY
+        self.max_bytes = (megabytes if megabytes is not None else ResultCache.SIZE) * 2**20
+        #digests of the files hashed so far, while their size and modification time do not change
+        self.digests = {}
+
+    def digest(self, filename):
+        info = os.stat(filename)
+        known = self.digests.get(filename)
+        if known is not None and known[0] == (info.st_size, info.st_mtime_ns):
+            return known[1]
+        sha = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(ResultCache.CHUNK), b''):
+                sha.update(chunk)
+        self.digests[filename] = ((info.st_size, info.st_mtime_ns), sha.hexdigest())
+        return sha.hexdigest()
+
+    #comments, indentation and blank lines of text scripts do not change their results
+    def key(self, path, capture_logs):
+        with open(path, 'rb') as f:
+            text = f.read()
+        if not path.endswith('.py'):
+            lines = [line.split(b'#')[0].strip() for line in text.splitlines()]
+            text = b"\n".join(line for line in lines if line)
+        sha = hashlib.sha256(f"{SIMULATOR_VERSION}\0{capture_logs}\0".encode())
+        sha.update(text)
+        return sha.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, path, capture_logs = False):
+        try:
+            entry = self._entry(self.key(path, capture_logs))
+            with open(entry) as f:
+                stored = json.load(f)
+            if any(self.digest(filename) != digest for (filename, digest) in stored["inputs"].items()):
+                return None
+            os.utime(entry)
+        except (OSError, ValueError, KeyError):
+            return None
+        result = stored["result"]
+        result["script"] = path
+        result["cached"] = True
+        return result
+
+    def put(self, path, result, capture_logs = False):
+        try:
+            #only regular files: devices and pipes have no stable contents
+            inputs = {filename: self.digest(filename) for filename in result.get("inputs", []) if filename != os.path.abspath(path) and os.path.isfile(filename)}
+            key = self.key(path, capture_logs)
+            os.makedirs(self.directory, exist_ok=True)
+            #written aside and renamed, so a concurrent batch never reads half an entry
+            (handle, temporary) = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(handle, 'w') as f:
+                json.dump({"inputs": inputs, "result": result}, f)
+            os.replace(temporary, self._entry(key))
+        except OSError:
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                try:
+                    info = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((info.st_mtime_ns, info.st_size, name))
+        total = sum(size for (mtime, size, name) in entries)
+        for (mtime, size, name) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(self.directory, name))
+            total -= size
+
+
+def run_batch(paths, jobs=None, timeout=None, capture_logs=False, cache=None):
+    results = [cache.get(path, capture_logs) if cache is not None else None for path in paths]
+    pending = [i for (i, result) in enumerate(results) if result is None]
+    if not pending:
+        return results
+    #map keeps the input order regardless of which worker finishes first,
+    #and the pool reuses its workers for all the scripts
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for (i, result) in zip(pending, executor.map(run_batch_script, [paths[i] for i in pending], repeat(timeout), repeat(capture_logs))):
+            results[i] = result
+            if cache is not None and result["status"] == "ok":
+                cache.put(paths[i], result, capture_logs)
+    return results
+
+
+def write_batch_report(results, filename, fmt='json'):
+    if fmt == 'json':
+        with open(filename, 'w') as f:
+            json.dump({"scripts": results}, f, indent=2)
+        return
+
+    #one row per script and level, with the columns of every level kind
+    rows = []
+    for result in results:
+        prefix = {"script": result["script"], "status": result["status"], "elapsed": f"{result['elapsed']:.6f}"}
+        levels = stats_rows(result["statistics"])
+        if not levels:
+            rows.append(prefix)
+        for level in levels:
+            rows.append({**prefix, **level})
+    with open(filename, 'w', newline='') as f:
+        write_stats_csv(f, rows)
+
+
+#Feeds the memory system with access records from a live source while the prompt keeps working.
+#An asyncio loop in its own thread reads the source (stdin '-', a FIFO, or 'unix:<path>' to listen
+#on a socket, one producer per connection) and batches the records into trace chunks. The chunks
+#wait in a bounded queue for the simulation thread, so a full queue stops the reads and the
+#producers block. Each chunk is simulated holding the lock, which the commands also take
+class LiveIngest:
+    #seconds after which the records received so far are simulated without waiting for a full chunk
+    FLUSH = 0.2
+    READ_SIZE = 2**16
+
+    def __init__(self, memory_system, source, binary = False, sized = False, chunk = 2**16, queue = 8, stats = None):
+        if chunk < 1 or queue < 1:
+            raise Exception("Chunks and queue need at least one entry")
+        self.memory_system = memory_system
+        self.source = source
+        self.binary = binary
+        self.dtype = SIZED_TRACE_DTYPE if sized or not binary else TRACE_DTYPE
+        self.chunk = chunk
+        self.stats = stats
+        self.chunks = Queue(queue)
+        self.lock = threading.RLock()
+        self.state = "starting"
+        self.error = None
+        self.received = 0
+        self.simulated = 0
+        self.invalid = 0
+        self.loop = None
+        self.task = None
+        if source != '-' and not source.startswith('unix:') and not os.path.exists(source):
+            raise Exception(f"No such FIFO {source}")
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.simulator = threading.Thread(target=self._simulate, daemon=True)
+
+    def start(self):
+        self.state = "running"
+        self.simulator.start()
+        self.reader.start()
+
+    def _read(self):
+        try:
+            #opening a FIFO waits for its writer
+            pipe = sys.stdin.buffer if self.source == '-' else None
+            if pipe is None and not self.source.startswith('unix:'):
+                pipe = open(self.source, 'rb', buffering=0)
+            if self.state == "running":
+                asyncio.run(self._main(pipe))
+        except Exception as e:
+            self.error = str(e)
+        finally:
+            self.chunks.put(None)
+
+    async def _main(self, pipe):
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        servers = []
+        try:
+            if self.stats is not None:
+                servers.append(await asyncio.start_unix_server(self._serve_stats, self.stats))
+            if pipe is not None:
+                reader = asyncio.StreamReader(limit=LiveIngest.READ_SIZE)
+                await self.loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+                await self._consume(reader)
+            else:
+                servers.append(await asyncio.start_unix_server(self._connection, self.source[len('unix:'):]))
+                await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            for server in servers:
+                server.close()
+            for path in [self.stats, self.source[len('unix:'):] if self.source.startswith('unix:') else None]:
+                if path is not None:
+                    with contextlib.suppress(OSError):
+                        os.remove(path)
+
+    async def _connection(self, reader, writer):
+        try:
+            await self._consume(reader)
+        finally:
+            writer.close()
+
+    #records come in any pieces, the incomplete one at the end waits for the next read
+    async def _consume(self, reader):
+        pending = b""
+        parsed = []
+        count = 0
+        while True:
+            try:
+                data = await asyncio.wait_for(reader.read(LiveIngest.READ_SIZE), LiveIngest.FLUSH)
+            except asyncio.TimeoutError:
+                data = None
+            if data is not None:
+                pending += data
+                records, pending = self._parse(pending, final = data == b"")
+                if len(records) > 0:
+                    parsed.append(records)
+                    count += len(records)
+                    self.received += len(records)
+            if count > 0 and (count >= self.chunk or data is None or data == b""):
+                records = np.concatenate(parsed)
+                for start in range(0, len(records), self.chunk):
+                    await self.loop.run_in_executor(None, self.chunks.put, records[start:start + self.chunk])
+                parsed = []
+                count = 0
+            if data == b"":
+                return
+
+    def _parse(self, data, final = False):
+        if self.binary:
+            complete = len(data) - len(data) % self.dtype.itemsize
+            return (np.frombuffer(data[:complete], dtype=self.dtype).copy(), data[complete:])
+        lines = data.split(b"\n")
+        rest = b"" if final else lines.pop()
+        fields = []
+        for line in lines:
+            words = line.split(b"#")[0].decode(errors='replace').split()
+            if not words:
+                continue
+            try:
+                fields.append(parse_trace_fields(words))
+            except ValueError:
+                self.invalid += 1
+        records = np.zeros(len(fields), dtype=self.dtype)
+        if fields:
+            (records['addr'], records['write'], records['size']) = zip(*fields)
+        return (records, rest)
+
+    def _simulate(self):
+        while True:
+            records = self.chunks.get()
+            if records is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                with self.lock:
+                    self.memory_system.run_trace(records)
+                    self.simulated += len(records)
+            except Exception as e:
+                self.error = str(e)
+        if self.error is not None:
+            self.state = "error"
+        elif self.state == "running":
+            self.state = "finished"
+
+    async def _serve_stats(self, reader, writer):
+        def snapshot():
+            with self.lock:
+                return json.dumps({"ingest": self.report(), "statistics": self.memory_system.stats_dict()})
+        writer.write((await self.loop.run_in_executor(None, snapshot)).encode())
+        await writer.drain()
+        writer.close()
+
+    #stops reading. The records already received are still simulated
+    def stop(self):
+        if self.state == "running":
+            self.state = "stopped"
+        if self.loop is not None and self.task is not None:
+            self.loop.call_soon_threadsafe(self.task.cancel)
+        elif self.source != '-' and not self.source.startswith('unix:'):
+            #a reader still waiting for the writer of the FIFO is released by opening it
+            with contextlib.suppress(OSError):
+                os.close(os.open(self.source, os.O_WRONLY | os.O_NONBLOCK))
+
+    def wait(self, timeout = None):
+        self.simulator.join(timeout)
+        return not self.simulator.is_alive()
+
+    def report(self):
+        return {"source": self.source, "state": self.state, "received": self.received, "simulated": self.simulated,
+                "queued": self.chunks.qsize(), "invalid": self.invalid, "error": self.error}
+
+    def show(self):
+        report = self.report()
+        error = f". {Fore.RED}{report['error']}{Style.RESET_ALL}" if report["error"] is not None else ""
+        output.write(f"Live {report['source']}: {Fore.YELLOW}{report['state']}{Style.RESET_ALL}, {report['received']} records received, " +
+                     f"{Fore.GREEN}{report['simulated']}{Style.RESET_ALL} simulated, {report['queued']} chunks queued, {report['invalid']} invalid lines{error}")
+
 
 if __name__ == '__main__':
     Cacheasy().cmdloop()
@@ -939,12 +5294,19 @@ if __name__ == '__main__':
     write_allocate: reserves memory when writing (brings block)
     no write_allocate: does not reserve memory if the block is not in cache (just writes to upper memory)
 
-    TODO:
     write_back: only write a block when evicted
-    write_through: writes all the hierarchy when dirty, no waiting for eviction
+    write_through: writes all the hierarchy, no waiting for eviction. Lines stay clean, and an
+    optional write buffer merges the writes to a line until it is full, the line is read or evicted
+
+    inclusive: a level evicting a line removes it from the levels above (back-invalidation)
+    exclusive: a line lives in one level only, moving up when read and down when evicted
+
+    record/replay: the requests of a cache to the next level are saved and sent again to other lower levels
+
+    live: accesses from a pipe or socket are simulated in chunks in the background, between commands
 
-    TODO:
-    differentiate between line read/writes and word read/writes since it is different!!!
+    line and word transfers: fills read every line of the next level covering the line,
+    writebacks move whole lines and requests may carry their size (split per line)
     
 """
 
@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from cacheasy import Cacheasy
+
+
+#runs commands in a simulator (a new one unless given) and returns it with their output
+@pytest.fixture
+def simulate(capsys):
+    def run(*commands, app = None):
+        if app is None:
+            app = Cacheasy()
+        capsys.readouterr()
+        for command in commands:
+            app.onecmd_plus_hooks(command)
+        return (app, capsys.readouterr().out)
+    return run
@@ -0,0 +1,56 @@
+import numpy as np
+
+from cacheasy import MemorySystem, ReplacementPolicy, ReuseDistance
+
+
+#distinct blocks between two accesses to the same block, counted the slow way
+def brute_force_histogram(blocks):
+    histogram = np.zeros(ReuseDistance.BUCKETS, dtype=np.int64)
+    for (i, block) in enumerate(blocks):
+        if block in blocks[:i]:
+            previous = i - 1 - blocks[:i][::-1].index(block)
+            histogram[len(set(blocks[previous + 1:i])).bit_length()] += 1
+    return histogram
+
+
+def test_reuse_distances_match_brute_force():
+    rng = np.random.default_rng(1)
+    blocks = [int(block) for block in rng.integers(0, 40, 600)]
+    #a small capacity makes the tree compact its times several times
+    reuse = ReuseDistance(capacity = 16)
+    for block in blocks:
+        reuse.access(block)
+    assert reuse.cold == len(set(blocks))
+    assert reuse.histogram.tolist() == brute_force_histogram(blocks).tolist()
+
+
+def test_cache_tracks_reuse_per_line():
+    memsys = MemorySystem(16)
+    memsys.add_main(4)
+    memsys.add_cache("L1", 1, 1, 4, ReplacementPolicy.LRU, True, True, 0, reuse = True)
+    memsys.set_narrate(False)
+    #two passes over 8 lines, two accesses per line in each
+    for _ in range(2):
+        memsys.read(0, 127, 8)
+    reuse = memsys.last_level.reuse
+    assert reuse.cold == 8
+    #distance 0 inside a line, 7 other lines between the passes
+    assert (reuse.histogram[0], reuse.histogram[3]) == (16, 8)
+    assert reuse.fraction_within(4) == 16 / 24
+
+
+#set 1 of a direct mapped cache is hammered by two conflicting lines, the others are touched once
+def test_heatmap_counts_per_set(simulate, tmp_path):
+    commands = ["read 16", "read 80"] * 3 + ["read 0", "read 32", "read 48"]
+    (app, _) = simulate("address_width 16", "line_size_width 4", "create Test", "name Memory", "memory",
+                        "name L1", "set_width 2", "way_width 0", "cache", "narrate False", *commands)
+    cache = app.memsys.last_level
+    assert cache.set_accesses.tolist() == [1, 6, 1, 1]
+    assert cache.set_misses.tolist() == [1, 6, 1, 1]
+    assert cache.set_evictions.tolist() == [0, 5, 0, 0]
+    (_, text) = simulate("show_heatmap -c misses", app = app)
+    assert "Misses: 9 over 4 sets" in text and "0x1 (6)" in text
+    export = tmp_path / "heat.npz"
+    simulate(f"show_heatmap -e {export}", app = app)
+    arrays = np.load(export)
+    assert arrays["L1_misses"].tolist() == [1, 6, 1, 1]
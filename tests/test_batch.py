@@ -0,0 +1,67 @@
+import csv
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import cacheasy
+from cacheasy import ResultCache, expand_batch_paths, run_batch, write_batch_report
+
+HIERARCHY = ["address_width 16", "line_size_width 4", "create Test", "name Memory", "memory",
+             "name L1", "set_width 2", "way_width 1", "cache", "narrate False"]
+
+
+def misses(result):
+    return result["statistics"]["levels"][-1]["line_miss"]
+
+
+#results come back in the order of the paths, whichever worker finishes first
+def test_batch_keeps_order_and_statistics(tmp_path):
+    for (name, reads) in (("b.chs", 1), ("a.chs", 3), ("c.chs", 2)):
+        (tmp_path / name).write_text("\n".join(HIERARCHY + [f"read {1024 * i}" for i in range(reads)]) + "\n")
+    (tmp_path / "broken.py").write_text("raise ValueError('broken')\n")
+    paths = expand_batch_paths([str(tmp_path)])
+    assert [os.path.basename(path) for path in paths] == ["a.chs", "b.chs", "broken.py", "c.chs"]
+    results = run_batch(paths, jobs=2)
+    assert [result["status"] for result in results] == ["ok", "ok", "error", "ok"]
+    assert [misses(results[i]) for i in (0, 1, 3)] == [3, 1, 2]
+    report = tmp_path / "report.csv"
+    write_batch_report(results, str(report), 'csv')
+    with open(report, newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert [(os.path.basename(row["script"]), row["name"]) for row in rows[:2]] == [("a.chs", "Memory"), ("a.chs", "L1")]
+    assert rows[1]["line_miss"] == "3"
+
+
+#the python script reads its addresses from a file of its own, which must be part of the key
+def test_cache_follows_files_read_by_python_scripts(tmp_path):
+    data = tmp_path / "addresses.txt"
+    data.write_text("0\n")
+    script = tmp_path / "reads.py"
+    script.write_text("".join(f"app('{command}')\n" for command in HIERARCHY) +
+                      f"for line in open({str(data)!r}):\n    app('read ' + line.strip())\n")
+    cache = ResultCache(str(tmp_path / "cache"))
+    (first,) = run_batch([str(script)], jobs=1, cache=cache)
+    assert first["status"] == "ok" and "cached" not in first and misses(first) == 1
+    (second,) = run_batch([str(script)], jobs=1, cache=cache)
+    assert second.get("cached") and misses(second) == 1
+    data.write_text("0\n1024\n2048\n")
+    (third,) = run_batch([str(script)], jobs=1, cache=cache)
+    assert "cached" not in third and misses(third) == 3
+
+
+def test_cache_key_changes_with_the_simulator(tmp_path, monkeypatch):
+    script = tmp_path / "one.chs"
+    script.write_text("\n".join(HIERARCHY + ["read 0"]) + "\n")
+    cache = ResultCache(str(tmp_path / "cache"))
+    run_batch([str(script)], jobs=1, cache=cache)
+    assert cache.get(str(script)) is not None
+    monkeypatch.setattr(cacheasy, "SIMULATOR_VERSION", "another simulator")
+    assert cache.get(str(script)) is None
+
+
+def test_batch_reports_timeouts(tmp_path):
+    script = tmp_path / "forever.py"
+    script.write_text("while True:\n    pass\n")
+    (result,) = run_batch([str(script)], jobs=1, timeout=0.5)
+    assert result["status"] == "timeout"
@@ -0,0 +1,80 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from cacheasy import MemorySystem, MissClassifier, ReplacementPolicy
+
+
+def single_line_cache(policy, write_allocate = True):
+    memsys = MemorySystem(32)
+    memsys.add_main(4)
+    memsys.add_cache("L1", 0, 0, 4, policy, True, write_allocate, 0)
+    return memsys
+
+
+#a read that hits a written line must leave it dirty, so it is written back when evicted
+@pytest.mark.parametrize("policy", [ReplacementPolicy.LRU, ReplacementPolicy.FIFO])
+def test_read_after_write_keeps_line_dirty(policy):
+    memsys = single_line_cache(policy)
+    memsys.write(0)
+    memsys.read(0)
+    memsys.read(16)
+    assert memsys.last_level.statistics.line_evict == 1
+
+
+@pytest.mark.parametrize("policy", [ReplacementPolicy.LRU, ReplacementPolicy.FIFO])
+def test_write_hit_dirties_line(policy):
+    memsys = single_line_cache(policy, write_allocate = False)
+    memsys.read(0)
+    memsys.write(0)
+    memsys.read(16)
+    assert memsys.last_level.statistics.line_evict == 1
+
+
+#32 bit addresses and 64 B lines have 2^26 blocks: the seen blocks must only cost their footprint
+def test_classification_memory_follows_footprint():
+    import tracemalloc
+    memsys = MemorySystem(32)
+    memsys.add_main(6)
+    memsys.add_cache("L1", 4, 2, 6, ReplacementPolicy.LRU, True, True, 0, classify = True)
+    memsys.set_narrate(False)
+    classifier = memsys.last_level.classifier
+    assert classifier.seen_bytes() == 0
+    blocks = 50000
+    tracemalloc.start()
+    memsys.read(0, (blocks - 1) * 64, 64)
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert classifier.seen_bytes() < blocks // 8 + 2**MissClassifier.PAGE_WIDTH
+    assert peak < 2**20
+    stats = memsys.last_level.statistics
+    assert (stats.miss_compulsory, stats.miss_capacity, stats.miss_conflict) == (blocks, 0, 0)
+
+
+def test_classification_is_exact():
+    memsys = MemorySystem(32)
+    memsys.add_main(4)
+    memsys.add_cache("L1", 0, 1, 4, ReplacementPolicy.LRU, True, True, 0, classify = True)
+    memsys.set_narrate(False)
+    #scattered blocks, far apart, seen twice: the second pass only has capacity misses
+    for _ in range(2):
+        for block in range(0, 2**28, 2**18):
+            memsys.read(block * 16)
+    stats = memsys.last_level.statistics
+    assert (stats.miss_compulsory, stats.miss_capacity, stats.miss_conflict) == (2**10, 2**10, 0)
+
+
+def test_classification_finds_conflicts():
+    memsys = MemorySystem(16)
+    memsys.add_main(4)
+    memsys.add_cache("L1", 1, 0, 4, ReplacementPolicy.LRU, True, True, 0, classify = True)
+    memsys.set_narrate(False)
+    #two blocks mapping to set 0 of a two line direct mapped cache
+    for _ in range(3):
+        memsys.read(0)
+        memsys.read(32)
+    stats = memsys.last_level.statistics
+    assert (stats.miss_compulsory, stats.miss_capacity, stats.miss_conflict) == (2, 0, 4)
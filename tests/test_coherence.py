@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from cacheasy import TRACE_DTYPE, MemorySystem, ReplacementPolicy
+
+
+#a shared L2 and a private L1 of 16 B lines for each core
+def two_cores():
+    memsys = MemorySystem(16)
+    memsys.add_main(4)
+    memsys.add_cache("L2", 2, 1, 4, ReplacementPolicy.LRU, True, True, 0)
+    memsys.add_cores(2)
+    memsys.add_cache("L1", 1, 0, 4, ReplacementPolicy.LRU, True, True, 0)
+    memsys.set_narrate(False)
+    return memsys
+
+
+def states(memsys, addr = 0):
+    return (memsys.directory.state(0, addr), memsys.directory.state(1, addr))
+
+
+def test_mesi_transitions():
+    memsys = two_cores()
+    expected = [(False, 0, ('E', 'I')), (False, 1, ('S', 'S')), (True, 0, ('M', 'I')), (False, 1, ('S', 'S')),
+                (True, 1, ('I', 'M')), (False, 0, ('S', 'S'))]
+    for (write, core, state) in expected:
+        if write:
+            memsys.write(4 * core, core = core)
+        else:
+            memsys.read(4 * core, core = core)
+        assert states(memsys) == state
+    report = memsys.directory.report()
+    assert (report["cores"], report["block_size"]) == (2, 16)
+    #each core upgrades a shared copy once, loses it to the other core and writes its modified copy back once
+    for counter in ('upgrades', 'invalidations', 'interventions', 'coherence_misses'):
+        assert report[counter] == [1, 1]
+    for level in memsys.levels[2:]:
+        assert (level.statistics.read_miss, level.statistics.bytes_writeback) == (2, 16)
+
+
+#E to M is silent
+def test_exclusive_write_is_silent():
+    memsys = two_cores()
+    memsys.read(0, core = 1)
+    memsys.write(0, core = 1)
+    assert states(memsys) == ('I', 'M')
+    assert sum(sum(values) for values in memsys.directory.counters.values()) == 0
+
+
+#the interleaved traces give the same states and counters as the requests one by one
+def test_core_traces_round_robin():
+    rng = np.random.default_rng(3)
+    traces = []
+    for core in range(2):
+        trace = np.zeros(200, dtype=TRACE_DTYPE)
+        trace['addr'] = rng.integers(0, 8, 200) * 16
+        trace['write'] = rng.integers(0, 2, 200)
+        traces.append(trace)
+    memsys = two_cores()
+    memsys.run_core_traces(traces)
+    reference = two_cores()
+    for i in range(200):
+        for core in range(2):
+            (addr, write) = (int(traces[core]['addr'][i]), traces[core]['write'][i])
+            if write:
+                reference.write(addr, core = core)
+            else:
+                reference.read(addr, core = core)
+    assert memsys.directory.report() == reference.directory.report()
+    assert [states(memsys, block * 16) for block in range(8)] == [states(reference, block * 16) for block in range(8)]
+    with pytest.raises(Exception):
+        memsys.run_core_traces(traces[:1])
@@ -0,0 +1,55 @@
+import pytest
+
+from cacheasy import DRAM, MemorySystem, ReplacementPolicy
+
+
+#2 banks of 256 B rows in 16 bit addresses: bit 8 selects the bank and the bits above the row
+def dram(**kwargs):
+    return DRAM(16, banks = 2, row_size = 256, **kwargs)
+
+
+#an empty bank activates the row, an open row is read at once and another row is precharged first
+def test_open_page_latencies():
+    memory = dram()
+    assert [memory.access(addr) for addr in (0, 4, 512, 256)] == [28, 14, 42, 28]
+    report = memory.report()
+    assert (report["row_hits"], report["row_empty"], report["row_conflicts"], report["latency"]) == (1, 2, 1, 112)
+    assert report["row_hit_rate"] == pytest.approx(0.25)
+
+
+def test_closed_page_latencies():
+    memory = dram(policy = "closed")
+    assert [memory.access(addr) for addr in (0, 4, 512, 256)] == [28] * 4
+    assert memory.report()["row_empty"] == 4
+
+
+#in the timed mode a bank serves one access at a time, while the other bank is free
+def test_busy_bank_delays_accesses():
+    memory = dram()
+    assert [memory.access(addr, now = 0) for addr in (0, 4, 256)] == [28, 28 + 14, 28]
+    closed = dram(policy = "closed")
+    #the closed page precharges after every access
+    assert [closed.access(addr, now = 0) for addr in (0, 4)] == [28, 28 + 14 + 28]
+
+
+def test_address_mapping():
+    memory = dram(mapping = "row:rank:channel:column:bank")
+    assert memory.locate(1) == (1, 0)
+    assert memory.locate(512) == (0, 1)
+    for kwargs in ({"banks": 3}, {"mapping": "row:bank:column"}, {"policy": "lazy"}, {"row_size": 2**16}):
+        with pytest.raises(Exception):
+            DRAM(16, **{"banks": 2, "row_size": 256, **kwargs})
+
+
+#the latency of main memory is that of its DRAM
+def test_main_memory_with_dram():
+    memsys = MemorySystem(16)
+    memsys.add_main(4, dram = dram())
+    memsys.add_cache("L1", 0, 0, 4, ReplacementPolicy.LRU, True, True, 0)
+    memsys.set_narrate(False)
+    memsys.last_level.set_latency(1)
+    for addr in (0, 16, 512, 256, 0):
+        memsys.read(addr)
+    report = memsys.latency_report()
+    assert report["levels"] == {"Main Memory": 28 + 14 + 42 + 28 + 42, "L1": 5}
+    assert memsys.levels[0].stats_dict()["dram"]["row_conflicts"] == 2
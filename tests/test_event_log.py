@@ -0,0 +1,25 @@
+HIERARCHY = ["address_width 16", "line_size_width 4", "create Test", "name Memory", "memory",
+             "name L1", "set_width 1", "way_width 0", "cache"]
+ACCESSES = ["read 0", "write 4", "read 32", "read 0", "write 64", "read 16"]
+
+
+#the recorded log renders the same lines as the narration, and survives save and load
+def test_render_log_matches_narration(simulate, tmp_path):
+    (app, _) = simulate(*HIERARCHY)
+    (_, narrated) = simulate(*ACCESSES, app = app)
+    (app, _) = simulate(*HIERARCHY, "narrate False", "event_log start", *ACCESSES, "event_log stop")
+    (_, rendered) = simulate("render_log", app = app)
+    assert len(rendered.splitlines()) > len(ACCESSES)
+    assert rendered == narrated
+    log = tmp_path / "events.npz"
+    simulate(f"event_log save {log}", "event_log clear", app = app)
+    (_, loaded) = simulate(f"event_log load {log}", "render_log", app = app)
+    assert loaded.splitlines()[1:] == rendered.splitlines()
+
+
+def test_render_log_filters_by_kind(simulate):
+    (app, _) = simulate(*HIERARCHY, "narrate False", "event_log start", *ACCESSES)
+    (_, misses) = simulate("render_log -k miss", app = app)
+    (_, hits) = simulate("render_log -k hit", app = app)
+    l1 = app.memsys.last_level.statistics
+    assert (len(misses.splitlines()), len(hits.splitlines())) == (l1.line_miss, l1.line_hit)
@@ -0,0 +1,39 @@
+import numpy as np
+
+from cacheasy import Hook, HookEvent, MemorySystem, ReplacementPolicy
+
+
+def hierarchy():
+    memsys = MemorySystem(16)
+    memsys.add_main(4)
+    memsys.add_cache("L1", 1, 0, 4, ReplacementPolicy.LRU, True, True, 0)
+    memsys.set_narrate(False)
+    return (memsys, memsys.last_level)
+
+
+def test_callbacks_follow_the_counters():
+    (memsys, cache) = hierarchy()
+    events = []
+    handle = cache.subscribe(['hit', 'miss', 'writeback'], lambda event, level, addr, flags: events.append((event, addr, flags)))
+    memsys.write(0)
+    memsys.read(4)
+    memsys.read(32)
+    assert events == [(HookEvent.MISS, 0, 0), (HookEvent.HIT, 4, 0), (HookEvent.MISS, 32, 0), (HookEvent.WRITEBACK, 0, Hook.DIRTY)]
+    cache.unsubscribe(handle)
+    memsys.read(64)
+    assert len(events) == 4
+    assert all(hook is None for hook in cache.hooks)
+
+
+def test_batches_deliver_numpy_chunks():
+    (memsys, cache) = hierarchy()
+    chunks = []
+    cache.subscribe('miss', lambda level, chunk: chunks.append(chunk.copy()), batch = 4)
+    for addr in range(0, 16 * 10, 16):
+        memsys.read(addr)
+    cache.flush_hooks()
+    assert [len(chunk) for chunk in chunks] == [4, 4, 2]
+    misses = np.concatenate(chunks)
+    assert misses['addr'].tolist() == list(range(0, 160, 16))
+    assert misses['set'].tolist() == [0, 1] * 5
+    assert (misses['event'] == HookEvent.MISS).all()
@@ -0,0 +1,48 @@
+from cacheasy import InclusionPolicy, MemorySystem, ReplacementPolicy
+
+
+#an L2 of 2 lines below an L1 of 4: blocks 0 and 32 share the set of L2, not that of L1
+def hierarchy(policy):
+    memsys = MemorySystem(16)
+    memsys.add_main(4)
+    memsys.add_cache("L2", 1, 0, 4, ReplacementPolicy.LRU, True, True, 0)
+    memsys.add_cache("L1", 2, 0, 4, ReplacementPolicy.LRU, True, True, 0)
+    memsys.set_narrate(False)
+    memsys.set_inclusion(policy)
+    memsys.write(0)
+    memsys.read(32)
+    memsys.read(0)
+    return memsys.levels[1:] + [memsys]
+
+
+def contents(level):
+    return [address for address in (0, 32) if address in level]
+
+
+#L1 keeps the lines L2 evicted
+def test_non_inclusive_keeps_lines_above():
+    (l2, l1, memsys) = hierarchy(InclusionPolicy.NINE)
+    assert (contents(l1), contents(l2)) == ([0, 32], [32])
+    assert l1.statistics.read_hit == 1
+    assert memsys.inclusion_report()["levels"]["L2"] == {"back_invalidations": 0, "lines": 1, "duplicated": 1}
+
+
+#every eviction of L2 removes the line from L1, and the dirty copy goes down to memory
+def test_inclusive_back_invalidates():
+    (l2, l1, memsys) = hierarchy(InclusionPolicy.INCLUSIVE)
+    assert (contents(l1), contents(l2)) == ([0], [0])
+    assert (l1.statistics.read_miss, l1.statistics.read_hit) == (2, 0)
+    assert (l2.statistics.back_invalidate, l2.statistics.bytes_writeback) == (2, 16)
+    assert memsys.inclusion_report()["levels"]["L2"]["back_invalidations"] == 2
+
+
+#L2 only holds what L1 evicts, so no line is held twice
+def test_exclusive_holds_the_evicted_lines():
+    (l2, l1, memsys) = hierarchy(InclusionPolicy.EXCLUSIVE)
+    assert (contents(l1), contents(l2)) == ([0, 32], [])
+    memsys.read(64)
+    assert (contents(l1), contents(l2)) == ([32], [0])
+    report = memsys.inclusion_report()
+    assert (report["levels"]["L2"]["duplicated"], report["duplicated_bytes"]) == (0, 0)
+    #the line handed down is still dirty
+    assert [line.dirty for lines in l2.set_data for line in lines if line.valid] == [True]
@@ -0,0 +1,90 @@
+import pytest
+
+from cacheasy import LatencyHistogram, MemorySystem, ReplacementPolicy
+
+
+#a one line L1 over a 4 set, 2 way L2, with hit latencies of 1, 10 and 100 cycles
+def hierarchy():
+    memsys = MemorySystem(16)
+    memsys.add_main(4)
+    memsys.add_cache("L2", 2, 1, 4, ReplacementPolicy.LRU, True, True, 0)
+    memsys.add_cache("L1", 0, 0, 4, ReplacementPolicy.LRU, True, True, 0)
+    memsys.set_narrate(False)
+    for (level, latency) in zip(memsys.levels, (100, 10, 1)):
+        level.set_latency(latency)
+    return memsys
+
+
+#L1 misses, hits, misses twice; L2 misses twice and hits the last block
+def test_amat_adds_the_levels_reached():
+    memsys = hierarchy()
+    for address in (0, 0, 16, 0):
+        memsys.read(address)
+    report = memsys.latency_report()
+    assert report["levels"] == {"Main Memory": 200, "L2": 30, "L1": 4}
+    assert report["total_latency"] == 234
+    assert report["amat"] == pytest.approx(234 / 4)
+
+
+def test_latency_histogram_of_the_requests():
+    memsys = hierarchy()
+    memsys.enable_latency_histogram()
+    for address in (0, 0, 16, 0):
+        memsys.read(address)
+    report = memsys.latency_report()
+    assert report["max_latency"] == 111
+    assert report["histogram"] == [{"low": 1, "high": 1, "count": 1}, {"low": 8, "high": 15, "count": 1},
+                                   {"low": 64, "high": 127, "count": 2}]
+
+
+def test_histogram_buckets_are_powers_of_two():
+    histogram = LatencyHistogram()
+    for latency in [0, 0, 1, 2, 3, 4, 7, 8, 1000]:
+        histogram.add(latency)
+    assert histogram.buckets() == [(0, 0, 2), (1, 1, 1), (2, 3, 2), (4, 7, 2), (8, 15, 1), (512, 1023, 1)]
+    assert (histogram.count, histogram.total, histogram.maximum) == (9, 1025, 1000)
+
+
+#latencies are binned in chunks, the pending ones included
+def test_histogram_flushes_every_chunk():
+    histogram = LatencyHistogram()
+    for _ in range(LatencyHistogram.CHUNK + 1):
+        histogram.add(5)
+    assert histogram.count == LatencyHistogram.CHUNK
+    assert histogram.buckets() == [(4, 7, LatencyHistogram.CHUNK + 1)]
+
+
+#four misses issued a cycle apart, then a hit on the first line
+def timed(mshrs):
+    memsys = MemorySystem(16)
+    memsys.add_main(4)
+    memsys.add_cache("L1", 2, 0, 4, ReplacementPolicy.LRU, True, True, 0, mshrs = mshrs)
+    memsys.set_narrate(False)
+    for (level, latency) in zip(memsys.levels, (100, 1)):
+        level.set_latency(latency)
+    memsys.enable_timing()
+    for address in (0, 16, 32, 48, 4):
+        memsys.read(address)
+    return memsys
+
+
+#without a limit the misses overlap and the last read merges into the first miss, still in flight
+def test_timed_misses_overlap():
+    memsys = timed(0)
+    report = memsys.timing_report()
+    assert (report["requests"], report["cycles"]) == (5, 104)
+    assert report["average_latency"] == pytest.approx((4 * 101 + 97) / 5)
+    mshr = report["levels"]["L1"]
+    assert (mshr["mshrs"], mshr["misses"], mshr["merged"], mshr["stall_cycles"]) == (None, 4, 1, 0)
+    assert mshr["mlp"] == pytest.approx(4 * 101 / 104)
+    assert memsys.last_level.statistics.read_hit == 1
+
+
+#with one MSHR every miss waits for the previous one, and the requests after it are blocked too
+@pytest.mark.parametrize(("mshrs", "cycles", "stalls", "mlp"), [(1, 404, 302, 1.0), (2, 203, 100, 404 / 203)])
+def test_mshrs_limit_the_misses_in_flight(mshrs, cycles, stalls, mlp):
+    report = timed(mshrs).timing_report()
+    mshr = report["levels"]["L1"]
+    assert report["cycles"] == cycles
+    assert (mshr["mshrs"], mshr["misses"], mshr["merged"], mshr["stall_cycles"]) == (mshrs, 4, 0, stalls)
+    assert mshr["mlp"] == pytest.approx(mlp)
@@ -0,0 +1,111 @@
+import os
+import socket
+import sys
+import threading
+import time
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from cacheasy import SIZED_TRACE_DTYPE, LiveIngest, MemorySystem, OutputWriter, ReplacementPolicy
+
+
+#the live ingestion threads write while the prompt flushes: no line may be lost or mixed
+def test_output_writer_is_thread_safe(capsys):
+    writer = OutputWriter(flush_lines = 7)
+    #switch threads as often as possible, so unsynchronised appends and clears would collide
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    def produce(thread):
+        for i in range(20000):
+            writer.write(f"{thread} {i}")
+    threads = [threading.Thread(target = produce, args = (thread,)) for thread in range(4)]
+    try:
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            writer.flush()
+        writer.flush()
+    finally:
+        sys.setswitchinterval(interval)
+    lines = capsys.readouterr().out.splitlines()
+    assert sorted(lines) == sorted(f"{thread} {i}" for thread in range(4) for i in range(20000))
+
+
+def hierarchy():
+    memsys = MemorySystem(16)
+    memsys.add_main(4)
+    memsys.add_cache("L2", 3, 1, 5, ReplacementPolicy.LRU, True, True, 0)
+    memsys.add_cache("L1", 2, 1, 4, ReplacementPolicy.LRU, True, True, 0)
+    memsys.set_narrate(False)
+    return memsys
+
+
+def accesses(length = 3000):
+    rng = np.random.default_rng(11)
+    records = np.zeros(length, dtype=SIZED_TRACE_DTYPE)
+    records['addr'] = rng.integers(0, 2**12, length)
+    records['write'] = rng.integers(0, 2, length)
+    return records
+
+
+def counters(memsys):
+    return [level.statistics.get_counters() for level in memsys.levels]
+
+
+def text(records):
+    lines = [f"{'W' if write else 'R'} {addr:#x}" for (addr, write) in zip(records['addr'].tolist(), records['write'].tolist())]
+    return ("\n".join(lines[:10] + ["not a record"] + lines[10:]) + "\n").encode()
+
+
+#records written to a FIFO in uneven pieces give the same statistics as the whole trace
+@pytest.mark.parametrize("binary", [False, True])
+def test_fifo_ingest_matches_the_trace(tmp_path, binary):
+    records = accesses()
+    fifo = str(tmp_path / "accesses")
+    os.mkfifo(fifo)
+    memsys = hierarchy()
+    live = LiveIngest(memsys, fifo, binary = binary, sized = True, chunk = 500)
+    live.start()
+    data = records.tobytes() if binary else text(records)
+    with open(fifo, 'wb') as pipe:
+        for start in range(0, len(data), 1001):
+            pipe.write(data[start:start + 1001])
+            pipe.flush()
+    assert live.wait(30)
+    report = live.report()
+    assert (report["state"], report["received"], report["simulated"], report["error"]) == ("finished", 3000, 3000, None)
+    assert report["invalid"] == (0 if binary else 1)
+    reference = hierarchy()
+    reference.run_trace(records)
+    assert counters(memsys) == counters(reference)
+
+
+def test_socket_ingest_matches_the_trace(tmp_path):
+    records = accesses()
+    path = str(tmp_path / "accesses.sock")
+    memsys = hierarchy()
+    live = LiveIngest(memsys, "unix:" + path, chunk = 256)
+    live.start()
+    deadline = time.monotonic() + 30
+    while not os.path.exists(path) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(path)
+        client.sendall(text(records))
+    while live.report()["simulated"] < len(records) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    live.stop()
+    assert live.wait(30)
+    assert (live.report()["simulated"], live.report()["state"]) == (len(records), "stopped")
+    reference = hierarchy()
+    reference.run_trace(records)
+    assert counters(memsys) == counters(reference)
+    assert not os.path.exists(path)
+
+
+def test_missing_fifo():
+    with pytest.raises(Exception):
+        LiveIngest(hierarchy(), "/nonexistent/accesses")
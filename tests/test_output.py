@@ -0,0 +1,31 @@
+import re
+
+from cacheasy import OutputWriter
+
+HIERARCHY = ["address_width 16", "line_size_width 4", "create Test", "name Memory", "memory",
+             "name L1", "set_width 1", "way_width 0", "cache"]
+
+
+def test_output_is_buffered_until_flushed(capsys):
+    writer = OutputWriter(flush_lines = 3)
+    writer.write("one")
+    writer.write("two")
+    assert capsys.readouterr().out == ""
+    writer.write("three")
+    assert capsys.readouterr().out == "one\ntwo\nthree\n"
+    writer.write("four")
+    writer.flush()
+    assert capsys.readouterr().out == "four\n"
+
+
+#colours are left out off-terminal, and only the escape codes differ when they are forced
+def test_colours_only_on_request(simulate):
+    (app, _) = simulate(*HIERARCHY)
+    (_, plain) = simulate("read 0", "write 32", "show_state stats", app = app)
+    try:
+        (app, _) = simulate(*HIERARCHY, "colour True")
+        (_, coloured) = simulate("read 0", "write 32", "show_state stats", app = app)
+    finally:
+        simulate("colour False")
+    assert "\x1b[" not in plain and "\x1b[" in coloured
+    assert re.sub(r"\x1b\[[0-9;]*m", "", coloured) == plain
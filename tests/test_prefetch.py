@@ -0,0 +1,44 @@
+from cacheasy import MemorySystem, ReplacementPolicy, create_prefetcher
+
+SEQUENTIAL = [16 * i for i in range(64)]
+
+
+def run(kind, params, addrs, latency = 0, set_width = 4, way_width = 2):
+    memsys = MemorySystem(20)
+    memsys.add_main(4)
+    memsys.add_cache("L1", set_width, way_width, 4, ReplacementPolicy.LRU, True, True, 0, prefetcher = create_prefetcher(kind, params, latency))
+    memsys.set_narrate(False)
+    for addr in addrs:
+        memsys.read(addr)
+    return memsys.last_level.statistics
+
+
+#the first miss starts the chain and every prefetched line triggers the next one
+def test_next_line_covers_a_sequential_scan():
+    stats = run('next_line', [1], SEQUENTIAL)
+    assert (stats.line_miss, stats.prefetch_issued, stats.prefetch_useful, stats.prefetch_late) == (1, 64, 63, 0)
+    assert stats.prefetch_coverage() == 63 / 64
+    #used on the next access, sooner than the latency
+    late = run('next_line', [1], SEQUENTIAL, latency = 8)
+    assert (late.prefetch_useful, late.prefetch_late) == (0, 63)
+    assert late.prefetch_accuracy() == stats.prefetch_accuracy()
+
+
+def test_next_line_prefetches_evicted_unused_are_useless():
+    #every other line of a direct mapped cache: the prefetched odd lines are never read
+    stats = run('next_line', [1], [32 * i for i in range(32)], set_width = 2, way_width = 0)
+    assert stats.prefetch_useful + stats.prefetch_late == 0
+    assert stats.prefetch_useless > 0 and stats.prefetch_accuracy() == 0.0
+
+
+#a stride needs two accesses to be seen and a third to be confirmed
+def test_stride_detects_strides_per_region():
+    stats = run('stride', [1, 12], [48 * i for i in range(40)])
+    assert (stats.line_miss, stats.prefetch_issued, stats.prefetch_useful) == (3, 38, 37)
+
+
+#lines wait in the buffers and move into the cache on a demand miss, which then is not a pull
+def test_stream_buffers_supply_misses():
+    stats = run('stream', [2, 4], SEQUENTIAL)
+    assert (stats.line_miss, stats.line_pull, stats.prefetch_useful) == (64, 1, 63)
+    assert stats.prefetch_coverage() == 63 / 64
@@ -0,0 +1,21 @@
+import csv
+import io
+import json
+
+HIERARCHY = ["address_width 16", "line_size_width 4", "create Test", "name Memory", "memory",
+             "name L1", "set_width 2", "way_width 1", "cache", "narrate False"]
+
+
+def test_show_state_exports_plain_statistics(simulate):
+    (app, _) = simulate(*HIERARCHY, "read 0", "write 0", "read 1024")
+    (_, text) = simulate("show_state --format json", app = app)
+    stats = json.loads(text)
+    (memory, l1) = stats["levels"]
+    assert (memory["name"], l1["name"]) == ("Memory", "L1")
+    assert (l1["read_hit"], l1["read_miss"], l1["write_hit"], l1["line_miss"]) == (0, 2, 1, 2)
+    assert l1["hit_rate"] == 1 / 3
+    assert "\x1b" not in text
+    (_, text) = simulate("show_state --format csv", app = app)
+    rows = list(csv.DictReader(io.StringIO(text)))
+    assert [row["name"] for row in rows] == ["Memory", "L1"]
+    assert rows[1]["read_miss"] == "2"
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from cacheasy import STREAM_DTYPE, TRACE_DTYPE, MemorySystem, ReplacementPolicy, StreamRecorder
+
+
+def lower_levels():
+    memsys = MemorySystem(16)
+    memsys.add_main(4)
+    memsys.add_cache("L2", 3, 1, 5, ReplacementPolicy.LRU, True, True, 0)
+    memsys.set_narrate(False)
+    return memsys
+
+
+def trace(length, seed = 5):
+    rng = np.random.default_rng(seed)
+    records = np.zeros(length, dtype=TRACE_DTYPE)
+    records['addr'] = rng.integers(0, 2**12, length)
+    records['write'] = rng.integers(0, 2, length)
+    return records
+
+
+def counters(memsys):
+    return [level.statistics.get_counters() for level in memsys.levels]
+
+
+#replaying what L1 sent to L2 on a fresh L2 gives the same hits and misses below L1
+@pytest.mark.parametrize(("write_back", "fast_forward"), [(True, 0), (False, 0), (True, 300)])
+def test_replay_matches_the_recorded_run(write_back, fast_forward):
+    memsys = lower_levels()
+    memsys.add_cache("L1", 2, 1, 4, ReplacementPolicy.LRU, write_back, True, 0)
+    memsys.set_narrate(False)
+    memsys.set_fast_forward(fast_forward)
+    memsys.record_stream("L1")
+    memsys.run_trace(trace(2000))
+    stream = memsys.stop_recording()
+    assert stream.dtype == STREAM_DTYPE
+    assert (stream['kind'] & StreamRecorder.WARM != 0).any() == (fast_forward > 0)
+    replayed = lower_levels()
+    replayed.replay_stream(stream, chunk_size = 128)
+    assert counters(replayed) == counters(memsys)[:2]
+    assert replayed.last_level.statistics.read_miss > 0
+
+
+def test_record_checks():
+    memsys = lower_levels()
+    with pytest.raises(Exception):
+        memsys.record_stream("L1")
+    with pytest.raises(Exception):
+        memsys.stop_recording()
+    memsys.add_cache("L1", 2, 1, 4, ReplacementPolicy.LRU, True, True, 0)
+    memsys.record_stream("L1")
+    with pytest.raises(Exception):
+        memsys.record_stream("L1")
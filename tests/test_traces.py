@@ -0,0 +1,87 @@
+import numpy as np
+
+from cacheasy import TRACE_DTYPE, MemorySystem, ReplacementPolicy
+
+HIERARCHY = ["address_width 20", "line_size_width 4", "create Test", "name Memory", "memory",
+             "name L1", "set_width 4", "way_width 1", "cache", "narrate False"]
+
+
+def random_trace(length = 4000, seed = 3):
+    rng = np.random.default_rng(seed)
+    trace = np.zeros(length, dtype=TRACE_DTYPE)
+    trace['addr'] = rng.integers(0, 2**14, length)
+    trace['write'] = rng.random(length) < 0.3
+    return trace
+
+
+#.npy and text traces give the statistics of the same accesses issued one by one
+def test_trace_files_run_like_commands(simulate, tmp_path):
+    trace = random_trace(500)
+    np.save(tmp_path / "trace.npy", trace)
+    (tmp_path / "trace.txt").write_text("# comment\n" + "".join(f"{'W' if write else 'R'} {addr}\n" for (addr, write) in trace.tolist()))
+    commands = [f"{'write' if write else 'read'} {addr}" for (addr, write) in trace.tolist()]
+    expected = simulate(*HIERARCHY, *commands)[0].memsys.last_level.statistics.get_counters()
+    for name in ("trace.npy", "trace.txt"):
+        (app, _) = simulate(*HIERARCHY, f"trace {tmp_path / name}")
+        assert app.memsys.last_level.statistics.get_counters() == expected
+
+
+#the sets of one level are independent, so the sampled ones count exactly as in a full run
+def test_sampled_sets_match_the_full_run():
+    trace = random_trace()
+    runs = []
+    for ratio in (None, 4):
+        memsys = MemorySystem(20)
+        memsys.add_main(4)
+        memsys.add_cache("L1", 4, 1, 4, ReplacementPolicy.LRU, True, True, 0)
+        memsys.set_narrate(False)
+        if ratio is not None:
+            memsys.enable_sampling(ratio)
+        memsys.run_trace(trace)
+        runs.append(memsys)
+    (full, sampled) = runs
+    sampler = sampled.sampler
+    selected = sampler.sampled_sets(sampled.last_level)
+    assert np.count_nonzero(selected) == 4
+    assert sampler.accesses == len(trace)
+    assert sampler.simulated == int(np.count_nonzero(selected[(trace['addr'] >> 4) & 15]))
+    assert sampled.last_level.set_misses[selected].tolist() == full.last_level.set_misses[selected].tolist()
+    estimate = sampler.estimate(sampled.last_level)
+    full_rate = full.last_level.statistics.line_hit / len(trace)
+    assert abs(estimate["line_hit_rate"] - full_rate) < 2 * estimate["line_hit_rate_margin"] + 0.02
+
+
+def two_levels():
+    memsys = MemorySystem(20)
+    memsys.add_main(4)
+    memsys.add_cache("L2", 5, 1, 4, ReplacementPolicy.LRU, True, True, 0)
+    memsys.add_cache("L1", 3, 1, 4, ReplacementPolicy.FIFO, True, True, 0)
+    memsys.set_narrate(False)
+    return memsys
+
+
+def contents(memsys):
+    return [[(line.tag, line.valid, line.dirty) for lines in level.set_data for line in lines] for level in memsys.levels[1:]]
+
+
+def counters(memsys):
+    return [level.statistics.get_counters() for level in memsys.levels]
+
+
+#a fast forwarded warm-up leaves the contents of a full run, and only the rest is counted
+def test_fast_forward_warms_without_counting():
+    trace = random_trace()
+    (warm, rest) = (1000, len(trace) - 1000)
+    full = two_levels()
+    full.run_trace(trace[:warm])
+    before = counters(full)
+    full.run_trace(trace[warm:])
+    fast = two_levels()
+    fast.set_fast_forward(warm)
+    fast.run_trace(trace)
+    assert fast.fast_forward == 0
+    assert contents(fast) == contents(full)
+    tail = [{name: after[name] - first[name] for name in after} for (first, after) in zip(before, counters(full))]
+    assert counters(fast) == tail
+    assert fast.last_level.statistics.read_hit + fast.last_level.statistics.read_miss + \
+        fast.last_level.statistics.write_hit + fast.last_level.statistics.write_miss == rest
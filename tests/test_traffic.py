@@ -0,0 +1,104 @@
+import pytest
+
+from cacheasy import WORD_SIZE, MemorySystem, ReplacementPolicy, split_access
+
+
+#a one line L1 of 16 B lines over main memory, with the traffic of every request
+def one_line(write_back = True):
+    memsys = MemorySystem(16)
+    memsys.add_main(4)
+    memsys.add_cache("L1", 0, 0, 4, ReplacementPolicy.LRU, write_back, True, 0)
+    memsys.set_narrate(False)
+    memsys.enable_traffic_windows(1)
+    return memsys
+
+
+#the dirty line goes up when the second block evicts it, then comes back down
+def test_write_back_traffic():
+    memsys = one_line()
+    memsys.write(0)
+    memsys.read(16)
+    memsys.read(0)
+    memsys.write(0)
+    report = memsys.traffic_report()
+    level = report["levels"]["L1"]
+    assert (level["next"], level["bytes_down"], level["bytes_up"]) == ("Main Memory", 48, 16)
+    assert level["windows_down"] == [16, 16, 16, 0]
+    assert level["windows_up"] == [0, 16, 0, 0]
+    assert report["memory_bytes"] == 64
+    assert report["memory_bytes_per_request"] == pytest.approx(64 / 4)
+
+
+#every write goes through with its size, a word when it is not given
+def test_write_through_traffic():
+    memsys = one_line(write_back = False)
+    memsys.write(0)
+    memsys.read(16)
+    memsys.write(16, size = 8)
+    level = memsys.traffic_report()["levels"]["L1"]
+    assert (level["bytes_down"], level["bytes_up"]) == (32, WORD_SIZE + 8)
+    assert level["windows_up"] == [WORD_SIZE, 0, 8]
+
+
+def test_traffic_windows_group_requests():
+    memsys = one_line()
+    memsys.enable_traffic_windows(2)
+    for address in (0, 16, 32, 48, 0):
+        memsys.read(address)
+    level = memsys.traffic_report()["levels"]["L1"]
+    #the last request has not closed its window
+    assert level["windows_down"] == [32, 32]
+    with pytest.raises(Exception):
+        memsys.enable_traffic_windows(0)
+
+
+def test_split_access_by_line():
+    assert split_access(12, 8, 4) == [(12, 4), (16, 4)]
+    assert split_access(16, 16, 4) == [(16, 16)]
+    assert split_access(30, 40, 4) == [(30, 2), (32, 16), (48, 16), (64, 6)]
+
+
+#an access straddling two lines is split into one access per line
+def test_sized_access_straddles_lines():
+    memsys = MemorySystem(16)
+    memsys.add_main(4)
+    memsys.add_cache("L1", 1, 0, 4, ReplacementPolicy.LRU, True, True, 0)
+    memsys.set_narrate(False)
+    memsys.read(12, size = 8)
+    stats = memsys.last_level.statistics
+    assert (stats.read_miss, stats.read_hit, stats.bytes_fill) == (2, 0, 32)
+    assert memsys.requests() == 2
+    memsys.read(4, size = 4)
+    memsys.read(16, size = 4)
+    assert stats.read_hit == 2
+
+
+#a 64 B line of L1 is filled from, and written back to, four 16 B lines of L2
+def test_fills_and_writebacks_move_whole_lines():
+    memsys = MemorySystem(16)
+    memsys.add_main(4)
+    memsys.add_cache("L2", 2, 0, 4, ReplacementPolicy.LRU, True, True, 0)
+    memsys.add_cache("L1", 0, 0, 6, ReplacementPolicy.LRU, True, True, 0)
+    memsys.set_narrate(False)
+    (l2, l1) = memsys.levels[1:]
+    memsys.read(0)
+    assert (l2.statistics.read_miss, l2.statistics.bytes_fill) == (4, 64)
+    memsys.write(8)
+    memsys.read(64)
+    assert (l1.statistics.line_evict, l1.statistics.bytes_writeback) == (1, 64)
+    #the written back lines are dirty in L2, and reach main memory when the next block evicts them
+    assert (l2.statistics.read_miss, l2.statistics.line_evict, l2.statistics.bytes_writeback) == (8, 4, 64)
+
+
+#a writeback allocates in a full level below, evicting what is there
+def test_writeback_into_a_full_level():
+    memsys = MemorySystem(16)
+    memsys.add_main(4)
+    memsys.add_cache("L2", 0, 0, 4, ReplacementPolicy.LRU, True, True, 0)
+    memsys.add_cache("L1", 1, 0, 4, ReplacementPolicy.LRU, True, True, 0)
+    memsys.set_narrate(False)
+    memsys.write(0)
+    memsys.read(16)
+    memsys.read(32)
+    l2 = memsys.levels[1]
+    assert (l2.statistics.read_miss, l2.statistics.bytes_writeback) == (3, 16)
@@ -0,0 +1,57 @@
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+from cacheasy import MemorySystem, ReplacementPolicy, VictimBuffer
+
+
+#direct mapped L1 of 4 lines with a fully associative victim buffer of 4 lines, step by step
+class Model:
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.l1 = {}
+        #block -> dirty, the newest last
+        self.victim = OrderedDict()
+        self.swaps = self.evictions = self.pulls = 0
+
+    def access(self, addr, write):
+        block = addr >> 4
+        line = self.l1.get(block % 4)
+        if line is not None and line[0] == block:
+            self.l1[block % 4] = (block, line[1] or write)
+            return
+        if block in self.victim:
+            self.swaps += 1
+            dirty = self.victim.pop(block)
+        else:
+            self.pulls += 1
+            dirty = False
+        if line is not None:
+            if len(self.victim) == 4:
+                #LRU and FIFO evict the oldest line, MRU the newest
+                (_, evicted) = self.victim.popitem(last = self.policy is ReplacementPolicy.MRU)
+                self.evictions += evicted
+            self.victim[line[0]] = line[1]
+        self.l1[block % 4] = (block, dirty or write)
+
+
+@pytest.mark.parametrize("policy", [ReplacementPolicy.LRU, ReplacementPolicy.FIFO, ReplacementPolicy.MRU])
+def test_victim_buffer_follows_a_reference_model(policy):
+    memsys = MemorySystem(16)
+    memsys.add_main(4)
+    memsys.add_cache("L1", 2, 0, 4, ReplacementPolicy.LRU, True, True, 0)
+    memsys.add_victim("Victim", 0, 2, 4, policy)
+    memsys.set_narrate(False)
+    victim = memsys.last_level.victim
+    assert isinstance(victim, VictimBuffer)
+    model = Model(policy)
+    rng = np.random.default_rng(5)
+    for (addr, write) in zip(rng.integers(0, 2**9, 3000).tolist(), (rng.random(3000) < 0.4).tolist()):
+        memsys.write(addr) if write else memsys.read(addr)
+        model.access(addr, write)
+    stats = memsys.last_level.statistics
+    assert (stats.victim_swap, stats.victim_evict, stats.line_pull) == (model.swaps, model.evictions, model.pulls)
+    assert stats.victim_swap > 100 and stats.victim_evict > 100
+    assert sorted((block, line.dirty) for (block, line) in victim.lines.items()) == sorted(model.victim.items())
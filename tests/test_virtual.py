@@ -0,0 +1,137 @@
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+from cacheasy import MemorySystem, PagePolicy, PageWalker, ReplacementPolicy, VirtualMemory
+
+#the textbook reference string
+REFERENCES = [7, 0, 1, 2, 0, 3, 0, 4, 2, 3, 0, 3, 2, 1, 2, 0, 1, 7, 0, 1]
+
+
+#4 physical pages of 4KB below 16 bit virtual addresses
+def virtual_memory(policy, interval = 64):
+    memsys = MemorySystem(14)
+    memsys.add_cache("Physical", 2, 0, 12, ReplacementPolicy.LRU, True, True, 0)
+    virtual = VirtualMemory("Virtual", 16, 14, 12, page_policy = policy, page_interval = interval)
+    virtual.add_memory_system(memsys)
+    virtual.set_narrate(False)
+    return virtual
+
+
+def faults(policy, pages, interval = 64):
+    virtual = virtual_memory(policy, interval)
+    for page in pages:
+        virtual.read(page << 12)
+    return virtual.statistics.line_miss
+
+
+@pytest.mark.parametrize(("policy", "expected"), [(PagePolicy.FIFO, 10), (PagePolicy.LRU, 8)])
+def test_textbook_page_faults(policy, expected):
+    assert faults(policy, REFERENCES) == expected
+
+
+def second_chance_faults(pages, frames = 4):
+    #page -> referenced, oldest first
+    queue = OrderedDict()
+    count = 0
+    for page in pages:
+        if page in queue:
+            queue[page] = True
+            continue
+        count += 1
+        if len(queue) == frames:
+            while True:
+                (oldest, referenced) = next(iter(queue.items()))
+                if not referenced:
+                    break
+                queue[oldest] = False
+                queue.move_to_end(oldest)
+            del queue[oldest]
+        queue[page] = True
+    return count
+
+
+#the clock is second chance with the queue kept as a ring
+@pytest.mark.parametrize("policy", [PagePolicy.CLOCK, PagePolicy.SECOND_CHANCE])
+def test_clock_and_second_chance_follow_the_model(policy):
+    rng = np.random.default_rng(7)
+    pages = rng.integers(0, 8, 400).tolist()
+    assert faults(policy, pages) == second_chance_faults(pages)
+    assert faults(policy, REFERENCES) == second_chance_faults(REFERENCES)
+
+
+def resident(virtual):
+    return sorted(virtual.page_table)
+
+
+#with the referenced bits cleared on every access, NRU evicts the only clean page
+def test_nru_prefers_clean_pages():
+    virtual = virtual_memory(PagePolicy.NRU, interval = 1)
+    for page in (0, 1, 3):
+        virtual.write(page << 12)
+    virtual.read(2 << 12)
+    virtual.read(4 << 12)
+    assert resident(virtual) == [0, 1, 3, 4]
+
+
+#the ages keep the referenced bits of the last intervals, so the page unused the longest goes
+def test_aging_evicts_the_oldest_history():
+    virtual = virtual_memory(PagePolicy.AGING, interval = 1)
+    for page in (0, 1, 2, 3, 0, 2, 3, 0, 3):
+        virtual.read(page << 12)
+    virtual.read(4 << 12)
+    assert resident(virtual) == [0, 2, 3, 4]
+
+
+#two levels of 2 bits, tables from physical page 3
+def test_walker_paths_and_tables():
+    walker = PageWalker([2, 2], 12, 3, 1)
+    path = walker.path(0b0110)
+    assert path == [(0, 0, 0x3000 + 1 * 8), (1, 1, 0x3020 + 2 * 8)]
+    assert walker.leaf(0b0111) == 0x3020 + 3 * 8
+    assert walker.walk(0b0110) == [entry for (_, _, entry) in path]
+    assert (walker.walks, walker.entries_read) == (1, 2)
+
+
+def test_walker_tables_fit_the_reserved_pages():
+    walker = PageWalker([9, 9], 12, 0, 1)
+    with pytest.raises(Exception):
+        walker.path(0)
+
+
+def test_walk_cache_skips_cached_levels():
+    walker = PageWalker([2, 2], 12, 3, 1, walk_cache_entries = 4)
+    walker.walk(0b0110)
+    assert walker.walk(0b0111) == [walker.leaf(0b0111)]
+    assert (walker.walks, walker.entries_read, walker.walk_cache_hits) == (2, 3, 1)
+
+
+def test_tlb_is_lru():
+    walker = PageWalker([2, 2], 12, 3, 1, tlb_entries = 2)
+    walker.tlb_insert(1)
+    walker.tlb_insert(2)
+    assert walker.tlb_lookup(1)
+    walker.tlb_insert(3)
+    assert not walker.tlb_lookup(2)
+    assert walker.tlb_lookup(1) and walker.tlb_lookup(3)
+    assert walker.tlb_hits == 3
+
+
+#8 physical pages, the last 2 hold the two levels of the page table
+@pytest.mark.parametrize(("tlb", "walks", "tlb_hits"), [(0, 8, 0), (64, 4, 4)])
+def test_page_walks_read_the_page_table(tlb, walks, tlb_hits):
+    memsys = MemorySystem(15)
+    memsys.add_cache("Physical", 3, 0, 12, ReplacementPolicy.LRU, True, True, 0)
+    virtual = VirtualMemory("Virtual", 16, 15, 12, walk_levels = [2, 2], tlb_entries = tlb)
+    virtual.add_memory_system(memsys)
+    virtual.set_narrate(False)
+    for _ in range(2):
+        for page in range(4):
+            virtual.read(page << 12)
+    assert virtual.number_of_pages == 6
+    assert sorted(virtual.walker.tables.values()) == [6 << 12, (6 << 12) + 32]
+    stats = virtual.walker.stats_dict()
+    assert (stats["page_walks"], stats["walk_entries_read"], stats["tlb_hits"]) == (walks, 2 * walks, tlb_hits)
+    #one leaf entry written per page loaded
+    assert stats["walk_entries_written"] == virtual.statistics.line_miss == 4
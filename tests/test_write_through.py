@@ -0,0 +1,58 @@
+from cacheasy import WORD_SIZE, MemorySystem, ReplacementPolicy, WriteBuffer
+
+
+#a write-through L1 of 4 lines over a write-back L2
+def write_through(write_allocate = True, write_buffer = 0):
+    memsys = MemorySystem(16)
+    memsys.add_main(4)
+    memsys.add_cache("L2", 2, 1, 4, ReplacementPolicy.LRU, True, True, 0)
+    memsys.add_cache("L1", 2, 0, 4, ReplacementPolicy.LRU, False, write_allocate, 0, write_buffer = write_buffer)
+    memsys.set_narrate(False)
+    return memsys.levels[1:] + [memsys]
+
+
+def test_buffer_merges_bytes_of_a_line():
+    buffer = WriteBuffer(2, 4)
+    assert not buffer.insert(4, 4)
+    assert buffer.insert(12, 2)
+    assert not buffer.insert(16, 1)
+    assert buffer.full() and 20 in buffer and 32 not in buffer
+    #the span covers the first and last bytes written
+    assert buffer.pop() == (4, 10)
+    assert buffer.between(0, 31) == [16]
+
+
+#every write reaches L2, where the allocating miss of L1 brought the line, and the lines of L1 stay clean
+def test_write_through_without_buffer():
+    (l2, l1, memsys) = write_through()
+    for address in (0, 4, 0):
+        memsys.write(address)
+    memsys.read(64)
+    assert (l1.statistics.write_forward, l1.statistics.bytes_through) == (3, 3 * WORD_SIZE)
+    assert (l1.statistics.line_evict, l1.statistics.bytes_writeback) == (0, 0)
+    assert (l2.statistics.write_hit, l2.statistics.write_miss) == (3, 0)
+
+
+#writes to a pending line merge, and a write to a new line waits for the oldest entry when full
+def test_buffer_coalesces_and_stalls():
+    (l2, l1, memsys) = write_through(write_buffer = 2)
+    for address in (0, 4, 16, 32):
+        memsys.write(address)
+    stats = l1.statistics
+    assert (stats.buffer_merge, stats.buffer_stall, stats.buffer_drain) == (1, 1, 1)
+    #the drained entry holds both words of block 0
+    assert stats.bytes_through == 2 * WORD_SIZE
+    assert l2.statistics.write_hit == 1
+    assert sorted(l1.write_buffer.between(0, 2**16 - 1)) == [16, 32]
+
+
+#the pending writes of a line reach L2 before the line is read from it
+def test_read_miss_drains_the_line():
+    (l2, l1, memsys) = write_through(write_allocate = False, write_buffer = 4)
+    memsys.write(0)
+    memsys.write(2, size = 2)
+    assert len(l1.write_buffer) == 1 and l2.statistics.write_miss == 0
+    memsys.read(0)
+    assert len(l1.write_buffer) == 0
+    assert (l1.statistics.buffer_merge, l1.statistics.buffer_drain, l1.statistics.bytes_through) == (1, 1, 4)
+    assert (l2.statistics.write_miss, l2.statistics.read_hit) == (1, 1)